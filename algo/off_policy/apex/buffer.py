@@ -2,13 +2,17 @@ import numpy as np
 
 from utility.debug_tools import assert_colorize
 from utility.run_avg import RunningMeanStd
-from algo.off_policy.replay.utils import init_buffer, add_buffer, copy_buffer
+from algo.off_policy.replay.utils import (build_schema, encode, decode, init_buffer, add_buffer, copy_buffer, 
+                                          frame_offsets, gather_frames)
 
 
 class LocalBuffer(dict):
-    """ Local buffer only stores one episode of transitions """
+    """ Local buffer of a worker, streamed to the replay in chunks with pop_chunk.
+    Episodes run on across chunks, the last n_steps rows of a chunk go with it as next states
+    and stay in the buffer as the first rows of the next chunk, where their n-step returns are completed.
+    With frame stacking, the frame_stack - 1 rows before them also stay as the frame context of the next chunk, 
+    so the stacks of all rows are rebuilt from frames merged with them """
     def __init__(self, args, state_shape, action_dim):
-        self.capacity = args['local_capacity']
         self.n_steps = args['n_steps']
         self.gamma = args['gamma']
 
@@ -16,7 +20,15 @@ class LocalBuffer(dict):
         self.fake_ratio = np.zeros(1)
         self.fake_ids = np.zeros(1, dtype=np.int32)
 
-        init_buffer(self, self.capacity, state_shape, action_dim, True, extra_state=1)
+        # local buffers share the schema of the replay they are merged into
+        self.schema = build_schema(args['schema'] if 'schema' in args else None, action_dim)
+        # rows of frame context at the front of chunks, which come on top of local_capacity
+        self.n_context = self.schema['state']['frame_stack'] - 1
+        self.capacity = args['local_capacity'] + self.n_context
+        # recurrent actors store their state before each transition for sequence replay
+        rnn_state_size = args['rnn_state_size'] if 'rnn_state_size' in args else None
+        init_buffer(self, self.capacity, state_shape, action_dim, True, extra_state=1, 
+                    schema=self.schema, rnn_state_size=rnn_state_size)
 
         self.reward_scale = args['reward_scale'] if 'reward_scale' in args else 1
         self.normalize_reward = args['normalize_reward']
@@ -24,44 +36,96 @@ class LocalBuffer(dict):
             self.running_reward_stats = RunningMeanStd()
         
         self.idx = 0
+        self.start = 0          # rows before start are frame context
+        self.episode_step = 0
 
     def __call__(self):
         """ fake the data pipline """
         while True:
             yield (self.fake_ratio, 
                    self.fake_ids, 
-                   (self['state'][:1], 
+                   (self._get_states(np.arange(1)), 
                     self['action'][:1], 
-                    self['reward'][:1],
-                    self['state'][:1], 
+                    self['reward'][:1].astype(np.promote_types(self['reward'].dtype, np.float32)),
+                    self._get_states(np.arange(1)), 
                     self['done'][:1], 
                     self['steps'][:1]))
 
-    def sample(self):
-        done = self['done'][:self.idx]
-        # process rewards
-        reward = np.copy(self['reward'][:self.idx])
+    def sample(self, start=0, end=None):
+        """ Transitions from start to end, whose next states must be in the buffer """
+        end = self.idx if end is None else end
+        done = self['done'][start: end]
+        steps = self['steps'][start: end]
+        # process rewards, in float32 whatever their storage dtype
+        reward = self['reward'][start: end].astype(np.promote_types(self['reward'].dtype, np.float32))
         if self.normalize_reward:
             # since we only expect rewards to be used once
             # we update the running stats when we use them
             self.running_reward_stats.update(reward)
             reward = self.running_reward_stats.normalize(reward)
         reward *= np.where(done, 1, self.reward_scale)
-        return (self['state'][:self.idx], 
-                self['action'][:self.idx], 
+        # samples are fed to the decoded tensors of the data pipeline
+        # next states are stored steps rows after states
+        indexes = np.arange(start, end)
+        next_indexes = indexes + steps[:, 0]
+        return (decode(self.schema, 'state', self._get_states(indexes)), 
+                decode(self.schema, 'action', self['action'][start: end]), 
                 reward,
-                self['state'][1:self.idx+1], 
+                decode(self.schema, 'state', self._get_states(next_indexes)), 
                 done, 
-                self['steps'][:self.idx])
+                steps)
 
     def reset(self):
         self.idx = 0
+        self.start = 0
+
+    @property
+    def chunk_ready(self):
+        return self.idx == self.capacity
+
+    def pop_chunk(self):
+        """ Return the filled rows as a dict of views, to be merged before the buffer is written again, 
+        and carry the last n_steps rows over to the next chunk. These rows only hold the next states 
+        of the chunk and their returns are incomplete, so they are sent with zero priority
+        and the replay never samples them. Neither does it sample the frame context before self.start.
+        Priorities of the rows in between are left to the caller """
+        length = self.idx
+        self['priority'][:self.start] = 0
+        self['priority'][length - self.n_steps: length] = 0
+        chunk = {k: v[:length] for k, v in self.items()}
+
+        return chunk, length
+
+    def carry_tail(self):
+        """ Move the last n_context + n_steps rows of the popped chunk to the front of the buffer """
+        n_carried = self.n_context + self.n_steps
+        tail = slice(self.idx - n_carried, self.idx)
+        for v in self.values():
+            v[:n_carried] = v[tail]
+        if 'since_start' in self:
+            # frames before the chunk are not merged with it, only the context rows lose frames this way
+            np.minimum(self['since_start'][:n_carried, 0], np.arange(n_carried, dtype=np.uint8), 
+                       out=self['since_start'][:n_carried, 0])
+        self.idx = n_carried
+        self.start = self.n_context
         
-    def add_data(self, state, action, reward, done):
+    def add_data(self, state, action, reward, done, rnn_state=None):
         """ Add experience to local buffer, return True if local buffer is full, otherwise false """
+        # frames before the buffer start are not merged, so the episode is cut there
         add_buffer(self, self.idx, state, action, reward, 
-                    done, self.n_steps, self.gamma)
+                    done, self.n_steps, self.gamma, schema=self.schema, 
+                    episode_step=min(self.episode_step, self.idx), rnn_state=rnn_state)
         self.idx = self.idx + 1
+        self.episode_step = 0 if done else self.episode_step + 1
 
     def add_last_state(self, state):
-        self['state'][self.idx] = state
\ No newline at end of file
+        self['state'][self.idx] = encode(self.schema, 'state', state)
+        if 'since_start' in self:
+            self['since_start'][self.idx] = min(self.episode_step, self.idx, 255)
+
+    def _get_states(self, indexes):
+        if self.schema['state']['frame_stack'] == 1:
+            return self['state'][indexes]
+        offsets = frame_offsets(self['since_start'][indexes, 0], self.schema['state']['frame_stack'], indexes)
+        
+        return gather_frames(self['state'], indexes[:, None] - offsets)
\ No newline at end of file
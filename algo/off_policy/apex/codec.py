@@ -0,0 +1,145 @@
+from collections import namedtuple
+import numpy as np
+import lz4.block
+
+from utility.debug_tools import assert_colorize
+
+
+""" Codecs for payloads sent between workers and the learner through ray.
+Experience chunks may be lz4-compressed field by field, weights may be quantized to float16
+or bfloat16, i.e., the upper 16 bits of float32. Quantization only applies to published copies,
+the learner keeps training its float32 weights. Decoding passes payloads sent without a codec through """
+Encoded = namedtuple('Encoded', 'codec data')
+
+EXPERIENCE_CODECS = [None, 'lz4']
+WEIGHT_CODECS = [None, 'float16', 'bfloat16']
+
+
+def encode_experience(chunk, codec):
+    """ Encode a dict of arrays """
+    assert_colorize(codec in EXPERIENCE_CODECS, f'Unknown experience codec: {codec}')
+    if codec is None:
+        return chunk
+    return Encoded(codec, {k: (lz4.block.compress(np.ascontiguousarray(v)), v.shape, v.dtype.str)
+                           for k, v in chunk.items()})
+
+def decode_experience(payload):
+    if not isinstance(payload, Encoded):
+        return payload
+    return {k: np.frombuffer(lz4.block.decompress(data), dtype=dtype).reshape(shape)
+            for k, (data, shape, dtype) in payload.data.items()}
+
+def encode_weights(weights, codec):
+    """ Encode a flat float32 weight vector """
+    assert_colorize(codec in WEIGHT_CODECS, f'Unknown weight codec: {codec}')
+    if codec is None:
+        return weights
+    weights = np.asarray(weights, dtype=np.float32)
+    if codec == 'float16':
+        return Encoded(codec, weights.astype(np.float16))
+    # bfloat16 keeps the upper half of float32, rounded to the nearest even
+    bits = weights.view(np.uint32)
+    rounding = np.uint32(0x7FFF) + ((bits >> 16) & 1)
+    return Encoded(codec, ((bits + rounding) >> 16).astype(np.uint16))
+
+def decode_weights(payload):
+    if not isinstance(payload, Encoded):
+        return payload
+    if payload.codec == 'float16':
+        return payload.data.astype(np.float32)
+    return (payload.data.astype(np.uint32) << 16).view(np.float32)
+
+
+if __name__ == '__main__':
+    # bytes sent and end-to-end throughput through ray with and without codecs
+    import pickle
+    from time import time
+    import ray
+    from algo.off_policy.replay.utils import build_schema, init_buffer
+    from algo.off_policy.apex.replay_server import get_replay_servers
+    # ray pickles functions of __main__ by value, which loses the lz4.block import
+    from algo.off_policy.apex.codec import encode_experience, decode_experience, encode_weights, decode_weights
+
+    action_dim = 4
+    n_steps = 3
+    chunk_size = 128
+    duration = 5
+    args = dict(
+        type='proportional',
+        capacity=int(1e5),
+        min_size=chunk_size,
+        batch_size=256,
+        normalize_reward=False,
+        n_steps=n_steps,
+        gamma=.99,
+        alpha=.5,
+        beta0=.4,
+        beta_steps=5e4,
+        tb_capacity=100,
+        n_servers=1,
+        server_cpus=0,
+    )
+    def make_chunk(state_shape, dtype):
+        chunk = {}
+        schema = build_schema(dict(state=dict(dtype=dtype)), action_dim)
+        init_buffer(chunk, chunk_size + n_steps, state_shape, action_dim, True, schema=schema)
+        if dtype == 'uint8':
+            # sprites moving over a static background, as in Atari frames
+            background = np.tile(np.linspace(0, 100, state_shape[1], dtype=np.uint8), (state_shape[0], 1))
+            for t in range(chunk_size + n_steps):
+                chunk['state'][t] = background
+                chunk['state'][t, t % 70: t % 70 + 8, (3 * t) % 70: (3 * t) % 70 + 8] = 255
+        else:
+            # low-dimensional observations drift smoothly along an episode
+            chunk['state'][:] = np.cumsum(np.random.normal(0, .05, size=chunk['state'].shape), axis=0)
+        chunk['action'][:] = np.random.uniform(-1, 1, size=chunk['action'].shape)
+        chunk['reward'][:] = np.random.normal(size=chunk['reward'].shape)
+        chunk['steps'][:] = n_steps
+        chunk['priority'][:] = np.random.uniform(.1, 2, size=chunk['priority'].shape)
+        return chunk
+
+    @ray.remote(num_cpus=0)
+    def push(server, chunk, codec, duration):
+        n = 0
+        merge_ref = None
+        start = time()
+        while time() - start < duration:
+            # chunks are encoded on every push, as by workers
+            payload = encode_experience(chunk, codec)
+            if merge_ref is not None:
+                ray.get(merge_ref)
+            # replay servers decode chunks and merge them into their replays, as the learner does
+            merge_ref = server.merge.remote(payload, chunk_size + n_steps)
+            n += 1
+        ray.get(merge_ref)
+        return n
+
+    @ray.remote(num_cpus=0)
+    def pull(refs):
+        start = time()
+        weights = decode_weights(ray.get(refs[0]))
+        return time() - start, weights[:1]
+
+    ray.init(include_dashboard=False)
+    for state_shape, dtype in [((24,), 'float16'), ((84, 84), 'uint8')]:
+        chunk = make_chunk(state_shape, dtype)
+        for codec in EXPERIENCE_CODECS:
+            server = get_replay_servers(args, state_shape, action_dim)[0]
+            n = ray.get(push.remote(server, chunk, codec, duration))
+            n_bytes = len(pickle.dumps(encode_experience(chunk, codec), protocol=5))
+            print(f'experience: {state_shape} {dtype}\tcodec: {codec}\t{n_bytes / 1024:.1f}KB per chunk\t'
+                  f'{n * (chunk_size + n_steps) / duration:.0f} transitions/s')
+            ray.kill(server)
+
+    # about the size of the SAC networks in apex/sac_args.yaml
+    weights = np.random.normal(0, .05, size=int(1.5e6)).astype(np.float32)
+    for codec in WEIGHT_CODECS:
+        payload = encode_weights(weights, codec)
+        start = time()
+        for _ in range(20):
+            ref = ray.put(encode_weights(weights, codec))
+        encode_time = (time() - start) / 20
+        pull_times = [ray.get(pull.remote([ray.put(payload)]))[0] for _ in range(20)]
+        error = np.max(np.abs(decode_weights(payload) - weights))
+        print(f'weights: 1.5M float32\tcodec: {codec}\t{len(pickle.dumps(payload, protocol=5)) / 2**20:.1f}MB\t'
+              f'publish: {encode_time * 1e3:.1f}ms\tpull: {np.mean(pull_times) * 1e3:.1f}ms\tmax error: {error:.1e}')
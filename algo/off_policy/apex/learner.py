@@ -8,10 +8,14 @@ import ray
 
 from utility import tf_utils
 from utility.display import pwc
+from utility.utils import to_int
+from algo.off_policy.apex.codec import decode_experience, encode_weights
 
 
 def get_learner(BaseClass, *args, **kwargs):
-    @ray.remote(num_gpus=0.3, num_cpus=2)
+    # merges run in their own thread, so a merge waiting for the rate limiter 
+    # does not hold up weights and stats served to workers
+    @ray.remote(num_gpus=0.3, num_cpus=2, concurrency_groups={'insert': 1})
     class Learner(BaseClass):
         """ Interface """
         def __init__(self, 
@@ -39,18 +43,54 @@ def get_learner(BaseClass, *args, **kwargs):
                             log_stats=log_stats,
                             device=device)
             
+            # the replay is periodically saved to snapshot_dir and restored from it on restart
+            self.snapshot_dir = buffer_args['snapshot_dir'] if 'snapshot_dir' in buffer_args else None
+            self.snapshot_freq = to_int(buffer_args['snapshot_freq']) if 'snapshot_freq' in buffer_args else int(1e5)
+            self.snapshot_thread = None
+            if self.snapshot_dir and os.path.exists(os.path.join(self.snapshot_dir, 'meta.pkl')):
+                self.buffer.load_snapshot(self.snapshot_dir)
+
+            # weights are published to the object store every weight_publish_freq updates as (version, ref),
+            # so workers fetch them only when they change and the learner flattens them once for all workers
+            self.weight_publish_freq = args['weight_publish_freq'] if 'weight_publish_freq' in args else 100
+            # published copies may be quantized by weight_codec, the learner keeps training in float32
+            self.weight_codec = args['weight_codec'] if 'weight_codec' in args else None
+            self.weights = None
+            self.weights_locker = threading.Lock()
+            self._publish_weights()
+
             self.learning_thread = threading.Thread(target=self.background_learning, daemon=True)
             self.learning_thread.start()
             
         def get_weights(self):
             return self.variables.get_flat()
 
+        def get_weights_ref(self, version):
+            """ Return the latest version of weights and a list of its object refs, encoded by weight_codec
+            and unquantized, which is empty if the caller already has that version """
+            latest_version, ref, float_ref = self.weights
+
+            return latest_version, [] if latest_version == version else [ref, float_ref]
+
         def set_weights(self, weights):
             pwc('Learner: pull weights from the evaluator', 'blue')
             self.variables.set_flat(weights)
+            self._publish_weights()
 
+        @ray.method(concurrency_group='insert')
         def merge_buffer(self, local_buffer, length):
-            self.buffer.merge(local_buffer, length)
+            self.buffer.merge(decode_experience(local_buffer), length)
+
+        def shared_replay_spec(self):
+            """ Workers on this machine write to the shared replay with SharedReplayWriter """
+            return self.buffer.writer_spec()
+
+        def rate_limiter_stats(self):
+            rate_limiter = getattr(self.buffer, 'rate_limiter', None)
+            return None if rate_limiter is None else rate_limiter.stats()
+
+        def priority_update_stats(self):
+            return None if self.priority_updater is None else self.priority_updater.stats()
 
         def background_learning(self):
             while not self.buffer.good_to_learn:
@@ -61,6 +101,11 @@ def get_learner(BaseClass, *args, **kwargs):
             while True:
                 t += 1
                 self.learn(t)
+                if t % self.weight_publish_freq == 0:
+                    self._publish_weights()
+                if self.snapshot_dir and t % self.snapshot_freq == 0:
+                    if self.snapshot_thread is None or not self.snapshot_thread.is_alive():
+                        self.snapshot_thread = self.buffer.save_snapshot(self.snapshot_dir)
 
         def record_stats(self, kwargs):
             assert isinstance(kwargs, dict)
@@ -69,4 +114,17 @@ def get_learner(BaseClass, *args, **kwargs):
         def print_construction_complete(self):
             pwc('Learner has been constructed.', 'cyan')
 
+        """ Implementation """
+        def _publish_weights(self):
+            # weights are published by the learning thread and by set_weights
+            with self.weights_locker:
+                version = 0 if self.weights is None else self.weights[0] + 1
+                weights = self.variables.get_flat()
+                ref = ray.put(encode_weights(weights, self.weight_codec))
+                # workers act with quantized weights, but report the unquantized ones to the evaluator,
+                # whose best weights are set back to the learner
+                float_ref = ref if self.weight_codec is None else ray.put(weights)
+                # the refs are kept alive by self.weights until the next version replaces them
+                self.weights = (version, ref, float_ref)
+
     return Learner.remote(*args, **kwargs)
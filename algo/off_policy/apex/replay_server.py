@@ -0,0 +1,192 @@
+import os
+import threading
+from collections import deque
+import numpy as np
+import ray
+
+from utility.display import pwc
+from utility.utils import to_int
+from algo.off_policy.replay.utils import stack_samples
+from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+from algo.off_policy.replay.rank_replay import RankBasedPrioritizedReplay
+from algo.off_policy.replay.sharded_replay import ShardedReplay
+from algo.off_policy.apex.codec import decode_experience
+
+
+@ray.remote(concurrency_groups={'insert': 1, 'sample': 1})
+class ReplayServer:
+    """ Hold a shard of the replay in its own process. Workers merge local buffers into it
+    and the learner pulls sampled batches from it, so ingestion is off the learner's critical path.
+    Shapes of the replay come from the env, as for the learner's replay, since chunks store
+    unstacked frames and discrete actions without an action axis. Merges and pulls run in their own threads, so a rate limiter may block either of them """
+    """ Interface """
+    def __init__(self, server_no, buffer_args, state_shape, action_dim):
+        self.no = server_no
+        n_servers = buffer_args['n_servers']
+        self.batches_per_pull = buffer_args['batches_per_pull'] if 'batches_per_pull' in buffer_args else 4
+        self.buffer_args = dict(buffer_args,
+                                capacity=to_int(buffer_args['capacity']) // n_servers,
+                                min_size=to_int(buffer_args['min_size']) // n_servers)
+        self.snapshot_dir = (os.path.join(buffer_args['snapshot_dir'], f'server_{server_no}')
+                            if 'snapshot_dir' in buffer_args and buffer_args['snapshot_dir'] else None)
+        self.snapshot_thread = None
+        self.replay = self._build_replay(state_shape, action_dim)
+
+    def good_to_learn(self):
+        return self.replay.good_to_learn
+
+    def size(self):
+        return len(self.replay)
+
+    @ray.method(concurrency_group='insert')
+    def merge(self, local_buffer, length):
+        self.replay.merge(decode_experience(local_buffer), length)
+
+    @ray.method(concurrency_group='sample')
+    def sample(self):
+        """ Return batches_per_pull batches stacked along the first axis, and the stats of the replay """
+        return self.replay.sample_many(self.batches_per_pull), self.stats()
+
+    def stats(self):
+        """ Size and sampling stats, by which the learner picks servers and normalizes IS ratios across them """
+        total, min_weight = self.replay.sampling_stats()
+
+        return dict(size=len(self.replay), total=total, min=min_weight, beta=self.replay.beta)
+
+    def update_priorities(self, priorities, saved_mem_idxs):
+        self.replay.update_priorities(priorities, saved_mem_idxs)
+
+    def save_snapshot(self):
+        if self.snapshot_dir:
+            if self.snapshot_thread is None or not self.snapshot_thread.is_alive():
+                self.snapshot_thread = self.replay.save_snapshot(self.snapshot_dir)
+
+    def rate_limiter_stats(self):
+        return None if self.replay.rate_limiter is None else self.replay.rate_limiter.stats()
+
+    """ Implementation """
+    def _build_replay(self, state_shape, action_dim):
+        replay_type = self.buffer_args['type']
+        if replay_type == 'proportional':
+            replay = ProportionalPrioritizedReplay(self.buffer_args, state_shape, action_dim)
+        elif replay_type == 'rank':
+            replay = RankBasedPrioritizedReplay(self.buffer_args, state_shape, action_dim)
+        elif replay_type == 'sharded':
+            replay = ShardedReplay(self.buffer_args, state_shape, action_dim)
+        else:
+            raise NotImplementedError(f'Replay servers do not support {replay_type} replay')
+
+        if self.snapshot_dir and os.path.exists(os.path.join(self.snapshot_dir, 'meta.pkl')):
+            replay.load_snapshot(self.snapshot_dir)
+        pwc(f'Replay server {self.no} has been constructed.', 'cyan')
+
+        return replay
+
+
+def get_replay_servers(buffer_args, state_shape, action_dim):
+    n_servers = buffer_args['n_servers']
+    num_cpus = buffer_args['server_cpus'] if 'server_cpus' in buffer_args else 1
+
+    return [ReplayServer.options(num_cpus=num_cpus).remote(server_no, buffer_args, state_shape, action_dim)
+            for server_no in range(n_servers)]
+
+
+class RemoteReplay:
+    """ Learner-side proxy of replay servers. Pulls of sampled batches are kept in flight
+    and priorities are sent back every priority_update_freq updates, so neither blocks learning.
+    Servers are pulled in proportion to their total sampling weights, so rows are sampled as from one replay,
+    and IS ratios are renormalized by the minimum weight of all servers. Both come from the stats 
+    servers return with their pulls. Indexes are global: server_no * server_capacity + mem_idx """
+    """ Interface """
+    def __init__(self, args):
+        self.servers = args['replay_servers']
+        self.server_capacity = to_int(args['capacity']) // len(self.servers)
+        self.n_pulls_in_flight = args['n_pulls_in_flight'] if 'n_pulls_in_flight' in args else 2
+        self.priority_update_freq = args['priority_update_freq'] if 'priority_update_freq' in args else 10
+
+        self.pulls = deque()        # (server_no, object ref of batches and stats)
+        self.batches = deque()      # (server_no, batch)
+        self.server_stats = None    # stats of each server as of its last pull
+        self.is_good_to_learn = False
+        self.merge_i = 0
+
+        self.priorities = []
+        self.saved_mem_idxs = []
+        # locker guards priorities, which are updated by the learning thread
+        self.locker = threading.Lock()
+
+    @property
+    def good_to_learn(self):
+        # servers never shrink, so they are not asked again once all are good to learn
+        if not self.is_good_to_learn:
+            self.is_good_to_learn = all(ray.get([server.good_to_learn.remote() for server in self.servers]))
+        
+        return self.is_good_to_learn
+
+    def __len__(self):
+        """ Total size of servers as of their last pulls """
+        if self.server_stats is None:
+            self._fetch_stats()
+
+        return sum(stats['size'] for stats in self.server_stats)
+
+    def __call__(self):
+        while True:
+            yield self.sample()
+
+    def sample(self):
+        while not self.batches:
+            self._pull()
+            server_no, pull = self.pulls.popleft()
+            (IS_ratios, indexes, samples), stats = ray.get(pull)
+            self.server_stats[server_no] = stats
+            # servers normalize IS ratios by their own minimum weights, which are no less than the global one
+            min_weight = min(s['min'] for s in self.server_stats)
+            IS_ratios = IS_ratios * (min_weight / stats['min'])**stats['beta']
+            self.batches.extend((server_no, (IS_ratios[i], indexes[i], tuple(x[i] for x in samples)))
+                                for i in range(len(indexes)))
+        self._pull()
+        server_no, (IS_ratios, indexes, samples) = self.batches.popleft()
+
+        return IS_ratios, indexes + server_no * self.server_capacity, samples
+
+    def sample_many(self, k):
+        return stack_samples(self.sample, k)
+
+    def merge(self, local_buffer, length):
+        self.servers[self.merge_i % len(self.servers)].merge.remote(local_buffer, length)
+        self.merge_i += 1
+
+    def update_priorities(self, priorities, saved_mem_idxs):
+        with self.locker:
+            self.priorities.append(np.reshape(priorities, -1))
+            self.saved_mem_idxs.append(np.reshape(saved_mem_idxs, -1))
+            if len(self.priorities) < self.priority_update_freq:
+                return
+            priorities = np.concatenate(self.priorities)
+            saved_mem_idxs = np.concatenate(self.saved_mem_idxs)
+            self.priorities = []
+            self.saved_mem_idxs = []
+
+        server_nos = saved_mem_idxs // self.server_capacity
+        for server_no in np.unique(server_nos):
+            mask = server_nos == server_no
+            self.servers[server_no].update_priorities.remote(priorities[mask],
+                                                             saved_mem_idxs[mask] % self.server_capacity)
+
+    def save_snapshot(self, path=None, chunk_size=None):
+        """ Each server saves to its own directory under snapshot_dir in the background """
+        for server in self.servers:
+            server.save_snapshot.remote()
+
+    """ Implementation """
+    def _pull(self):
+        if self.server_stats is None:
+            self._fetch_stats()
+        while len(self.pulls) < self.n_pulls_in_flight:
+            totals = np.array([stats['total'] for stats in self.server_stats])
+            server_no = np.random.choice(len(self.servers), p=totals / np.sum(totals))
+            self.pulls.append((server_no, self.servers[server_no].sample.remote()))
+
+    def _fetch_stats(self):
+        self.server_stats = ray.get([server.stats.remote() for server in self.servers])
@@ -5,7 +5,11 @@ import numpy as np
 import ray
 
 from utility.display import pwc
+from utility.debug_tools import assert_colorize
 from utility.schedule import PiecewiseSchedule
+from algo.off_policy.apex.buffer import LocalBuffer
+from algo.off_policy.replay.shared_replay import SharedReplayWriter
+from algo.off_policy.apex.codec import encode_experience, decode_weights
 
 
 def get_worker(BaseClass, *args, **kwargs):
@@ -25,8 +29,19 @@ def get_worker(BaseClass, *args, **kwargs):
                     device=None):
             self.no = worker_no                             # use 0 worker to evaluate the model
             self.weight_update_freq = weight_update_freq    # update weights 
+            # workers write to a shared replay on this machine directly, bypassing ray
+            self.shared_replay = buffer_args['type'] == 'shared'
             buffer_args['type'] = 'local'
-            buffer_args['local_capacity'] = 1 if worker_no == 0 else env_args['max_episode_steps'] * weight_update_freq
+            # transitions are streamed in chunks of local_chunk_size, followed by n_steps rows of next states
+            # and, with frame stacking, preceded by frame context, see LocalBuffer
+            local_chunk_size = buffer_args['local_chunk_size'] if 'local_chunk_size' in buffer_args else 128
+            buffer_args['local_capacity'] = 1 if worker_no == 0 else local_chunk_size + args['n_steps']
+            # chunks sent through ray are encoded by experience_codec, see codec.py
+            self.experience_codec = buffer_args['experience_codec'] if 'experience_codec' in buffer_args else None
+            # workers step n_envs envs with one batched act, worker 0 evaluates on one env
+            if worker_no == 0:
+                env_args['n_envs'] = 1
+            self.n_envs = env_args['n_envs'] if 'n_envs' in env_args else 1
 
             super().__init__(name, 
                             args, 
@@ -35,9 +50,26 @@ def get_worker(BaseClass, *args, **kwargs):
                             sess_config=sess_config,
                             save=save,
                             device=device)
-
-        def compute_priorities(self):
-            state, action, reward, next_state, done, steps = self.buffer.sample()
+            self.weights_version = -1   # version of the learner's weights in use
+            # new weights are requested and fetched while acting with the current ones. 
+            # Workers only wait for them when the weights in use are more than max_policy_lag versions
+            # behind the newest version seen, and they are swapped in every weight_sync_steps steps
+            # of collection and after every weight_update_freq episodes
+            self.max_policy_lag = args['max_policy_lag'] if 'max_policy_lag' in args else 1
+            self.weight_sync_steps = args['weight_sync_steps'] if 'weight_sync_steps' in args else None
+            self.version_request = None         # object ref of (version, refs) asked from the learner
+            self.weights_fetch = None           # (version, object refs of weights) being fetched
+            # unquantized weights in use, sent to the evaluator, None before the first weights from the learner
+            self.float_weights_ref = None
+            self.latest_version = -1
+            self.policy_lag = 0
+            self.max_policy_lag_seen = 0
+            # each env accumulates n-step returns in its own local buffer
+            self.buffers = [self.buffer] + [LocalBuffer(buffer_args, self.state_shape, self.action_dim) 
+                                            for _ in range(self.n_envs - 1)]
+
+        def compute_priorities(self, buffer, start, end):
+            state, action, reward, next_state, done, steps = buffer.sample(start, end)
             return self.sess.run(self.priority, feed_dict={
                 self.data['state']: state,
                 self.data['action']: action,
@@ -47,14 +79,46 @@ def get_worker(BaseClass, *args, **kwargs):
                 self.data['steps']: steps
             })
 
-        def sample_data(self, learner, evaluator):
+        def sample_data(self, learner, evaluator, replay_servers=None):
             def collect_fn(state, action, reward, done):
-                self.buffer.add_data(state, action, reward, done)
-
-            def pull_weights_from_learner():
-                # pull weights from learner
-                weights = ray.get(learner.get_weights.remote())
-                self.variables.set_flat(weights)
+                add_data(self.buffer, state, action, reward, done)
+                count_steps(1)
+
+            def collect_vec_fn(states, actions, rewards, dones):
+                for buffer, state, action, reward, done in zip(self.buffers, states, actions, 
+                                                                rewards[:, 0], dones[:, 0]):
+                    add_data(buffer, state, action, reward, done)
+                count_steps(self.n_envs)
+
+            def add_data(buffer, state, action, reward, done):
+                buffer.add_data(state, action, reward, done)
+                if buffer.chunk_ready:
+                    push_chunk(buffer)
+
+            def count_steps(n):
+                self.n_collected += n
+                # weights are swapped whenever collection passes a multiple of weight_sync_steps
+                if self.weight_sync_steps and (self.n_collected // self.weight_sync_steps 
+                                               > (self.n_collected - n) // self.weight_sync_steps):
+                    self._pull_weights(learner)
+
+            def push_chunk(buffer):
+                nonlocal merge_ref
+                chunk, length = buffer.pop_chunk()
+                chunk['priority'][buffer.start: length - buffer.n_steps] = self.compute_priorities(
+                    buffer, buffer.start, length - buffer.n_steps)
+                # one merge is kept in flight, so workers wait when the replay's rate limiter blocks inserts
+                if merge_ref is not None:
+                    ray.get(merge_ref)
+                # only filled rows are sent, they are serialized or copied before the buffer is written again
+                if self.shared_replay:
+                    writer.merge(chunk, length)
+                elif replay_servers:
+                    replay_server = replay_servers[self.no % len(replay_servers)]
+                    merge_ref = replay_server.merge.remote(encode_experience(chunk, self.experience_codec), length)
+                else:
+                    merge_ref = learner.merge_buffer.remote(encode_experience(chunk, self.experience_codec), length)
+                buffer.carry_tail()
 
             to_record = self.no == 0
             scores = deque(maxlen=self.weight_update_freq)
@@ -62,54 +126,128 @@ def get_worker(BaseClass, *args, **kwargs):
             best_score_mean = -50
             episode_i = 0
             step = 0
+            merge_ref = None
+            self.n_collected = 0
+            if self.shared_replay:
+                spec = ray.get(learner.shared_replay_spec.remote())
+                # worker 0 only evaluates, the others write to shards from 0 on
+                assert_colorize(self.no - 1 < spec['n_shards'], 
+                                f'Each worker needs its own shard: {self.no - 1} vs. {spec["n_shards"]}')
+                writer = SharedReplayWriter(spec, self.no - 1) if self.no > 0 else None
             while True:
-                episode_i += 1
-                fn = None if to_record else collect_fn
-                score, epslen = self.run_trajectory(fn=fn, evaluation=to_record)
-                step += epslen
-                scores.append(score)
-                epslens.append(epslen)
-
-                if episode_i % self.weight_update_freq == 0:
-                    score_mean = np.mean(scores)
-                    if to_record:
-                        # record stats
-                        stats = dict(
-                            Timing='Eval',
-                            WorkerNo=self.no,
-                            Steps=episode_i,
-                            ScoreMean=score_mean, 
-                            ScoreStd=np.std(scores),
-                            ScoreMax=np.max(score), 
-                            EpslenMean=np.mean(epslens), 
-                            EpslenStd=np.std(epslens), 
-                        )
-                        tf_stats = dict(worker_no=f'worker_{self.no}')
-                        tf_stats.update(stats)
-
-                        learner.record_stats.remote(tf_stats)
+                if self.n_envs == 1:
+                    fn = None if to_record else collect_fn
+                    finished = [self.run_trajectory(fn=fn, evaluation=to_record)]
+                else:
+                    finished = zip(*self.run_vec_episodes(fn=collect_vec_fn))
+                for score, epslen in finished:
+                    episode_i += 1
+                    step += epslen
+                    scores.append(score)
+                    epslens.append(epslen)
+
+                    if episode_i % self.weight_update_freq == 0:
+                        score_mean = np.mean(scores)
+                        if to_record:
+                            # record stats
+                            stats = dict(
+                                Timing='Eval',
+                                WorkerNo=self.no,
+                                Steps=episode_i,
+                                ScoreMean=score_mean, 
+                                ScoreStd=np.std(scores),
+                                ScoreMax=np.max(score), 
+                                EpslenMean=np.mean(epslens), 
+                                EpslenStd=np.std(epslens), 
+                                PolicyLag=self.policy_lag,
+                                PolicyLagMax=self.max_policy_lag_seen,
+                            )
+                            tf_stats = dict(worker_no=f'worker_{self.no}')
+                            tf_stats.update(stats)
+
+                            learner.record_stats.remote(tf_stats)
                         
-                        learner.rl_log.remote(stats)
-
-                    if score_mean > min(250, best_score_mean):
-                        best_score_mean = score_mean
-                        pwc(f'Worker {self.no}: Best score updated to {best_score_mean:2f}', 'blue')
-                        evaluator.evaluate_model.remote(self.variables.get_flat(), score_mean)
-
-                    # send data to learner
-                    if self.buffer.idx == self.buffer.capacity:
-                        last_state = np.zeros_like(self.buffer['state'][0])
-                        self.buffer.add_last_state(last_state)
-                        self.buffer['priority'][:self.buffer.idx] = self.compute_priorities()
-                        # push samples to the central buffer after each episode
-                        learner.merge_buffer.remote(dict(self.buffer), self.buffer.idx)
-                        self.buffer.reset()
-
-                    # pull weights from learner
-                    weights = ray.get(learner.get_weights.remote())
-                    self.variables.set_flat(weights)
+                            learner.rl_log.remote(stats)
+
+                        if score_mean > min(250, best_score_mean):
+                            best_score_mean = score_mean
+                            pwc(f'Worker {self.no}: Best score updated to {best_score_mean:2f}', 'blue')
+                            # weights in use may be quantized by the learner's weight_codec
+                            evaluator.evaluate_model.remote(self.variables.get_flat() if self.float_weights_ref is None 
+                                                            else self.float_weights_ref, score_mean)
+
+                        self._pull_weights(learner)
 
         def print_construction_complete(self):
             pwc(f'Worker {self.no} has been constructed.', 'cyan')
 
+        """ Implementation """
+        def _pull_weights(self, learner):
+            """ Swap in the newest weights that have arrived and keep a request for newer ones in flight """
+            self._receive_version(block=False)
+            if self.latest_version - self.weights_version > self.max_policy_lag:
+                # too stale to keep acting, wait for the newest weights
+                self._receive_version(block=True)
+            if self.weights_fetch is not None:
+                version, ref, float_ref = self.weights_fetch
+                block = self.latest_version - self.weights_version > self.max_policy_lag
+                if block or ray.wait([ref], timeout=0)[0]:
+                    self.variables.set_flat(decode_weights(ray.get(ref)))
+                    self.weights_version = version
+                    self.float_weights_ref = float_ref
+                    self.weights_fetch = None
+            if self.version_request is None:
+                known_version = self.weights_fetch[0] if self.weights_fetch else self.weights_version
+                self.version_request = learner.get_weights_ref.remote(known_version)
+
+            self.policy_lag = self.latest_version - self.weights_version
+            if self.policy_lag > self.max_policy_lag_seen:
+                self.max_policy_lag_seen = self.policy_lag
+                pwc(f'Worker {self.no}: policy lag reached {self.policy_lag} versions', 'blue')
+
+        def _receive_version(self, block):
+            """ Receive the answer to the version request, if any, and start fetching newer weights """
+            if self.version_request is None or not (block or ray.wait([self.version_request], timeout=0)[0]):
+                return
+            version, refs = ray.get(self.version_request)
+            self.version_request = None
+            self.latest_version = max(self.latest_version, version)
+            if refs:
+                self.weights_fetch = (version, *refs)
+                # start moving the weights to this node without waiting for them
+                ray.wait(refs[:1], timeout=0, fetch_local=True)
+
     return Worker.remote(*args, **kwargs)
+
+
+if __name__ == '__main__':
+    # env steps per second of a worker on one cpu, acting on one env and on n_envs envs with batched acts.
+    # No results yet, n_envs stays 1 in the yamls until this shows batched acts pay off
+    from time import time
+    import tensorflow as tf
+    from utility.yaml_op import load_args
+    from algo.off_policy.sac.agent import Agent
+
+    duration = 60
+    args = load_args('algo/off_policy/apex/sac_args.yaml')
+    args['agent']['model_name'] = 'benchmark'
+    sess_config = tf.ConfigProto(intra_op_parallelism_threads=1,
+                                 inter_op_parallelism_threads=1,
+                                 allow_soft_placement=True)
+    for n_envs in [1, 4, 8, 16]:
+        agent = Agent(f'Agent{n_envs}', 
+                      dict(args['agent']), 
+                      dict(args['env'], n_envs=n_envs), 
+                      dict(args['buffer'], type='local', local_capacity=1),
+                      sess_config=sess_config, 
+                      device='/CPU:0')
+        n_steps = [0]
+        def count_fn(*transition, n_envs=n_envs):
+            n_steps[0] += n_envs
+        start = time()
+        while time() - start < duration:
+            if n_envs == 1:
+                agent.run_trajectory(fn=count_fn)
+            else:
+                agent.run_vec_episodes(fn=count_fn)
+        print(f'envs: {n_envs}\tsteps per second: {n_steps[0] / (time() - start):.0f}')
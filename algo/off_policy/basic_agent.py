@@ -12,8 +12,14 @@ from utility.debug_tools import assert_colorize
 from basic_model.model import Model
 from env.gym_env import create_gym_env
 from algo.off_policy.apex.buffer import LocalBuffer
+from algo.off_policy.replay.utils import build_schema
 from algo.off_policy.replay.uniform_replay import UniformReplay
 from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+from algo.off_policy.replay.rank_replay import RankBasedPrioritizedReplay
+from algo.off_policy.replay.sharded_replay import ShardedReplay
+from algo.off_policy.replay.shared_replay import SharedReplay
+from algo.off_policy.replay.priority_updater import PriorityUpdater
+from algo.off_policy.apex.replay_server import RemoteReplay
 
 
 class OffPolicyOperation(Model, ABC):
@@ -49,6 +55,8 @@ class OffPolicyOperation(Model, ABC):
         self.train_env = create_gym_env(env_args)
         self.state_shape = self.train_env.state_shape
         self.action_dim = self.train_env.action_dim
+        # states of the vectorized training env, kept between calls of run_vec_episodes
+        self.vec_states = None
 
         # replay buffer hyperparameters
         buffer_args['n_steps'] = args['n_steps']
@@ -57,16 +65,35 @@ class OffPolicyOperation(Model, ABC):
         self.buffer_type = buffer_args['type']
         if self.buffer_type == 'proportional':
             self.buffer = ProportionalPrioritizedReplay(buffer_args, self.state_shape, self.action_dim)
+        elif self.buffer_type == 'rank':
+            self.buffer = RankBasedPrioritizedReplay(buffer_args, self.state_shape, self.action_dim)
+        elif self.buffer_type == 'sharded':
+            self.buffer = ShardedReplay(buffer_args, self.state_shape, self.action_dim)
+        elif self.buffer_type == 'shared':
+            self.buffer = SharedReplay(buffer_args, self.state_shape, self.action_dim)
+        elif self.buffer_type == 'remote':
+            self.buffer = RemoteReplay(buffer_args)
         elif self.buffer_type == 'uniform':
             self.buffer = UniformReplay(buffer_args, self.state_shape, self.action_dim)
         elif self.buffer_type == 'local':
             self.buffer = LocalBuffer(buffer_args, self.state_shape, self.action_dim)
         else:
             raise NotImplementedError('No buffer is constructed')
+        # priorities are sent back to prioritized buffers after each learning step
+        self.prioritized = self.buffer_type in ['proportional', 'rank', 'sharded', 'shared', 'remote']
+        # priorities are applied by a background thread at most max_priority_staleness learning steps late,
+        # 0 applies them in the learning step
+        max_priority_staleness = buffer_args['max_priority_staleness'] if 'max_priority_staleness' in buffer_args else 0
+        self.priority_updater = (PriorityUpdater(self.buffer, max_priority_staleness) 
+                                 if self.prioritized and max_priority_staleness else None)
         
         # arguments for prioritized replay
         self.prio_alpha = float(buffer_args['alpha'])
         self.prio_epsilon = float(buffer_args['epsilon'])
+        # samples are emitted in storage dtypes and decoded in the graph
+        self.buffer_schema = build_schema(buffer_args['schema'] if 'schema' in buffer_args else None, self.action_dim)
+        # number of batches sampled per generator step, amortizing the python overhead of tf.data
+        self.batches_per_sample = buffer_args['batches_per_sample'] if 'batches_per_sample' in buffer_args else 4
 
         super().__init__(name, args, 
                          sess_config=sess_config, 
@@ -92,6 +119,10 @@ class OffPolicyOperation(Model, ABC):
 
     def add_data(self, state, action_repr, reward, done):
         self.buffer.add(state, action_repr, reward, done)
+
+    def add_data_batch(self, states, actions, rewards, dones):
+        """ Add a transition from each env of a vectorized environment """
+        self.buffer.add_batch(states, actions, rewards, dones)
         
     def merge_buffer(self, buffer, length):
         self.buffer.merge(buffer, length)
@@ -123,10 +154,38 @@ class OffPolicyOperation(Model, ABC):
         
         return env.get_score(), env.get_epslen()
 
+    def run_vec_episodes(self, fn=None):
+        """ Step all envs of the vectorized training env with one act on their stacked states
+        until some episodes finish, fn is a function executed on the batch of transitions after each step.
+        Finished envs are reset in place while the others run on, and the next call resumes from there.
+        Return the scores and lengths of the finished episodes """
+        env = self.train_env
+        if self.vec_states is None:
+            self.vec_states = env.reset()
+        scores, epslens = [], []
+
+        while not scores:
+            action = np.reshape(self.act(self.vec_states), (env.n_envs, *env.action_shape))
+            for _ in range(self.max_action_repetitions):
+                next_state, reward, done, _ = env.step(action)
+                if fn:
+                    fn(self.vec_states, action, reward, done)
+                done_ids = np.flatnonzero(done)
+                for i in done_ids:
+                    scores.append(env.envs[i].get_score())
+                    epslens.append(env.envs[i].get_epslen())
+                    next_state[i] = env.envs[i].reset()
+                self.vec_states = next_state
+                if len(done_ids):
+                    # actions are not repeated into new episodes
+                    break
+
+        return scores, epslens
+
     def learn(self, t=None):
         feed_dict = self._get_feeddict(t) if self.schedule_lr else None
     
-        fetches = [self.priority, self.data['saved_mem_idxs']] if self.buffer_type == 'proportional' else []
+        fetches = [self.priority, self.data['saved_mem_idxs']] if self.prioritized else []
         
         if self.log_tensorboard:
             results, _, summary = self.sess.run([fetches, self.opt_op, self.graph_summary], feed_dict=feed_dict)
@@ -139,9 +198,12 @@ class OffPolicyOperation(Model, ABC):
         self._update_target_net()
 
         self.update_step += 1
-        if self.buffer_type == 'proportional':
+        if self.prioritized:
             priority, saved_mem_idxs = results
-            self.buffer.update_priorities(priority, saved_mem_idxs)
+            if self.priority_updater:
+                self.priority_updater.update_priorities(priority, saved_mem_idxs)
+            else:
+                self.buffer.update_priorities(priority, saved_mem_idxs)
     
     def rl_log(self, kwargs):
         assert isinstance(kwargs, dict)
@@ -165,7 +227,8 @@ class OffPolicyOperation(Model, ABC):
 
     def _prepare_data(self, buffer):
         with tf.name_scope('data'):
-            sample_types = (tf.float32, tf.float32, tf.float32, tf.float32, tf.float32, tf.float32)
+            dtype = lambda name: tf.as_dtype(self.buffer_schema[name]['dtype'])
+            sample_types = (dtype('state'), dtype('action'), dtype('reward'), dtype('state'), tf.bool, tf.uint8)
             sample_shapes = (
                 (None, *self.state_shape),
                 (None, self.action_dim),
@@ -174,11 +237,24 @@ class OffPolicyOperation(Model, ABC):
                 (None, 1),
                 (None, 1)
             )
+            if hasattr(buffer, 'sample_many'):
+                # batches are sampled batches_per_sample at a time and split again in tf
+                def generator():
+                    while True:
+                        yield buffer.sample_many(self.batches_per_sample)
+                sample_shapes = tuple((None, *shape) for shape in sample_shapes)
+                info_shape = (None, None)
+            else:
+                generator = buffer
+                info_shape = (None)
             if self.buffer_type != 'uniform':
                 sample_types = (tf.float32, tf.int32, sample_types)
-                sample_shapes =((None), (None), sample_shapes)
+                sample_shapes = (info_shape, info_shape, sample_shapes)
 
-            ds = tf.data.Dataset.from_generator(buffer, sample_types, sample_shapes)
+            ds = tf.data.Dataset.from_generator(generator, sample_types, sample_shapes)
+            if hasattr(buffer, 'sample_many'):
+                # unbatch copies every batch, so prefetched batches never alias replay memory
+                ds = ds.apply(tf.data.experimental.unbatch())
             ds = ds.prefetch(tf.data.experimental.AUTOTUNE)
             iterator = ds.make_one_shot_iterator()
             samples = iterator.get_next(name='samples')
@@ -194,15 +270,24 @@ class OffPolicyOperation(Model, ABC):
             state, action, reward, next_state, done, steps = samples
             data['IS_ratio'] = 1                                # fake ratio to avoid complicate the code
 
-        data['state'] = state
-        data['action'] = action
-        data['reward'] = reward
-        data['next_state'] = next_state
-        data['done'] = done
-        data['steps'] = steps
+        data['state'] = self._decode('state', state)
+        data['action'] = self._decode('action', action)
+        data['reward'] = self._decode('reward', reward)
+        data['next_state'] = self._decode('state', next_state)
+        data['done'] = tf.cast(done, tf.float32)
+        data['steps'] = tf.cast(steps, tf.float32)
 
         return data
 
+    def _decode(self, name, x):
+        """ Decode samples of field name to float32 as described by the buffer schema """
+        with tf.name_scope(f'decode_{name}'):
+            x = tf.cast(x, tf.float32)
+            if self.buffer_schema[name]['scale'] is not None:
+                x = x * self.buffer_schema[name]['scale'] + self.buffer_schema[name]['offset']
+
+        return x
+
     def _compute_priority(self, priority):
         with tf.name_scope('priority'):
             priority += self.prio_epsilon
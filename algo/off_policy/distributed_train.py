@@ -8,10 +8,14 @@ import tensorflow as tf
 import ray
 
 from utility.tf_utils import get_sess_config
+from utility.display import pwc
+from utility.utils import to_int
 from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
 from algo.off_policy.apex.worker import get_worker
 from algo.off_policy.apex.learner import get_learner
+from algo.off_policy.apex.replay_server import get_replay_servers
 from algo.off_policy.apex.evaluator import get_evaluator
+from env.gym_env import create_gym_env
 
 
 def main(env_args, agent_args, buffer_args, render=False):
@@ -32,9 +36,27 @@ def main(env_args, agent_args, buffer_args, render=False):
 
     ray.init()
 
+    if buffer_args['type'] == 'shared':
+        # each worker but the evaluating worker 0 writes to its own shard
+        buffer_args['n_shards'] = n_workers - 1
+        buffer_args['capacity'] = to_int(buffer_args['capacity']) // (n_workers - 1) * (n_workers - 1)
+
+    if 'n_servers' in buffer_args and buffer_args['n_servers']:
+        # the replay lives in standalone servers, the learner only pulls batches from them
+        buffer_args['n_steps'] = agent_args['n_steps']
+        buffer_args['gamma'] = agent_args['gamma']
+        buffer_args['batch_size'] = agent_args['batch_size']
+        # replay servers are shaped by the env, as the learner's replay is
+        env = create_gym_env(dict(env_args, n_envs=1, log_video=False))
+        replay_servers = get_replay_servers(buffer_args, env.state_shape, env.action_dim)
+        learner_buffer_args = dict(buffer_args, type='remote', replay_servers=replay_servers)
+    else:
+        replay_servers = None
+        learner_buffer_args = buffer_args
+
     agent_name = 'Agent'
     sess_config = get_sess_config(2)
-    learner = get_learner(Agent, agent_name, agent_args, env_args, buffer_args, 
+    learner = get_learner(Agent, agent_name, agent_args, env_args, learner_buffer_args, 
                             log=True, log_tensorboard=True, log_stats=True, 
                             sess_config=sess_config, device='/GPU: 0')
     env_args['seed'] = 0
@@ -65,10 +87,22 @@ def main(env_args, agent_args, buffer_args, render=False):
                             weight_update_freq, sess_config=sess_config, device=f'/CPU:0')
         workers.append(worker)
 
-    pids = [worker.sample_data.remote(learner, evaluator) for worker in workers]
+    pids = [worker.sample_data.remote(learner, evaluator, replay_servers) for worker in workers]
 
     while True:
         time.sleep(600)
         weights = evaluator.get_best_model.remote()
         ray.get(learner.set_weights.remote(weights))
+        # seconds inserts and samples have waited for the rate limiter
+        if replay_servers:
+            limiter_stats = ray.get([server.rate_limiter_stats.remote() for server in replay_servers])
+        else:
+            limiter_stats = [ray.get(learner.rate_limiter_stats.remote())]
+        for i, stats in enumerate(limiter_stats):
+            if stats:
+                pwc(f'Rate limiter {i}: ' + '\t'.join(f'{k}: {v:.4g}' for k, v in stats.items()), 'blue')
+        # learning steps priorities lag behind when applied in the background
+        priority_stats = ray.get(learner.priority_update_stats.remote())
+        if priority_stats:
+            pwc('Priority updates: ' + '\t'.join(f'{k}: {v:.4g}' for k, v in priority_stats.items()), 'blue')
 
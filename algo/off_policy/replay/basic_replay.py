@@ -1,4 +1,7 @@
 from abc import ABC
+import os
+import shutil
+import pickle
 import threading
 import numpy as np
 
@@ -6,7 +9,10 @@ from utility.debug_tools import assert_colorize
 from utility.display import pwc
 from utility.utils import to_int
 from utility.run_avg import RunningMeanStd
-from algo.off_policy.replay.utils import add_buffer, copy_buffer
+from algo.off_policy.replay.utils import (build_schema, encode, init_buffer, add_buffer, copy_buffer, 
+                                          stack_samples, frame_offsets, gather_frames)
+from algo.off_policy.replay.rate_limiter import RateLimiter
+from algo.off_policy.replay.episode_index import EpisodeIndex
 
 class Replay(ABC):
     """ Interface """
@@ -23,14 +29,70 @@ class Replay(ABC):
         if self.normalize_reward:
             self.running_reward_stats = RunningMeanStd()
 
+        # storage dtypes and quantization of fields
+        self.schema = build_schema(args['schema'] if 'schema' in args else None, action_dim)
+        self.state_shape = state_shape
+        self.frame_stack = self.schema['state']['frame_stack']
+        self.episode_step = 0   # steps since the episode start, only used by single agent
+        # storage backend of memory, ram or memmap
+        self.storage = args['storage'] if 'storage' in args else 'ram'
+        self.storage_dir = args['storage_dir'] if 'storage_dir' in args else None
+
         self.n_steps = args['n_steps']
         self.gamma = args['gamma']
+        # store 1-step transitions and compute n-step returns for sampled indexes only,
+        # so n_steps and gamma can be changed without refilling the buffer
+        self.lazy_n_steps = args['lazy_n_steps'] if 'lazy_n_steps' in args else False
+        # the newest rows, whose n-step windows are not fully written yet, are held back from sampling.
+        # held holds what subclasses need to release them, aligned with open_rows
+        self.open_rows = np.zeros(0, dtype=np.int64)
+        self.held = np.zeros(0)
+        # single agent transitions wait in a temporary buffer until their n-step returns are complete
+        self.has_tb = self.n_steps > 1 and not self.lazy_n_steps
+        # transitions from vectorized environments complete their n-step returns in per-env temporary buffers
+        self.vec_tb_capacity = args['tb_capacity'] if 'tb_capacity' in args else 100
+        self.vec_tb = None
         
         self.is_full = False
         self.mem_idx = 0
+
+        # which rows merges overwrite: fifo, reservoir, lowest_priority or top_k_return.
+        # Policies other than fifo place merges by the episode index and never wrap around, 
+        # mem_idx is then the end of rows written so far
+        self.eviction = args['eviction'] if 'eviction' in args else 'fifo'
+        assert_colorize(self.eviction in ['fifo', 'reservoir', 'lowest_priority', 'top_k_return'], 
+                        f'Unknown eviction policy: {self.eviction}')
+        if self.eviction != 'fifo':
+            assert_colorize(not self.lazy_n_steps and self.frame_stack == 1, 
+                            f'{self.eviction} eviction does not support lazy n-step returns or frame stacking')
+        self.top_k = args['top_k'] if 'top_k' in args else 100      # episodes kept by top_k_return
+        self.n_rejected = 0     # merges the eviction policy decided not to insert
+        # start, length and return of stored episodes, used by eviction and sequence sampling
+        self.episodes = (EpisodeIndex() if self.eviction != 'fifo' or ('episode_index' in args and args['episode_index']) 
+                         else None)
+
+        # sampled batches are written into a ring of preallocated slots instead of new arrays.
+        # Consumers such as tf.data may keep references to a returned batch for a while, 
+        # so the ring should hold more slots than batches in flight
+        self.n_sample_slots = args['n_sample_slots'] if 'n_sample_slots' in args else 5
+        self.sample_slots = []
+        self.slot_i = 0
         
         # locker used to avoid conflict introduced by tf.data.Dataset and multi-agent
         self.locker = threading.Lock()
+        # rows to be copied by the snapshot being saved, None if no snapshot is saved
+        self.snapshot_dirty = None
+
+        # keep the ratio of sampled to inserted transitions in a band, e.g.,
+        # rate_limiter: {samples_per_insert: 8, error_buffer: 2560, timeout: null}
+        self.rate_limiter = None
+        if 'rate_limiter' in args and args['rate_limiter']:
+            limiter_args = args['rate_limiter']
+            self.rate_limiter = RateLimiter(
+                float(limiter_args['samples_per_insert']),
+                float(limiter_args['error_buffer']) if 'error_buffer' in limiter_args else 10. * self.batch_size,
+                self.min_size,
+                timeout=limiter_args['timeout'] if 'timeout' in limiter_args else None)
 
     @property
     def good_to_learn(self):
@@ -47,15 +109,48 @@ class Replay(ABC):
         assert_colorize(self.good_to_learn, 'There are not sufficient transitions to start learning --- '
                                             f'transitions in buffer: {len(self)}\t'
                                             f'minimum required size: {self.min_size}')
+        if self.rate_limiter:
+            self.rate_limiter.await_sample(self.batch_size)
+        with self.locker:
+            samples = self._sample_batch()
+
+        return samples
+
+    def sample_many(self, k):
+        """ Sample k batches under one lock acquisition, stacked along a new leading axis.
+        The i-th batch is what the i-th of k consecutive calls of self.sample would return """
+        assert_colorize(self.good_to_learn, 'There are not sufficient transitions to start learning --- '
+                                            f'transitions in buffer: {len(self)}\t'
+                                            f'minimum required size: {self.min_size}')
+        if self.rate_limiter:
+            self.rate_limiter.await_sample(k * self.batch_size)
         with self.locker:
-            samples = self._sample()
+            samples = stack_samples(self._sample_batch, k)
 
         return samples
 
+    def sample_sequences(self, seq_len):
+        """ Sample batch_size sequences of seq_len contiguous transitions inside episodes,
+        uniformly over all such sequences. Return the rows of shape [batch_size, seq_len] 
+        and a dict of the fields of memory gathered at them """
+        assert_colorize(self.episodes is not None, 'Sequence sampling requires the episode index')
+        if self.rate_limiter:
+            self.rate_limiter.await_sample(self.batch_size * seq_len)
+        with self.locker:
+            rows = self.episodes.sample_sequences(self.batch_size, seq_len)
+            sequences = {k: np.take(v, rows, axis=0) for k, v in self.memory.items() if k != 'priority'}
+
+        return rows, sequences
+
     def merge(self, local_buffer, length):
         """ Merge a local buffer to the replay buffer, useful for distributed algorithms """
         assert_colorize(length < self.capacity, 
                     f'Local buffer cannot be largeer than the replay: {length} vs. {self.capacity}')
+        if self.lazy_n_steps:
+            assert_colorize(np.all(local_buffer['steps'][:length] == 1), 
+                            'Lazy n-step replay expects 1-step transitions')
+        if self.rate_limiter:
+            self.rate_limiter.await_insert(length)
         with self.locker:
             self._merge(local_buffer, length)
 
@@ -63,13 +158,35 @@ class Replay(ABC):
         """ Add a single transition to the replay buffer """
         raise NotImplementedError
 
+    def add_batch(self):
+        """ Add a transition from each of n_envs vectorized environments """
+        raise NotImplementedError
+
+    def save_snapshot(self, path, chunk_size=int(1e5)):
+        """ Save the buffer to directory path in a background thread, return the thread.
+        Arrays are copied chunk by chunk and the lock is only held while copying a chunk,
+        so training continues. Rows changed meanwhile are copied again, the snapshot holds 
+        the buffer as it is when the last chunk is copied """
+        thread = threading.Thread(target=self._save_snapshot, args=(path, chunk_size), daemon=True)
+        thread.start()
+
+        return thread
+
+    def load_snapshot(self, path, chunk_size=int(1e5)):
+        """ Restore the buffer from a snapshot saved by save_snapshot """
+        with open(os.path.join(path, 'meta.pkl'), 'rb') as f:
+            meta = pickle.load(f)
+        with self.locker:
+            self._load_snapshot(path, meta, chunk_size)
+        pwc(f'Replay: {len(self)} transitions are restored from {path}', 'green')
+
     """ Implementation """
     def _add(self, state, action, reward, done):
         """ add is only used for single agent, no multiple adds are expected to run at the same time
             but it may fight for resource with self.sample if background learning is enabled """
-        if self.n_steps > 1:
+        if self.has_tb:
             add_buffer(self.tb, self.tb_idx, state, action, reward, 
-                        done, self.n_steps, self.gamma)
+                        done, self.n_steps, self.gamma, schema=self.schema, episode_step=self.episode_step)
             
             if not self.tb_full and self.tb_idx == self.tb_capacity - 1:
                 self.tb_full = True
@@ -91,59 +208,443 @@ class Replay(ABC):
                 self.tb_idx = n_not_ready
                 self.tb_full = False
         else:
+            if self.rate_limiter:
+                self.rate_limiter.await_insert(1)
+            assert_colorize(self.eviction == 'fifo', f'{self.eviction} eviction only supports merge')
             with self.locker:
+                if self.episodes is not None:
+                    self._remove_episodes(self.mem_idx, self.mem_idx + 1)
                 add_buffer(self.memory, self.mem_idx, state, action, reward,
-                            done, self.n_steps, self.gamma)
+                            done, 1, self.gamma, schema=self.schema, episode_step=self.episode_step)
+                self._mark_dirty(self.mem_idx)
+                if self.episodes is not None:
+                    priority = self._row_priorities(self.mem_idx, self.mem_idx + 1)
+                    self.episodes.append_row(self.mem_idx, float(reward), bool(done), 
+                                             0. if priority is None else float(priority[0]))
+                if not self.is_full and self.mem_idx == self.capacity - 1:
+                    self.is_full = True
                 self.mem_idx = (self.mem_idx + 1) % self.capacity
+                if self.lazy_n_steps:
+                    self._update_open_rows()
+        self.episode_step = 0 if done else self.episode_step + 1
+
+    def _add_batch(self, states, actions, rewards, dones, priority=None):
+        """ Each env completes the n-step returns of its transitions in its own tb_capacity rows of self.vec_tb,
+        as a LocalBuffer does for a worker. The rows of an env are merged when its episode is done or its rows 
+        are full. In the latter case the last n_steps rows go along with zero priority as next states
+        and stay as the first rows of the env, where their returns are completed, 
+        together with frame_stack - 1 rows of frame context. Envs merged at the same step are merged together """
+        n_envs = len(states)
+        if self.vec_tb is None:
+            self._init_vec_tb(n_envs)
+        rewards = np.reshape(rewards, -1)
+        dones = np.reshape(dones, -1)
+
+        rows = self.vec_tb_starts + self.vec_tb_idx
+        self.vec_tb['state'][rows] = encode(self.schema, 'state', states)
+        self.vec_tb['action'][rows] = np.reshape(encode(self.schema, 'action', actions), 
+                                                 self.vec_tb['action'][rows].shape)
+        self.vec_tb['reward'][rows, 0] = rewards
+        self.vec_tb['done'][rows, 0] = dones
+        self.vec_tb['steps'][rows] = 1
+        if 'since_start' in self.vec_tb:
+            # frames before the rows of an env are not merged, so the episode is cut there
+            self.vec_tb['since_start'][rows, 0] = np.minimum(np.minimum(self.vec_episode_step, self.vec_tb_idx), 255)
+        self.vec_tb['priority'][rows] = 1. if priority is None else priority
+        if not self.lazy_n_steps:
+            # update the n-step returns of previous transitions of each env, as add_buffer does
+            extend = np.ones(n_envs, dtype=bool)
+            for i in range(1, self.n_steps):
+                prev_rows = rows - i
+                extend &= (self.vec_tb_idx >= i) & np.logical_not(self.vec_tb['done'][prev_rows, 0])
+                prev_rows = prev_rows[extend]
+                self.vec_tb['reward'][prev_rows, 0] += self.gamma**i * rewards[extend]
+                self.vec_tb['done'][prev_rows, 0] = dones[extend]
+                self.vec_tb['steps'][prev_rows, 0] += 1
+        self.vec_tb_idx += 1
+        self.vec_episode_step = np.where(dones, 0, self.vec_episode_step + 1)
+
+        full = self.vec_tb_idx == self.vec_tb_capacity
+        env_ids = np.nonzero(dones | full)[0]
+        if len(env_ids):
+            self._merge_vec_tb(env_ids, dones[env_ids])
+
+    def _init_vec_tb(self, n_envs):
+        n_context = self.frame_stack - 1
+        assert_colorize(self.vec_tb_capacity > n_context + self.n_steps, 
+                        f'tb_capacity must be larger than frame_stack - 1 + n_steps: {self.vec_tb_capacity}')
+        self.vec_tb = {}
+        init_buffer(self.vec_tb, n_envs * self.vec_tb_capacity, self.state_shape, 
+                    1 if self.memory['action'].ndim == 1 else self.memory['action'].shape[1], 
+                    True, schema=self.schema)
+        self.vec_tb_starts = np.arange(n_envs) * self.vec_tb_capacity
+        self.vec_tb_idx = np.zeros(n_envs, dtype=np.int64)
+        self.vec_tb_context = np.zeros(n_envs, dtype=np.int64)    # rows of frame context at the front
+        self.vec_episode_step = np.zeros(n_envs, dtype=np.int64)
+
+    def _merge_vec_tb(self, env_ids, dones):
+        """ Merge the rows of env_ids in one go, their frame context and, for envs whose episodes 
+        are not done, their last n_steps rows with zero priority. Then carry these rows over """
+        lengths = self.vec_tb_idx[env_ids]
+        rows = np.concatenate([np.arange(start, start + length) 
+                               for start, length in zip(self.vec_tb_starts[env_ids], lengths)])
+        chunk = {k: v[rows] for k, v in self.vec_tb.items()}
+        offsets = np.cumsum(lengths) - lengths
+        for offset, length, n_context, done in zip(offsets, lengths, self.vec_tb_context[env_ids], dones):
+            chunk['priority'][offset: offset + n_context] = 0
+            if not done:
+                chunk['priority'][offset + length - self.n_steps: offset + length] = 0
+        
+        self.merge(chunk, len(rows))
+        
+        n_context = self.frame_stack - 1
+        n_carried = n_context + self.n_steps
+        for env_id, length, done in zip(env_ids, lengths, dones):
+            if done:
+                self.vec_tb_idx[env_id] = 0
+                self.vec_tb_context[env_id] = 0
+                continue
+            start = self.vec_tb_starts[env_id]
+            copy_buffer(self.vec_tb, start, start + n_carried, self.vec_tb, start + length - n_carried, start + length)
+            if 'since_start' in self.vec_tb:
+                np.minimum(self.vec_tb['since_start'][start: start + n_carried, 0], 
+                           np.arange(n_carried, dtype=np.uint8), 
+                           out=self.vec_tb['since_start'][start: start + n_carried, 0])
+            self.vec_tb_idx[env_id] = n_carried
+            self.vec_tb_context[env_id] = n_context
 
     def _sample(self):
         raise NotImplementedError
 
+    def _sample_batch(self):
+        """ Sample a batch and update the sampling statistics, called with self.locker held """
+        return self._sample()
+
+    def _snapshot_arrays(self):
+        """ Arrays to save in a snapshot, only the first len(self) rows are saved """
+        return dict(self.memory)
+
+    def _snapshot_meta(self):
+        meta = dict(mem_idx=self.mem_idx, is_full=self.is_full, length=len(self), episodes=self.episodes,
+                    open_rows=self.open_rows, held=self.held)
+        if self.normalize_reward:
+            meta['running_reward_stats'] = self.running_reward_stats
+
+        return meta
+
+    def _save_snapshot(self, path, chunk_size):
+        """ Copy dirty rows chunk by chunk into path.tmp, at first all rows. Rows changed meanwhile 
+        are marked dirty again, and the last chunk is copied together with meta under the same lock, 
+        so arrays and meta describe the same buffer. path.tmp then replaces path """
+        path = os.fspath(path)
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        with self.locker:
+            self.snapshot_dirty = np.zeros(self.capacity, dtype=bool)
+            self.snapshot_dirty[:len(self)] = True
+        try:
+            arrays = self._snapshot_arrays()
+            # files have room for all rows as the buffer may grow while saved, 
+            # rows never copied take no disk space on most file systems
+            outs = {name: np.lib.format.open_memmap(os.path.join(tmp_path, f'{name}.npy'), mode='w+', 
+                                                    dtype=array.dtype, shape=array.shape)
+                    for name, array in arrays.items()}
+            done = False
+            while not done:
+                with self.locker:
+                    rows = np.flatnonzero(self.snapshot_dirty)[:chunk_size]
+                    self.snapshot_dirty[rows] = False
+                    chunks = {name: np.take(array, rows, axis=0) for name, array in arrays.items()}
+                    done = not np.any(self.snapshot_dirty)
+                    if done:
+                        meta = pickle.dumps(self._snapshot_meta())
+                        self.snapshot_dirty = None
+                for name, chunk in chunks.items():
+                    outs[name][rows] = chunk
+            for out in outs.values():
+                out.flush()
+            del outs
+        finally:
+            self.snapshot_dirty = None
+        
+        # meta is written last so that an incomplete snapshot is never loaded
+        with open(os.path.join(tmp_path, 'meta.pkl'), 'wb') as f:
+            f.write(meta)
+        # the previous snapshot stays intact until the new one is complete
+        old_path = path + '.old'
+        if os.path.exists(path):
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def _mark_dirty(self, rows):
+        """ Mark rows changed while a snapshot is saved, to be copied again """
+        if self.snapshot_dirty is not None:
+            self.snapshot_dirty[rows] = True
+
+    def _load_snapshot(self, path, meta, chunk_size):
+        length = meta['length']
+        assert_colorize(length <= self.capacity, 
+                        f'Snapshot is larger than the replay: {length} vs. {self.capacity}')
+        for name, array in self._snapshot_arrays().items():
+            saved = np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+            for start in range(0, length, chunk_size):
+                end = min(start + chunk_size, length)
+                array[start: end] = saved[start: end]
+            del saved
+
+        self.mem_idx = meta['mem_idx']
+        self.is_full = meta['is_full']
+        self.open_rows = meta['open_rows']
+        self.held = meta['held']
+        if self.episodes is not None:
+            self.episodes = meta['episodes'] or EpisodeIndex()
+        if self.normalize_reward:
+            self.running_reward_stats = meta['running_reward_stats']
+
     def _merge(self, local_buffer, length):
-        end_idx = self.mem_idx + length
+        start_idx, key = self._evict(local_buffer, length)
+        if start_idx is None:
+            self.n_rejected += 1
+            return
+        end_idx = start_idx + length
 
-        if end_idx > self.capacity:
-            first_part = self.capacity - self.mem_idx
-            second_part = length - first_part
-            
-            copy_buffer(self.memory, self.mem_idx, self.capacity, local_buffer, 0, first_part)
-            copy_buffer(self.memory, 0, second_part, local_buffer, first_part, length)
-        else:
-            copy_buffer(self.memory, self.mem_idx, end_idx, local_buffer, 0, length)
+        self._write(start_idx, local_buffer, length)
+        if self.episodes is not None:
+            self._index_episodes(start_idx, length, key)
             
         if self.normalize_reward:
             # compute running reward statistics
-            self.running_reward_stats.update(local_buffer['reward'][:length])
+            self.running_reward_stats.update(local_buffer['reward'][:length].astype(np.float64))
 
         # memory is full, recycle buffer via FIFO
         if not self.is_full and end_idx >= self.capacity:
             pwc('Memory is full', 'green')
             self.is_full = True
         
-        self.mem_idx = end_idx % self.capacity
+        self.mem_idx = end_idx % self.capacity if self.eviction == 'fifo' else max(self.mem_idx, end_idx)
+        if self.lazy_n_steps:
+            self._update_open_rows()
+
+    def _update_open_rows(self):
+        """ Hold back the rows whose n-step windows reach past the write head, 
+        and release those completed by the transitions written since. 
+        The next state of a non-terminal window is the state of the row after it """
+        n = min(self.n_steps, len(self))
+        rows = (self.mem_idx - 1 - np.arange(n)) % self.capacity      # newest first
+        # the window of a row ends at the first done from it on
+        done = self.memory['done'][rows, 0]
+        open_rows = rows[: np.argmax(done) if np.any(done) else n]
+
+        still_open = np.isin(self.open_rows, open_rows)
+        if not np.all(still_open):
+            self._release_rows(self.open_rows[~still_open], self.held[~still_open])
+            self.open_rows, self.held = self.open_rows[still_open], self.held[still_open]
+        new_rows = open_rows[~np.isin(open_rows, self.open_rows)]
+        if len(new_rows):
+            self.held = np.concatenate([self.held, self._hold_rows(new_rows)])
+            self.open_rows = np.concatenate([self.open_rows, new_rows])
+
+    def _hold_rows(self, rows):
+        """ Keep rows from being sampled, return what _release_rows needs to undo it """
+        raise NotImplementedError
+
+    def _release_rows(self, rows, held):
+        raise NotImplementedError
+
+    def _write(self, start_idx, local_buffer, length):
+        """ Copy the first length transitions of local_buffer to memory from start_idx on, wrapping around """
+        self._mark_dirty(np.arange(start_idx, start_idx + length) % self.capacity)
+        end_idx = start_idx + length
+        if end_idx > self.capacity:
+            first_part = self.capacity - start_idx
+            
+            copy_buffer(self.memory, start_idx, self.capacity, local_buffer, 0, first_part)
+            copy_buffer(self.memory, 0, length - first_part, local_buffer, first_part, length)
+        else:
+            copy_buffer(self.memory, start_idx, end_idx, local_buffer, 0, length)
+
+    def _evict(self, local_buffer, length):
+        """ Choose where local_buffer is written and drop the episodes it overwrites.
+        Other than fifo, merges go to the unwritten end of memory while they fit and then to the window
+        of episodes with the lowest scores, as long as these are lower than the score of the merge.
+        Return the start row, None if the merge is rejected, and the key of the incoming episodes """
+        # keeping the episodes with the largest random keys keeps a uniform sample of all merges
+        key = np.random.uniform() if self.eviction == 'reservoir' else 0.
+        if self.eviction == 'fifo' or self.mem_idx + length <= self.capacity:
+            start_idx = self.mem_idx
+        else:
+            scores, incoming_score = self._eviction_scores(local_buffer, length, key)
+            start_idx, cost = self.episodes.best_window(length, self.capacity, scores)
+            if cost >= incoming_score:
+                return None, key
+
+        if self.episodes is not None:
+            end_idx = start_idx + length
+            if self.eviction != 'fifo' and end_idx < self.capacity:
+                # evicted episodes are dropped whole, the rows left over of the last one are never sampled.
+                # Otherwise its remainder is kept with the return of a part of an episode
+                last = self.episodes.find(np.array([end_idx - 1]))[0]
+                if last >= 0 and self.episodes.start[last] + self.episodes.length[last] > end_idx:
+                    rest_end = self.episodes.start[last] + self.episodes.length[last]
+                    self._remove_episodes(end_idx, rest_end)
+                    self._hold_rows(np.arange(end_idx, rest_end))
+            self._remove_episodes(start_idx, min(end_idx, self.capacity))
+            if end_idx > self.capacity:
+                self._remove_episodes(0, end_idx - self.capacity)
+
+        return start_idx, key
+
+    def _eviction_scores(self, local_buffer, length, key):
+        """ Scores of stored episodes and of the merge, the lower the sooner evicted """
+        ids = self.episodes.order
+        if self.eviction == 'reservoir':
+            return self.episodes.key[ids], key
+        elif self.eviction == 'lowest_priority':
+            assert_colorize('priority' in local_buffer, 'lowest_priority eviction requires prioritized replay')
+            return (self.episodes.priority[ids] / self.episodes.length[ids], 
+                    float(np.mean(local_buffer['priority'][:length])))
+        elif self.eviction == 'top_k_return':
+            # the top_k episodes with the highest returns are never evicted, the others are evicted FIFO
+            scores = self.episodes.inserted_at[ids].astype(np.float64)
+            if len(ids) > self.top_k:
+                scores[np.argpartition(-self.episodes.ret[ids], self.top_k)[:self.top_k]] = np.inf
+            else:
+                scores[:] = np.inf
+            return scores, float(self.episodes.n_inserted)
+        else:
+            raise NotImplementedError
+
+    def _remove_episodes(self, lo, hi):
+        self.episodes.remove_range(lo, hi, self.memory['reward'][:, 0], self._row_priorities())
+
+    def _index_episodes(self, start_idx, length, key):
+        """ Add the episodes written to memory from start_idx on, splitting them at episode ends
+        and at the end of memory """
+        for lo, hi in [(start_idx, min(start_idx + length, self.capacity)), (0, start_idx + length - self.capacity)]:
+            if hi <= lo:
+                continue
+            # episodes end at rows with done and a 1-step return
+            ends = lo + 1 + np.flatnonzero(self.memory['done'][lo: hi, 0] & (self.memory['steps'][lo: hi, 0] == 1))
+            bounds = np.concatenate([[lo], ends[ends < hi], [hi]])
+            starts, lengths = bounds[:-1], np.diff(bounds)
+            rets = np.add.reduceat(self.memory['reward'][lo: hi, 0].astype(np.float64), starts - lo)
+            priorities = self._row_priorities(lo, hi)
+            priorities = 0. if priorities is None else np.add.reduceat(priorities.astype(np.float64), starts - lo)
+            # all but the last episode end with done
+            dones = np.ones(len(starts), dtype=bool)
+            dones[-1] = len(ends) > 0 and ends[-1] == hi
+            self.episodes.add(starts, lengths, rets, priorities, dones, key)
+
+    def _row_priorities(self, lo=None, hi=None):
+        """ Priorities of rows [lo, hi), None if the replay has no priorities """
+        return None
 
     def _get_samples(self, indexes):
         indexes = np.asarray(indexes) # convert tuple to array
-        
-        done = self.memory['done'][indexes]
-        state = self.memory['state'][indexes] 
-        # squeeze steps since it is of shape [None, 1]
-        next_indexes = (indexes + np.squeeze(self.memory['steps'][indexes])) % self.capacity
-        assert indexes.shape == next_indexes.shape
+        slot = self._get_slot(len(indexes))
+
+        # mode='clip' avoids the internal buffering np.take does for mode='raise', 
+        # indexes are checked once instead so that invalid ones are not silently clamped.
+        # Next indexes wrap around in memory
+        lo, hi = np.min(indexes), np.max(indexes)
+        assert_colorize(0 <= lo and hi < self.capacity, f'Sampled indexes out of memory: [{lo}, {hi}]')
+        if self.lazy_n_steps:
+            reward, done, steps = self._compute_n_steps(indexes, slot)
+        else:
+            reward = slot['reward']
+            # rewards stored in narrower dtypes are decoded so that they are normalized and scaled in float32
+            reward[...] = np.take(self.memory['reward'], indexes, axis=0, mode='clip')
+            done = np.take(self.memory['done'], indexes, axis=0, out=slot['done'], mode='clip')
+            steps = np.take(self.memory['steps'], indexes, axis=0, out=slot['steps'], mode='clip')
+        # steps is of shape [None, 1]
+        next_indexes = self._next_indexes(indexes, steps[:, 0], out=slot['next_indexes'])
+        if self.frame_stack > 1:
+            state = self._stack_frames(indexes, slot['state'])
+            next_state = self._stack_frames(next_indexes, slot['next_state'])
+        else:
+            state = np.take(self.memory['state'], indexes, axis=0, out=slot['state'], mode='clip')
+            next_state = np.take(self.memory['state'], next_indexes, axis=0, out=slot['next_state'], mode='clip')
         # using zero state as the terminal state
-        next_state = np.where(done, np.zeros_like(state), self.memory['state'][next_indexes])
+        next_state[done[:, 0]] = 0
 
         # process rewards
-        reward = np.copy(self.memory['reward'][indexes])
         if self.normalize_reward:
-            reward = self.running_reward_stats.normalize(reward)
-        reward *= np.where(done, 1, self.reward_scale)
+            reward[...] = self.running_reward_stats.normalize(reward)
+        if self.reward_scale != 1:
+            # rewards of terminal transitions are not scaled
+            not_done = np.logical_not(done, out=slot['not_done'])
+            np.multiply(reward, self.reward_scale, out=reward, where=not_done, dtype=np.float64)
         
         return (
             state,
-            self.memory['action'][indexes],
+            np.take(self.memory['action'], indexes, axis=0, out=slot['action'], mode='clip'),
             reward,
             next_state,
             done,
-            self.memory['steps'][indexes],
+            steps,
         )
+
+    def _compute_n_steps(self, indexes, slot):
+        """ Compute n-step rewards, dones and steps of indexes from 1-step transitions.
+        The window of an index stops after the transition ending its episode, 
+        rows whose windows are not fully written are never sampled, see _update_open_rows """
+        reward = np.take(self.memory['reward'][:, 0], indexes).astype(np.float64)
+        done = np.take(self.memory['done'][:, 0], indexes)
+        steps = np.ones_like(indexes)
+
+        # extend windows that have not reached the end of their episodes one transition at a time
+        extend = np.logical_not(done)
+        for i in range(1, self.n_steps):
+            rows = self._next_indexes(indexes, i, out=None)
+            reward += np.where(extend, self.gamma**i * np.take(self.memory['reward'][:, 0], rows), 0)
+            next_done = np.take(self.memory['done'][:, 0], rows) & extend
+            done |= next_done
+            steps += extend
+            extend &= np.logical_not(next_done)
+        slot['reward'][:, 0] = reward
+        slot['done'][:, 0] = done
+        slot['steps'][:, 0] = steps
+
+        return slot['reward'], slot['done'], slot['steps']
+
+    def _stack_frames(self, indexes, out):
+        """ Rebuild stacked states of indexes from the stored frames """
+        since_start = self.memory['since_start'][indexes, 0]
+        # rows right after the write head lost their earlier frames to newer transitions
+        max_offsets = (indexes - self.mem_idx) % self.capacity if self.is_full else indexes
+        offsets = frame_offsets(since_start, self.frame_stack, max_offsets)
+        rows = self._next_indexes(indexes[:, None], -offsets, out=None)
+
+        return gather_frames(self.memory['state'], rows, out=out)
+
+    def _next_indexes(self, indexes, steps, out):
+        """ Indexes of the next states, which are stored steps rows after indexes """
+        next_indexes = np.add(indexes, steps, out=out)
+        next_indexes %= self.capacity
+
+        return next_indexes
+
+    def _get_slot(self, batch_size):
+        """ Return the next slot of preallocated arrays in the ring """
+        if not self.sample_slots or len(self.sample_slots[0]['done']) != batch_size:
+            self.sample_slots = [self._allocate_slot(batch_size) for _ in range(self.n_sample_slots)]
+        slot = self.sample_slots[self.slot_i % len(self.sample_slots)]
+        self.slot_i += 1
+
+        return slot
+
+    def _allocate_slot(self, batch_size):
+        slot = {}
+        for k in ['action', 'reward', 'done', 'steps']:
+            slot[k] = np.empty((batch_size, *self.memory[k].shape[1:]), dtype=self.memory[k].dtype)
+        # rewards are emitted in at least float32, whatever their storage dtype
+        slot['reward'] = slot['reward'].astype(np.promote_types(slot['reward'].dtype, np.float32))
+        # memory may only hold the newest frame of each state
+        slot['state'] = np.empty((batch_size, *self.state_shape), dtype=self.memory['state'].dtype)
+        slot['next_state'] = np.empty_like(slot['state'])
+        slot['next_indexes'] = np.empty(batch_size, dtype=np.int64)
+        slot['not_done'] = np.empty_like(slot['done'])
+
+        return slot
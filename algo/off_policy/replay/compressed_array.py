@@ -0,0 +1,163 @@
+from collections import OrderedDict
+import numpy as np
+import lz4.block
+
+
+class CompressedArray:
+    """ Array whose rows are stored in lz4-compressed chunks of chunk_size rows.
+    Chunks being written stay decoded until writes move on to other chunks,
+    chunks read by take are decoded into an LRU cache of cache_size chunks.
+    Supports the indexing used by replay buffers: integers, slices and index arrays along axis 0 """
+    """ Interface """
+    def __init__(self, shape, dtype, chunk_size=32, cache_size=8, n_open_chunks=2):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.cache_size = cache_size
+        self.n_open_chunks = n_open_chunks
+        self.chunk_shape = (chunk_size, *self.shape[1:])
+
+        n_chunks = int(np.ceil(self.shape[0] / chunk_size))
+        empty_chunk = lz4.block.compress(np.zeros(self.chunk_shape, dtype=self.dtype).tobytes())
+        self.chunks = [empty_chunk] * n_chunks
+        self.open_chunks = OrderedDict()    # chunk_no --> decoded chunk written since it was compressed
+        self.cache = OrderedDict()          # chunk_no --> decoded chunk, least recently used first
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        """ Bytes held by compressed chunks, open chunks and the cache """
+        # chunks never written share the same compressed empty chunk
+        compressed_nbytes = sum({id(chunk): len(chunk) for chunk in self.chunks}.values())
+        chunk_nbytes = int(np.prod(self.chunk_shape)) * self.dtype.itemsize
+
+        return compressed_nbytes + (len(self.open_chunks) + len(self.cache)) * chunk_nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getstate__(self):
+        # pickled arrays, e.g., local buffers sent to the replay, only carry compressed chunks
+        state = dict(self.__dict__, open_chunks=OrderedDict(), cache=OrderedDict())
+        state['chunks'] = list(self.chunks)
+        for chunk_no, chunk in self.open_chunks.items():
+            state['chunks'][chunk_no] = lz4.block.compress(chunk.tobytes())
+
+        return state
+
+    def __getitem__(self, key):
+        # results keep the shape of index arrays, as for ndarrays
+        return self.take(self._get_rows(key) if isinstance(key, slice) else key)
+
+    def __setitem__(self, key, value):
+        rows = self._get_rows(key)
+        key_shape = (len(rows), ) if isinstance(key, slice) else np.shape(key)
+        value = np.broadcast_to(np.asarray(value, dtype=self.dtype), (*key_shape, *self.shape[1:]))
+        value = value.reshape(len(rows), *self.shape[1:])
+        for chunk_no, group in self._group_by_chunk(rows):
+            self._open(chunk_no)[rows[group] % self.chunk_size] = value[group]
+
+    def take(self, indices, axis=0, out=None, mode=None):
+        """ Same as np.take along axis 0, only chunks touched by indices are decoded """
+        assert axis == 0, 'CompressedArray only supports take along axis 0'
+        indices = np.asarray(indices)
+        if out is None:
+            out = np.empty((*indices.shape, *self.shape[1:]), dtype=self.dtype)
+        rows = indices.reshape(-1)
+        flat_out = out.reshape(len(rows), *self.shape[1:])
+        for chunk_no, group in self._group_by_chunk(rows):
+            flat_out[group] = self._decode(chunk_no)[rows[group] % self.chunk_size]
+        if not out.flags.c_contiguous:
+            # flat_out is a copy of out
+            out[...] = flat_out.reshape(out.shape)
+
+        return out
+
+    """ Implementation """
+    def _get_rows(self, key):
+        if isinstance(key, slice):
+            return np.arange(*key.indices(len(self)))
+        return np.reshape(key, -1)
+
+    def _group_by_chunk(self, rows):
+        """ Yield each chunk touched by rows with the positions of rows in it """
+        chunk_nos = rows // self.chunk_size
+        if len(chunk_nos) == 0:
+            return
+        order = np.argsort(chunk_nos, kind='stable')
+        sorted_nos = chunk_nos[order]
+        bounds = np.flatnonzero(np.diff(sorted_nos)) + 1
+        for group in np.split(order, bounds):
+            yield chunk_nos[group[0]], group
+
+    def _decode(self, chunk_no):
+        if chunk_no in self.open_chunks:
+            return self.open_chunks[chunk_no]
+        if chunk_no in self.cache:
+            self.cache.move_to_end(chunk_no)
+            return self.cache[chunk_no]
+        chunk = np.frombuffer(lz4.block.decompress(self.chunks[chunk_no]), dtype=self.dtype)
+        chunk = chunk.reshape(self.chunk_shape)
+        self.cache[chunk_no] = chunk
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return chunk
+
+    def _open(self, chunk_no):
+        """ Return the writable decoded chunk, compressing the least recently opened chunk if necessary """
+        if chunk_no in self.open_chunks:
+            self.open_chunks.move_to_end(chunk_no)
+            return self.open_chunks[chunk_no]
+        chunk = np.array(self._decode(chunk_no))
+        self.cache.pop(chunk_no, None)
+        self.open_chunks[chunk_no] = chunk
+        if len(self.open_chunks) > self.n_open_chunks:
+            closed_no, closed_chunk = self.open_chunks.popitem(last=False)
+            self.chunks[closed_no] = lz4.block.compress(closed_chunk.tobytes())
+
+        return chunk
+
+
+if __name__ == '__main__':
+    # memory and sampling latency on synthetic pixel observations: 
+    # sprites moving over a static background, as in Atari frames
+    from utility.debug_tools import timeit
+    from algo.off_policy.replay.uniform_replay import UniformReplay
+
+    frame_shape = (84, 84)
+    frame_stack = 4
+    capacity = int(2e4)
+    args = dict(
+        capacity=capacity,
+        min_size=capacity,
+        batch_size=32,
+        normalize_reward=False,
+        n_steps=3,
+        gamma=.99,
+        tb_capacity=100,
+    )
+    background = np.tile(np.linspace(0, 100, frame_shape[1], dtype=np.uint8), (frame_shape[0], 1))
+    def frame(t):
+        x = background.copy()
+        for i in range(4):
+            r, c = (t * (i + 1) + 20 * i) % (frame_shape[0] - 8), (3 * t + 30 * i) % (frame_shape[1] - 8)
+            x[r: r + 8, c: c + 8] = 255 - 40 * i
+        return x
+    frames = [frame(t) for t in range(capacity + frame_stack)]
+
+    n = 1000
+    # uniform batches touch a chunk per frame, so small chunks decode less per sample
+    for compression, chunk_size in [(None, 32), ('lz4', 16), ('lz4', 32), ('lz4', 128)]:
+        schema = dict(state=dict(dtype='uint8', frame_stack=frame_stack, 
+                                 compression=compression, chunk_size=chunk_size))
+        replay = UniformReplay(dict(args, schema=schema), (*frame_shape, frame_stack), 1)
+        for t in range(capacity):
+            replay.add(np.stack(frames[t: t + frame_stack], axis=-1), 0, 0., (t + 1) % 1000 == 0)
+        duration, _ = timeit(lambda: [replay.sample() for _ in range(n)])
+        print(f'compression: {compression}\tchunk size: {chunk_size}\t'
+              f'state memory: {replay.memory["state"].nbytes / 2**20:.1f}MB\t'
+              f'sample latency: {duration / n * 1e6:.0f}us per batch of {args["batch_size"]}')
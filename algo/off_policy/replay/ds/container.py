@@ -12,5 +12,11 @@ class Container():
     def update(self, priority, mem_idx):
         raise NotImplementedError
 
+    def update_batch(self, priorities, mem_idxs):
+        raise NotImplementedError
+
     def find(self, value):
         raise NotImplementedError
+
+    def find_batch(self, values):
+        raise NotImplementedError
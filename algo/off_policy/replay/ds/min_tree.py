@@ -0,0 +1,49 @@
+import numpy as np
+from algo.off_policy.replay.ds.container import Container
+
+class MinTree(Container):
+    """ Interface """
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        self.tree_size = capacity - 1
+        
+        # empty leaves never become the minimum
+        self.container = np.full(self.tree_size + self.capacity, np.inf)
+
+    @property
+    def min_priority(self):
+        return self.container[0]
+
+    def update(self, priority, mem_idx):
+        idx = mem_idx + self.tree_size
+        self.container[idx] = priority
+
+        self._propagate(idx)
+
+    def update_batch(self, priorities, mem_idxs):
+        """ Vectorized version of update, recomputing parent minima one level at a time """
+        mem_idxs = np.reshape(mem_idxs, -1)
+        priorities = np.broadcast_to(np.reshape(priorities, -1), mem_idxs.shape)
+        # only the last write to a duplicate index takes effect, as in sequential updates
+        mem_idxs, last = np.unique(mem_idxs[::-1], return_index=True)
+        idxes = mem_idxs + self.tree_size
+        self.container[idxes] = priorities[::-1][last]
+
+        self._propagate_batch(idxes)
+
+    """ Implementation """
+    def _propagate(self, idx):
+        while idx > 0:
+            idx = (idx - 1) // 2    # update idx to its parent idx
+
+            left = idx * 2 + 1
+            right = idx * 2 + 2
+
+            self.container[idx] = min(self.container[left], self.container[right])
+
+    def _propagate_batch(self, idxes):
+        # see SumTree._propagate_batch
+        while idxes.size > 0 and idxes[-1] > 0:
+            idxes = np.unique((idxes[idxes > 0] - 1) // 2)
+
+            self.container[idxes] = np.minimum(self.container[2 * idxes + 1], self.container[2 * idxes + 2])
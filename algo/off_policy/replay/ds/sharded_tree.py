@@ -0,0 +1,112 @@
+import numpy as np
+from algo.off_policy.replay.ds.container import Container
+
+
+class ShardedTree(Container):
+    """ n_shards trees of shard_capacity leaves stored as the rows of one array and
+    indexed by global mem_idx = shard_no * shard_capacity + leaf. An update only touches
+    the row of its shard, so updates to different shards may run under different lockers.
+    Subclasses define how a parent combines its children """
+    """ Interface """
+    def __init__(self, n_shards, shard_capacity, fill_value):
+        super().__init__(n_shards * shard_capacity)
+        self.n_shards = n_shards
+        self.shard_capacity = shard_capacity
+        self.tree_size = shard_capacity - 1
+
+        self.container = np.full((n_shards, self.tree_size + shard_capacity), fill_value, dtype=np.float64)
+        # number of levels below the roots, i.e., the depth of the deepest leaf
+        self.depth = int(np.ceil(np.log2(shard_capacity))) if shard_capacity > 1 else 0
+
+    @property
+    def roots(self):
+        return self.container[:, 0]
+
+    @property
+    def priorities(self):
+        """ Leaves of all shards, indexed by mem_idx. This is a copy """
+        return self.container[:, self.tree_size:].reshape(-1)
+
+    def update_batch(self, priorities, mem_idxs):
+        """ Same as SumTree.update_batch, parents are recomputed within the shard of each leaf """
+        mem_idxs = np.reshape(mem_idxs, -1)
+        priorities = np.broadcast_to(np.reshape(priorities, -1), mem_idxs.shape)
+        # only the last write to a duplicate index takes effect, as in sequential updates
+        mem_idxs, last = np.unique(mem_idxs[::-1], return_index=True)
+        shard_nos, leaves = np.divmod(mem_idxs, self.shard_capacity)
+        width = self.container.shape[1]
+        flat_idxes = shard_nos * width + leaves + self.tree_size
+        flat_container = self.container.reshape(-1)
+        flat_container[flat_idxes] = priorities[::-1][last]
+
+        self._propagate_batch(flat_container, flat_idxes, width)
+
+    """ Implementation """
+    def _propagate_batch(self, flat_container, flat_idxes, width):
+        # see SumTree._propagate_batch, shards have the same shape, so their levels line up
+        idxes = flat_idxes % width
+        while True:
+            has_parent = idxes > 0
+            if not np.any(has_parent):
+                break
+            idxes, row_starts = idxes[has_parent], flat_idxes[has_parent] - idxes[has_parent]
+            flat_idxes = np.unique(row_starts + (idxes - 1) // 2)
+            idxes = flat_idxes % width
+            row_starts = flat_idxes - idxes
+
+            flat_container[flat_idxes] = self._combine(flat_container[row_starts + 2 * idxes + 1],
+                                                       flat_container[row_starts + 2 * idxes + 2])
+
+    def _combine(self, left, right):
+        raise NotImplementedError
+
+
+class ShardedSumTree(ShardedTree):
+    """ Sum trees of shards, sampled as one sum tree over all leaves """
+    """ Interface """
+    def __init__(self, n_shards, shard_capacity):
+        super().__init__(n_shards, shard_capacity, 0.)
+
+    @property
+    def total_priorities(self):
+        return np.sum(self.roots)
+
+    def find_batch(self, values):
+        """ Same as SumTree.find_batch over all leaves: values pick shards by the totals
+        of the shards before them, then descend the trees of their shards all at once """
+        values = np.array(values, dtype=np.float64)
+        totals = np.cumsum(self.roots)
+        shard_nos = np.minimum(np.searchsorted(totals, values), self.n_shards - 1)
+        values -= totals[shard_nos] - self.roots[shard_nos]
+        idxes = np.zeros(values.shape, dtype=np.int64)   # start from the roots
+
+        for _ in range(self.depth):
+            # leaves may lie at two different depths when shard_capacity is not a power of 2
+            is_leaf = idxes >= self.tree_size
+            left = np.where(is_leaf, idxes, 2 * idxes + 1)
+            left_priorities = self.container[shard_nos, left]
+            go_right = (values > left_priorities) & ~is_leaf
+            idxes = left + go_right
+            values -= np.where(go_right, left_priorities, 0)
+
+        return self.container[shard_nos, idxes], shard_nos * self.shard_capacity + idxes - self.tree_size
+
+    """ Implementation """
+    def _combine(self, left, right):
+        return left + right
+
+
+class ShardedMinTree(ShardedTree):
+    """ Min trees of shards, the minimum over all leaves is the minimum of their roots """
+    """ Interface """
+    def __init__(self, n_shards, shard_capacity):
+        # empty leaves never become the minimum
+        super().__init__(n_shards, shard_capacity, np.inf)
+
+    @property
+    def min_priority(self):
+        return np.min(self.roots)
+
+    """ Implementation """
+    def _combine(self, left, right):
+        return np.minimum(left, right)
@@ -0,0 +1,104 @@
+import numpy as np
+from algo.off_policy.replay.ds.container import Container
+
+class SortedArray(Container):
+    """ Keep mem_idxs ordered by descending priority. 
+    Updated mem_idxs are taken out of the order and inserted back at the ranks of their new priorities,
+    so ranks are never stale and the order never needs a full sort """
+    def __init__(self, capacity):
+        super().__init__(capacity)
+
+        self.container = np.zeros(self.capacity)                # mem_idx   -->     priority
+        self.order = np.zeros(0, dtype=np.int64)                # rank      -->     mem_idx
+        # negated priorities in rank order, kept with the order so that ranks are searched without a gather
+        self.keys = np.zeros(0)
+        self.in_order = np.zeros(self.capacity, dtype=bool)
+
+    def __len__(self):
+        return len(self.order)
+
+    @property
+    def priorities(self):
+        return self.container
+
+    def find(self, rank):
+        mem_idx = self.order[rank]
+
+        return self.container[mem_idx], mem_idx
+
+    def find_batch(self, ranks):
+        mem_idxs = self.order[ranks]
+
+        return self.container[mem_idxs], mem_idxs
+
+    def update(self, priority, mem_idx):
+        self.update_batch(priority, mem_idx)
+
+    def update_batch(self, priorities, mem_idxs):
+        mem_idxs = np.reshape(mem_idxs, -1)
+        priorities = np.broadcast_to(np.reshape(priorities, -1), mem_idxs.shape)
+        # only the last write to a duplicate index takes effect, as in sequential updates
+        mem_idxs, last = np.unique(mem_idxs[::-1], return_index=True)
+        
+        # re-rank updated mem_idxs, ties are broken in favor of the newest update, 
+        # which keeps new transitions with the top priority at the front
+        ranked = mem_idxs[self.in_order[mem_idxs]]
+        self.in_order[ranked] = False
+        removed = self._find_ranks(ranked)
+        self.in_order[mem_idxs] = True
+        self.container[mem_idxs] = priorities[::-1][last]
+        keys = -self.container[mem_idxs]
+        sorted_idxs = np.argsort(keys, kind='stable')
+        mem_idxs, keys = mem_idxs[sorted_idxs], keys[sorted_idxs]
+        # removed entries are still in order, so they are searched before they are dropped
+        ranks = np.searchsorted(self.keys, keys, side='left')
+        self._rebuild(removed, ranks, mem_idxs, keys)
+
+    def remove_batch(self, mem_idxs):
+        """ Take mem_idxs out of the order until they are updated again """
+        mem_idxs = mem_idxs[self.in_order[mem_idxs]]
+        self.in_order[mem_idxs] = False
+        self._rebuild(self._find_ranks(mem_idxs), np.zeros(0, dtype=np.int64), mem_idxs[:0], np.zeros(0))
+
+    def _find_ranks(self, mem_idxs):
+        """ Sorted ranks of mem_idxs, which are still in the order but no longer in in_order """
+        if mem_idxs.size == 0:
+            return np.zeros(0, dtype=np.int64)
+        keys = -self.container[mem_idxs]
+        lo = np.searchsorted(self.keys, keys, side='left')
+        found = self.order[lo] == mem_idxs
+        ranks = lo[found]
+        if not np.all(found):
+            # entries tied with others are looked for among all entries with the same keys
+            hi = np.searchsorted(self.keys, keys[~found], side='right')
+            span_lo, span_hi = np.min(lo[~found]), np.max(hi)
+            tied = span_lo + np.flatnonzero(~self.in_order[self.order[span_lo: span_hi]])
+            ranks = np.union1d(ranks, tied)
+
+        return np.sort(ranks)
+
+    def _rebuild(self, removed, ranks, mem_idxs, keys):
+        """ Drop the entries at ranks removed and insert mem_idxs with keys before ranks, 
+        copying the order once run by run instead of filtering and inserting in separate passes """
+        size = len(self.order) - len(removed) + len(mem_idxs)
+        order, all_keys = np.empty(size, dtype=np.int64), np.empty(size)
+        # insertions at a rank go before the removal of the entry at it
+        cuts = np.concatenate([ranks, removed])
+        n_inserts = len(ranks)
+        events = np.lexsort((np.arange(len(cuts)) >= n_inserts, cuts))
+        src = dst = 0
+        for i in events:
+            cut = cuts[i]
+            order[dst: dst + cut - src] = self.order[src: cut]
+            all_keys[dst: dst + cut - src] = self.keys[src: cut]
+            dst += cut - src
+            src = cut
+            if i < n_inserts:
+                order[dst] = mem_idxs[i]
+                all_keys[dst] = keys[i]
+                dst += 1
+            else:
+                src += 1
+        order[dst:] = self.order[src:]
+        all_keys[dst:] = self.keys[src:]
+        self.order, self.keys = order, all_keys
@@ -8,11 +8,18 @@ class SumTree(Container):
         self.tree_size = capacity - 1
         
         self.container = np.zeros(self.tree_size + self.capacity)
+        # number of levels below the root, i.e., the depth of the deepest leaf
+        self.depth = int(np.ceil(np.log2(capacity))) if capacity > 1 else 0
 
     @property
     def total_priorities(self):
         return self.container[0]
 
+    @property
+    def priorities(self):
+        """ Leaves of the tree, indexed by mem_idx """
+        return self.container[self.tree_size:]
+
     def find(self, value):
         idx = 0                 # start from the root
 
@@ -26,12 +33,41 @@ class SumTree(Container):
 
         return self.container[idx], idx - self.tree_size
 
+    def find_batch(self, values):
+        """ Vectorized version of find, descending all values one level at a time """
+        values = np.array(values, dtype=np.float64)
+        idxes = np.zeros(values.shape, dtype=np.int64)   # start from the root
+
+        for _ in range(self.depth):
+            # leaves may lie at two different depths when capacity is not a power of 2,
+            # values which have already reached a leaf stay where they are
+            is_leaf = idxes >= self.tree_size
+            left = np.where(is_leaf, idxes, 2 * idxes + 1)
+            left_priorities = self.container[left]
+            go_right = (values > left_priorities) & ~is_leaf
+            idxes = left + go_right
+            values -= np.where(go_right, left_priorities, 0)
+
+        return self.container[idxes], idxes - self.tree_size
+
     def update(self, priority, mem_idx):
         idx = mem_idx + self.tree_size
         self.container[idx] = priority
 
         self._propagate(idx)
 
+    def update_batch(self, priorities, mem_idxs):
+        """ Vectorized version of update, recomputing parent sums one level at a time """
+        mem_idxs = np.reshape(mem_idxs, -1)
+        priorities = np.broadcast_to(np.reshape(priorities, -1), mem_idxs.shape)
+        # only the last write to a duplicate index takes effect, as in sequential updates
+        mem_idxs, last = np.unique(mem_idxs[::-1], return_index=True)
+        idxes = mem_idxs + self.tree_size
+        self.container[idxes] = priorities[::-1][last]
+
+        self._propagate_batch(idxes)
+
+    """ Implementation """
     def _propagate(self, idx):
         while idx > 0:
             idx = (idx - 1) // 2    # update idx to its parent idx
@@ -40,3 +76,49 @@ class SumTree(Container):
             right = idx * 2 + 2
 
             self.container[idx] = self.container[left] + self.container[right]
+
+    def _propagate_batch(self, idxes):
+        # a parent recomputed before one of its children is recomputed again 
+        # in the next iteration, so all sums are up to date at the end
+        while idxes.size > 0 and idxes[-1] > 0:
+            idxes = np.unique((idxes[idxes > 0] - 1) // 2)
+
+            self.container[idxes] = self.container[2 * idxes + 1] + self.container[2 * idxes + 2]
+
+
+if __name__ == '__main__':
+    # test efficiency
+    from utility.debug_tools import timeit
+
+    capacity = int(1e6)
+    batch_size = 512
+    tree = SumTree(capacity)
+    tree.update_batch(np.random.uniform(size=capacity), np.arange(capacity))
+
+    segment = tree.total_priorities / batch_size
+    values = np.random.uniform(np.arange(batch_size) * segment, np.arange(1, batch_size + 1) * segment)
+    n = 100
+    loop_time, loop_results = timeit(lambda: [[tree.find(v) for v in values] for _ in range(n)])
+    batch_time, batch_results = timeit(lambda: [tree.find_batch(values) for _ in range(n)])
+    priorities, indexes = list(zip(*loop_results[0]))
+    assert np.all(np.array(priorities) == batch_results[0][0])
+    assert np.all(np.array(indexes) == batch_results[0][1])
+    print(f'capacity: {capacity}\tbatch size: {batch_size}')
+    print(f'find:\t\t{loop_time / n * 1e3:.3f}ms per batch')
+    print(f'find_batch:\t{batch_time / n * 1e3:.3f}ms per batch')
+    print(f'speedup:\t{loop_time / batch_time:.1f}x')
+
+    # priority updates after a learning step touch random leaves, 
+    # whereas merging a local buffer writes contiguous leaves
+    for name, mem_idxs in [('priority update', np.random.randint(0, capacity, size=batch_size)),
+                           ('merge', np.arange(capacity // 2, capacity // 2 + 2000))]:
+        priorities = np.random.uniform(size=mem_idxs.size)
+        def update():
+            for p, i in zip(priorities, mem_idxs):
+                tree.update(p, i)
+        loop_time, _ = timeit(lambda: [update() for _ in range(n)])
+        batch_time, _ = timeit(lambda: [tree.update_batch(priorities, mem_idxs) for _ in range(n)])
+        print(f'{name} of {mem_idxs.size} leaves')
+        print(f'update:		{loop_time / n * 1e3:.3f}ms')
+        print(f'update_batch:	{batch_time / n * 1e3:.3f}ms')
+        print(f'speedup:	{loop_time / batch_time:.1f}x')
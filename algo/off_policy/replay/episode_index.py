@@ -0,0 +1,218 @@
+import numpy as np
+
+from utility.debug_tools import assert_colorize
+
+
+class EpisodeIndex:
+    """ Episodes stored in replay memory, held in compact arrays indexed by episode id.
+    An episode is a run of contiguous rows ending with an episode end or with the data merged in one go,
+    so an episode cut by a local buffer continues in another episode. Each episode records its start row,
+    length, the sum of its stored rewards (its return when rewards are 1-step),
+    the sum of its priorities, when it was inserted, counted in inserted rows, and a key
+    used by eviction policies. Live ids are kept sorted by start row in self.order,
+    so the episodes overlapping a row range are found by binary search """
+    """ Interface """
+    def __init__(self, init_size=1024):
+        self.start = np.zeros(init_size, dtype=np.int64)
+        self.length = np.zeros(init_size, dtype=np.int64)
+        self.ret = np.zeros(init_size, dtype=np.float64)
+        self.priority = np.zeros(init_size, dtype=np.float64)
+        self.inserted_at = np.zeros(init_size, dtype=np.int64)
+        self.key = np.zeros(init_size, dtype=np.float64)
+        self.done = np.zeros(init_size, dtype=bool)
+
+        self.order = np.zeros(0, dtype=np.int64)        # live ids sorted by start
+        self.free_ids = list(range(init_size - 1, -1, -1))
+        self.n_inserted = 0                             # rows inserted so far
+
+    def __len__(self):
+        return len(self.order)
+
+    @property
+    def starts(self):
+        """ Start rows of live episodes, sorted """
+        return self.start[self.order]
+
+    @property
+    def ends(self):
+        return self.start[self.order] + self.length[self.order]
+
+    def add(self, starts, lengths, rets, priorities, dones, key=0.):
+        """ Add contiguous episodes inserted together, their rows must not belong to any episode """
+        n = len(starts)
+        while len(self.free_ids) < n:
+            self._grow()
+        ids = np.array([self.free_ids.pop() for _ in range(n)], dtype=np.int64)
+        self.start[ids] = starts
+        self.length[ids] = lengths
+        self.ret[ids] = rets
+        self.priority[ids] = priorities
+        self.done[ids] = dones
+        self.inserted_at[ids] = self.n_inserted
+        self.key[ids] = key
+        self.n_inserted += int(np.sum(lengths))
+
+        pos = np.searchsorted(self.starts, starts[0])
+        self.order = np.insert(self.order, pos, ids)
+
+        return ids
+
+    def append_row(self, row, reward, done, priority=0.):
+        """ Extend the unfinished episode ending at row by row, or start a new episode at row """
+        prev = self.find(row - 1) if row > 0 else -1
+        if prev >= 0 and not self.done[prev] and self.start[prev] + self.length[prev] == row:
+            self.length[prev] += 1
+            self.ret[prev] += reward
+            self.priority[prev] += priority
+            self.done[prev] = done
+            self.n_inserted += 1
+        else:
+            self.add(np.array([row]), [1], [reward], [priority], [done])
+
+    def remove_range(self, lo, hi, reward, priority=None):
+        """ Drop the episodes in rows [lo, hi) and trim the ones overlapping them.
+        reward and priority are per-row arrays, used to take trimmed rows out of returns and priorities """
+        starts, ends = self.starts, self.ends
+        i0 = np.searchsorted(ends, lo, side='right')
+        i1 = np.searchsorted(starts, hi, side='left')
+        if i0 == i1:
+            return
+        ids = self.order[i0: i1]
+        first, last = ids[0], ids[-1]
+        # only the first and the last episodes may stick out of the range
+        assert_colorize(not (self.start[first] < lo and self.start[first] + self.length[first] > hi),
+                        'Cannot remove rows in the middle of an episode')
+        keep = np.zeros(len(ids), dtype=bool)
+        if self.start[first] < lo:
+            self._trim(first, lo, self.start[first] + self.length[first], reward, priority)
+            self.length[first] = lo - self.start[first]
+            keep[0] = True
+        if self.start[last] + self.length[last] > hi:
+            self._trim(last, self.start[last], hi, reward, priority)
+            self.length[last] -= hi - self.start[last]
+            self.start[last] = hi
+            keep[-1] = True
+
+        self.free_ids.extend(ids[~keep].tolist())
+        self.order = np.delete(self.order, np.arange(i0, i1)[~keep])
+
+    def find(self, rows):
+        """ Ids of the episodes containing rows, -1 for rows in no episode """
+        starts = self.starts
+        pos = np.searchsorted(starts, rows, side='right') - 1
+        ids = self.order[np.maximum(pos, 0)] if len(starts) else np.zeros_like(pos)
+        inside = (pos >= 0) & (rows < self.start[ids] + self.length[ids])
+
+        return np.where(inside, ids, -1)
+
+    def add_priorities(self, rows, deltas):
+        ids = self.find(rows)
+        valid = ids >= 0
+        np.add.at(self.priority, ids[valid], deltas[valid])
+
+    def best_window(self, length, capacity, scores):
+        """ Find the window of length rows inside [0, capacity) whose overwritten episodes
+        have the lowest maximal score, scores are given for the episodes in self.order.
+        Windows start at episode starts or ends, so no episode loses its last rows.
+        Return the start of the window and its cost, -inf if it overwrites no episode """
+        starts, ends = self.starts, self.ends
+        # candidates are episode starts and the ends followed by a gap, in order.
+        # The first episode overwritten from an episode start is that episode, from an end the next one
+        candidates = np.stack([starts, ends], axis=1).reshape(-1)
+        first_ids = np.stack([np.arange(len(starts)), np.arange(1, len(starts) + 1)], axis=1).reshape(-1)
+        is_candidate = np.ones(len(candidates), dtype=bool)
+        is_candidate[1::2] = ends != np.append(starts[1:], -1)
+        candidates = np.append(0, candidates[is_candidate])
+        i0 = np.append(0, first_ids[is_candidate])
+        fit = candidates + length <= capacity
+        candidates, i0 = candidates[fit], i0[fit]
+        i1 = np.searchsorted(starts, candidates + length, side='left')
+        # max over scores[i0: i1] for all windows at once, -inf pads the end
+        padded = np.append(np.asarray(scores, dtype=np.float64), -np.inf)
+        costs = np.maximum.reduceat(padded, np.stack([i0, i1], axis=1).reshape(-1))[::2]
+        costs[i0 >= i1] = -np.inf
+        i = np.argmin(costs)
+
+        return candidates[i], costs[i]
+
+    def sample_sequences(self, n, seq_len):
+        """ Rows of n sequences of seq_len contiguous rows inside episodes,
+        sampled uniformly over all such sequences """
+        ids = self.order[self.length[self.order] >= seq_len]
+        assert_colorize(len(ids) > 0, f'No episode is as long as {seq_len}')
+        n_seqs = self.length[ids] - seq_len + 1
+        cum_seqs = np.cumsum(n_seqs)
+        seq_idxs = np.random.randint(0, cum_seqs[-1], size=n)
+        i = np.searchsorted(cum_seqs, seq_idxs, side='right')
+        starts = self.start[ids[i]] + seq_idxs - (cum_seqs[i] - n_seqs[i])
+
+        return starts[:, None] + np.arange(seq_len)
+
+    """ Implementation """
+    def _trim(self, i, lo, hi, reward, priority):
+        self.ret[i] -= np.sum(reward[lo: hi], dtype=np.float64)
+        if priority is not None:
+            self.priority[i] -= np.sum(priority[lo: hi], dtype=np.float64)
+
+    def _grow(self):
+        size = len(self.start)
+        for name in ['start', 'length', 'ret', 'priority', 'inserted_at', 'key', 'done']:
+            array = getattr(self, name)
+            grown = np.zeros(2 * size, dtype=array.dtype)
+            grown[: size] = array
+            setattr(self, name, grown)
+        self.free_ids.extend(range(2 * size - 1, size - 1, -1))
+
+
+if __name__ == '__main__':
+    # cost of merges under each eviction policy and of sequence sampling
+    from time import time
+    from algo.off_policy.replay.utils import init_buffer
+    from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+
+    state_shape = (24,)
+    action_dim = 4
+    local_capacity = 1000
+    args = dict(
+        capacity=int(1e6),
+        min_size=local_capacity,
+        batch_size=256,
+        normalize_reward=False,
+        n_steps=3,
+        gamma=.99,
+        alpha=.5,
+        beta0=.4,
+        beta_steps=5e4,
+        tb_capacity=100,
+    )
+    local_buffer = {}
+    init_buffer(local_buffer, local_capacity, state_shape, action_dim, True)
+    local_buffer['state'][:] = np.random.normal(size=local_buffer['state'].shape)
+    local_buffer['reward'][:] = np.random.normal(size=local_buffer['reward'].shape)
+    local_buffer['steps'][:] = 1
+
+    n = 2000
+    for eviction in ['fifo', 'reservoir', 'lowest_priority', 'top_k_return']:
+        for episode_index in [False, True]:
+            if eviction != 'fifo' and not episode_index:
+                continue
+            replay = ProportionalPrioritizedReplay(dict(args, eviction=eviction, episode_index=episode_index), 
+                                                   state_shape, action_dim)
+            # episodes of 20 to 500 steps
+            for _ in range(args['capacity'] // local_capacity):
+                local_buffer['done'][:] = np.random.uniform(size=(local_capacity, 1)) < 1 / 100
+                local_buffer['priority'][:] = np.random.uniform(.1, 2)
+                replay.merge(local_buffer, local_capacity)
+            start = time()
+            for _ in range(n):
+                local_buffer['priority'][:] = np.random.uniform(.1, 2)
+                replay.merge(local_buffer, local_capacity)
+            merge_time = (time() - start) / n
+            message = f'{eviction}\tepisode index: {episode_index}\tmerge: {merge_time * 1e6:.0f}us'
+            if episode_index:
+                start = time()
+                for _ in range(100):
+                    replay.sample_sequences(80)
+                message += (f'\tepisodes: {len(replay.episodes)}\trejected merges: {replay.n_rejected}'
+                            f'\tsequences of 80: {(time() - start) / 100 * 1e6:.0f}us per batch')
+            print(message)
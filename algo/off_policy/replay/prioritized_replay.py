@@ -1,7 +1,6 @@
 import numpy as np
 
 from utility.decorators import override
-from utility.debug_tools import assert_colorize
 from utility.schedule import PiecewiseSchedule
 from algo.off_policy.replay.basic_replay import Replay
 from algo.off_policy.replay.utils import init_buffer, add_buffer, copy_buffer
@@ -25,58 +24,124 @@ class PrioritizedReplay(Replay):
 
         self.sample_i = 0   # count how many times self.sample is called
 
-        init_buffer(self.memory, self.capacity, state_shape, action_dim, self.n_steps == 1)
+        init_buffer(self.memory, self.capacity, state_shape, action_dim, not self.has_tb,
+                    storage=self.storage, storage_dir=self.storage_dir, schema=self.schema)
 
         # Code for single agent
-        if self.n_steps > 1:
+        if self.has_tb:
             self.tb_capacity = args['tb_capacity']
             self.tb_idx = 0
             self.tb_full = False
             self.tb = {}
-            init_buffer(self.tb, self.tb_capacity, state_shape, action_dim, True)
-
-    @override(Replay)
-    def sample(self):
-        assert_colorize(self.good_to_learn, 'There are not sufficient transitions to start learning --- '
-                                            f'transitions in buffer: {len(self)}\t'
-                                            f'minimum required size: {self.min_size}')
-        with self.locker:        
-            samples = self._sample()
-            self.sample_i += 1
-            self._update_beta()
-
-        return samples
+            init_buffer(self.tb, self.tb_capacity, state_shape, action_dim, True, schema=self.schema)
 
     @override(Replay)
     def add(self, state, action, reward, done):
-        if self.n_steps > 1:
+        if self.has_tb:
             self.tb['priority'][self.tb_idx] = self.top_priority
         else:
             self.memory['priority'][self.mem_idx] = self.top_priority
-            self.data_structure.update(self.top_priority, self.mem_idx)
+            self._update_priorities(self.top_priority, self.mem_idx)
         super()._add(state, action, reward, done)
 
+    @override(Replay)
+    def add_batch(self, states, actions, rewards, dones):
+        super()._add_batch(states, actions, rewards, dones, priority=self.top_priority)
+
     def update_priorities(self, priorities, saved_mem_idxs):
         with self.locker:
             if self.to_update_priority:
                 self.top_priority = max(self.top_priority, np.max(priorities))
-            for priority, mem_idx in zip(priorities, saved_mem_idxs):
-                self.data_structure.update(priority, mem_idx)
+            if self.episodes is not None:
+                # rows dropped from the episode index since they were sampled stay unsampled
+                saved_mem_idxs = np.reshape(saved_mem_idxs, -1)
+                priorities = np.broadcast_to(np.reshape(priorities, -1), saved_mem_idxs.shape)
+                kept = self.episodes.find(saved_mem_idxs) >= 0
+                priorities, saved_mem_idxs = priorities[kept], saved_mem_idxs[kept]
+            self._update_priorities(priorities, saved_mem_idxs)
+
+    def sampling_stats(self):
+        """ Total and minimum sampling weights of rows, the probability of a row is its weight over the total. 
+        Replays sampled separately, such as replay servers, are combined by these """
+        raise NotImplementedError
 
     """ Implementation """
+    @override(Replay)
+    def _sample_batch(self):
+        samples = self._sample()
+        self.sample_i += 1
+        self._update_beta()
+
+        return samples
+
+    def _update_priorities(self, priorities, mem_idxs):
+        """ Keep all data structures in sync with the new priorities """
+        self._mark_dirty(mem_idxs)
+        if self.episodes is not None:
+            # the last of duplicate indexes takes effect
+            mem_idxs = np.reshape(mem_idxs, -1)
+            priorities = np.broadcast_to(np.reshape(priorities, -1), mem_idxs.shape)
+            _, last = np.unique(mem_idxs[::-1], return_index=True)
+            rows = mem_idxs[::-1][last]
+            self.episodes.add_priorities(rows, priorities[::-1][last] - self.data_structure.priorities[rows])
+        self.data_structure.update_batch(priorities, mem_idxs)
+
+    @override(Replay)
+    def _snapshot_arrays(self):
+        arrays = super()._snapshot_arrays()
+        # trees are rebuilt from their leaves when the snapshot is loaded
+        arrays['leaf_priority'] = self.data_structure.priorities
+
+        return arrays
+
+    @override(Replay)
+    def _snapshot_meta(self):
+        meta = super()._snapshot_meta()
+        meta.update(dict(top_priority=self.top_priority, sample_i=self.sample_i))
+
+        return meta
+
+    @override(Replay)
+    def _load_snapshot(self, path, meta, chunk_size):
+        super()._load_snapshot(path, meta, chunk_size)
+        self.top_priority = meta['top_priority']
+        self.sample_i = meta['sample_i']
+        self._update_beta()
+        
+        length = meta['length']
+        self._update_priorities(self.data_structure.priorities[:length], np.arange(length))
+
     def _update_beta(self):
         self.beta = self.beta_schedule.value(self.sample_i)
 
     @override(Replay)
-    def _merge(self, local_buffer, length):
-        end_idx = self.mem_idx + length
-        assert np.all(local_buffer['priority'][: length])
-        for idx, mem_idx in enumerate(range(self.mem_idx, end_idx)):
-            self.data_structure.update(local_buffer['priority'][idx], mem_idx % self.capacity)
+    def _write(self, start_idx, local_buffer, length):
+        # rows with zero priority are never sampled, e.g., rows streamed only as next states
+        assert np.all(local_buffer['priority'][: length] >= 0)
+        mem_idxs = np.arange(start_idx, start_idx + length) % self.capacity
+        self._update_priorities(local_buffer['priority'][: length], mem_idxs)
             
-        super()._merge(local_buffer, length)
+        super()._write(start_idx, local_buffer, length)
+
+    @override(Replay)
+    def _hold_rows(self, rows):
+        # rows with zero priority are never sampled
+        held = np.copy(self.data_structure.priorities[rows])
+        self._update_priorities(0, rows)
+
+        return held
+
+    @override(Replay)
+    def _release_rows(self, rows, held):
+        self._update_priorities(held, rows)
+
+    @override(Replay)
+    def _row_priorities(self, lo=None, hi=None):
+        return self.data_structure.priorities[lo: hi]
         
-    def _compute_IS_ratios(self, probabilities):
-        IS_ratios = (np.min(probabilities) / probabilities)**self.beta
+    def _compute_IS_ratios(self, probabilities, min_probability):
+        """ Normalize by the minimum probability over the whole buffer, 
+        so that weights do not depend on which batch is sampled """
+        IS_ratios = (min_probability / probabilities)**self.beta
 
         return IS_ratios
@@ -0,0 +1,133 @@
+import threading
+from time import time
+import numpy as np
+
+
+class PriorityUpdater:
+    """ Apply priority updates of the learner to a prioritized buffer in a background thread,
+    so a learning step only queues its priorities. Updates queued while the thread is busy
+    are concatenated and applied with one call of buffer.update_priorities, where later
+    updates to the same index win. At most max_staleness learning steps are queued or being
+    applied, queueing more waits for the thread, which bounds how stale priorities get.
+    Lag is counted in learning steps queued after the step of an update when it is applied """
+    """ Interface """
+    def __init__(self, buffer, max_staleness=4):
+        assert max_staleness > 0, f'max_staleness must be positive: {max_staleness}'
+        self.buffer = buffer
+        self.max_staleness = max_staleness
+
+        self.pending = []       # (step, priorities, saved_mem_idxs)
+        self.n_queued = 0
+        self.n_applied = 0
+        self.n_batches = 0      # calls of buffer.update_priorities
+        self.lag_sum = 0
+        self.max_lag = 0
+        self.wait_time = 0.     # seconds learning steps waited for the thread
+        self.error = None
+
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def update_priorities(self, priorities, saved_mem_idxs):
+        """ Queue an update, waiting while max_staleness updates are not applied yet """
+        with self.cond:
+            if self.n_queued - self.n_applied >= self.max_staleness:
+                start = time()
+                self.cond.wait_for(lambda: self.n_queued - self.n_applied < self.max_staleness or self.error)
+                self.wait_time += time() - start
+            self._check_error()
+            self.pending.append((self.n_queued, np.reshape(priorities, -1), np.reshape(saved_mem_idxs, -1)))
+            self.n_queued += 1
+            self.cond.notify_all()
+
+    def flush(self):
+        """ Wait until all queued updates are applied """
+        with self.cond:
+            self.cond.wait_for(lambda: self.n_applied == self.n_queued or self.error)
+            self._check_error()
+
+    def stats(self):
+        with self.cond:
+            return dict(
+                PriorityUpdates=self.n_applied,
+                PriorityBatches=self.n_batches,
+                PriorityLagMean=self.lag_sum / max(self.n_applied, 1),
+                PriorityLagMax=self.max_lag,
+                PriorityWaitTime=self.wait_time,
+            )
+
+    """ Implementation """
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending)
+                updates, self.pending = self.pending, []
+            try:
+                steps, priorities, saved_mem_idxs = zip(*updates)
+                self.buffer.update_priorities(np.concatenate(priorities), np.concatenate(saved_mem_idxs))
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+                    self.cond.notify_all()
+                raise
+            with self.cond:
+                lags = self.n_queued - 1 - np.array(steps)
+                self.lag_sum += int(np.sum(lags))
+                self.max_lag = max(self.max_lag, int(np.max(lags)))
+                self.n_applied += len(updates)
+                self.n_batches += 1
+                self.cond.notify_all()
+
+    def _check_error(self):
+        if self.error is not None:
+            raise RuntimeError('Priority updates failed in the background thread') from self.error
+
+
+if __name__ == '__main__':
+    # time per learning step and priority lag with priorities applied in the step and in the background.
+    # A learning step is emulated by sleeping, which releases the GIL as session calls do
+    from time import sleep
+    from algo.off_policy.replay.utils import init_buffer
+    from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+
+    state_shape = (24,)
+    action_dim = 4
+    local_capacity = 1000
+    args = dict(
+        capacity=int(1e6),
+        min_size=local_capacity,
+        batch_size=256,
+        normalize_reward=False,
+        n_steps=3,
+        gamma=.99,
+        alpha=.5,
+        beta0=.4,
+        beta_steps=5e4,
+        tb_capacity=100,
+    )
+    local_buffer = {}
+    init_buffer(local_buffer, local_capacity, state_shape, action_dim, True)
+    local_buffer['steps'][:] = 1
+    local_buffer['priority'][:] = 1
+    replay = ProportionalPrioritizedReplay(args, state_shape, action_dim)
+    for _ in range(args['capacity'] // local_capacity):
+        replay.merge(local_buffer, local_capacity)
+
+    n = 1000
+    step_time = 2e-3
+    for max_staleness in [0, 1, 4, 16]:
+        updater = PriorityUpdater(replay, max_staleness) if max_staleness else None
+        start = time()
+        for _ in range(n):
+            IS_ratios, indexes, _ = replay.sample()
+            sleep(step_time)
+            (updater or replay).update_priorities(np.random.uniform(.1, 2, size=args['batch_size']), indexes)
+        duration = (time() - start) / n
+        if updater:
+            updater.flush()
+        stats = updater.stats() if updater else dict(PriorityLagMean=0, PriorityLagMax=0, PriorityBatches=n)
+        print(f'max staleness: {max_staleness}\tstep: {duration * 1e3:.2f}ms\t'
+              f'overhead: {(duration - step_time) * 1e3:.2f}ms\t'
+              f'lag mean: {stats["PriorityLagMean"]:.2f}\tlag max: {stats["PriorityLagMax"]}\t'
+              f'updates per batch: {n / stats["PriorityBatches"]:.1f}')
@@ -3,6 +3,7 @@ import ray
 
 from utility.decorators import override
 from algo.off_policy.replay.ds.sum_tree import SumTree
+from algo.off_policy.replay.ds.min_tree import MinTree
 from algo.off_policy.replay.prioritized_replay import PrioritizedReplay
 
 
@@ -11,22 +12,35 @@ class ProportionalPrioritizedReplay(PrioritizedReplay):
     def __init__(self, args, state_shape, action_dim):
         super().__init__(args, state_shape, action_dim)
         self.data_structure = SumTree(self.capacity)        # mem_idx    -->     priority
+        self.min_tree = MinTree(self.capacity)              # global minimum priority for IS ratios
+
+    @override(PrioritizedReplay)
+    def sampling_stats(self):
+        return self.data_structure.total_priorities, self.min_tree.min_priority
 
     """ Implementation """
+    @override(PrioritizedReplay)
+    def _update_priorities(self, priorities, mem_idxs):
+        super()._update_priorities(priorities, mem_idxs)
+        # rows with zero priority are never sampled, so they do not count for IS ratios
+        self.min_tree.update_batch(np.where(priorities > 0, priorities, np.inf), mem_idxs)
+
     @override(PrioritizedReplay)
     def _sample(self):
         total_priorities = self.data_structure.total_priorities
         
         segment = total_priorities / self.batch_size
 
-        priorities, indexes = list(zip(*[self.data_structure.find(np.random.uniform(i * segment, (i+1) * segment))
-                                        for i in range(self.batch_size)]))
+        # stratified sampling, one value from each segment
+        values = np.random.uniform(np.arange(self.batch_size) * segment, 
+                                   np.arange(1, self.batch_size + 1) * segment)
+        priorities, indexes = self.data_structure.find_batch(values)
 
-        priorities = np.array(priorities)
         probabilities = priorities / total_priorities
 
         # compute importance sampling ratios
-        IS_ratios = self._compute_IS_ratios(probabilities)
+        min_probability = self.min_tree.min_priority / total_priorities
+        IS_ratios = self._compute_IS_ratios(probabilities, min_probability)
         samples = self._get_samples(indexes)
         
         return IS_ratios, indexes, samples
@@ -0,0 +1,80 @@
+import numpy as np
+
+from utility.decorators import override
+from algo.off_policy.replay.ds.sorted_array import SortedArray
+from algo.off_policy.replay.prioritized_replay import PrioritizedReplay
+
+
+class RankBasedPrioritizedReplay(PrioritizedReplay):
+    """ Interface """
+    def __init__(self, args, state_shape, action_dim):
+        super().__init__(args, state_shape, action_dim)
+        self.data_structure = SortedArray(self.capacity)                # rank    -->     mem_idx
+
+        # unnormalized cumulative distribution of the power-law distribution p(rank) ∝ rank^(-alpha).
+        # Distributions of smaller sizes are prefixes of this one
+        self.cdf = np.cumsum(np.arange(1, self.capacity + 1, dtype=np.float64)**-self.alpha)
+        
+        # stratified segments are only recomputed when the size of the buffer changes
+        self.segment_size = None
+        self.segment_starts = None
+        self.segment_ends = None
+
+    @override(PrioritizedReplay)
+    def sampling_stats(self):
+        # the weight of rank r is r^(-alpha), the last rank has the minimum
+        size = len(self.data_structure)
+
+        return self.cdf[size - 1], size**-self.alpha
+
+    """ Implementation """
+    @override(PrioritizedReplay)
+    def _write(self, start_idx, local_buffer, length):
+        super()._write(start_idx, local_buffer, length)
+        # every row in the order has a rank, rows with zero priority, e.g., rows streamed only as next states, 
+        # are left out of it
+        zero = local_buffer['priority'][:length, 0] == 0
+        if np.any(zero):
+            self.data_structure.remove_batch((start_idx + np.flatnonzero(zero)) % self.capacity)
+
+    @override(PrioritizedReplay)
+    def _hold_rows(self, rows):
+        # every row in the order has a rank, rows are held back by leaving the order
+        held = np.copy(self.data_structure.priorities[rows])
+        self.data_structure.remove_batch(rows)
+
+        return held
+
+    @override(PrioritizedReplay)
+    def _sample(self):
+        # rows held back from sampling are not ranked
+        size = len(self.data_structure)
+        starts, ends = self._get_segments(size)
+        
+        # stratified sampling, one rank from each segment
+        ranks = np.random.randint(starts, ends)
+        priorities, indexes = self.data_structure.find_batch(ranks)
+
+        total = self.cdf[size - 1]
+        probabilities = (ranks + 1.)**-self.alpha / total
+
+        # compute importance sampling ratios
+        min_probability = size**-self.alpha / total
+        IS_ratios = self._compute_IS_ratios(probabilities, min_probability)
+        samples = self._get_samples(indexes)
+        
+        return IS_ratios, indexes, samples
+
+    def _get_segments(self, size):
+        if size != self.segment_size:
+            # split the probability mass of the first size ranks into batch_size equal segments
+            boundaries = self.cdf[size - 1] * np.arange(1, self.batch_size) / self.batch_size
+            boundaries = np.searchsorted(self.cdf[:size], boundaries)
+
+            self.segment_starts = np.concatenate([[0], boundaries])
+            # the head of the distribution may be split at a single rank, keep each segment non-empty
+            self.segment_ends = np.minimum(np.maximum(np.append(boundaries, size), self.segment_starts + 1), size)
+            self.segment_starts = np.minimum(self.segment_starts, self.segment_ends - 1)
+            self.segment_size = size
+
+        return self.segment_starts, self.segment_ends
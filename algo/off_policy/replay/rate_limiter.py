@@ -0,0 +1,77 @@
+import threading
+from time import time
+
+from utility.debug_tools import assert_colorize
+
+
+class RateLimiter:
+    """ Keep the number of sampled transitions per inserted transition close to samples_per_insert.
+    With diff = n_inserted * samples_per_insert - n_sampled, inserts wait while diff is above
+    min_size * samples_per_insert + error_buffer and samples wait while diff is below
+    min_size * samples_per_insert - error_buffer, so the first min_size inserts never wait.
+    A side is let through as long as diff is inside the band before its call,
+    so an insert or a batch may overshoot the band but the two sides never wait for each other.
+    Inserts and samples must come from different threads, otherwise waiting never ends.
+    With timeout, a side waits at most timeout seconds and then goes on, throttling instead of blocking """
+    """ Interface """
+    def __init__(self, samples_per_insert, error_buffer, min_size, timeout=None):
+        assert_colorize(samples_per_insert > 0, f'samples_per_insert must be positive: {samples_per_insert}')
+        assert_colorize(error_buffer > 0, f'error_buffer must be positive: {error_buffer}')
+        self.samples_per_insert = samples_per_insert
+        self.min_diff = min_size * samples_per_insert - error_buffer
+        self.max_diff = min_size * samples_per_insert + error_buffer
+        self.timeout = timeout
+
+        self.n_inserted = 0
+        self.n_sampled = 0
+        # seconds each side spent waiting and how many of its waits timed out
+        self.insert_wait_time = 0.
+        self.sample_wait_time = 0.
+        self.n_insert_timeouts = 0
+        self.n_sample_timeouts = 0
+
+        self.cond = threading.Condition()
+
+    @property
+    def diff(self):
+        return self.n_inserted * self.samples_per_insert - self.n_sampled
+
+    def await_insert(self, n):
+        """ Wait until n transitions can be inserted and count them as inserted """
+        with self.cond:
+            waited, timed_out = self._wait(lambda: self.diff <= self.max_diff)
+            self.insert_wait_time += waited
+            self.n_insert_timeouts += timed_out
+            self.n_inserted += n
+            self.cond.notify_all()
+
+    def await_sample(self, n):
+        """ Wait until n transitions can be sampled and count them as sampled """
+        with self.cond:
+            waited, timed_out = self._wait(lambda: self.diff >= self.min_diff)
+            self.sample_wait_time += waited
+            self.n_sample_timeouts += timed_out
+            self.n_sampled += n
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return dict(
+                Inserted=self.n_inserted,
+                Sampled=self.n_sampled,
+                SamplesPerInsert=self.n_sampled / max(self.n_inserted, 1),
+                InsertWaitTime=self.insert_wait_time,
+                SampleWaitTime=self.sample_wait_time,
+                InsertTimeouts=self.n_insert_timeouts,
+                SampleTimeouts=self.n_sample_timeouts,
+            )
+
+    """ Implementation """
+    def _wait(self, predicate):
+        """ Wait on self.cond until predicate holds, return the waiting time and whether it timed out """
+        if predicate():
+            return 0., False
+        start = time()
+        satisfied = self.cond.wait_for(predicate, timeout=self.timeout)
+
+        return time() - start, not satisfied
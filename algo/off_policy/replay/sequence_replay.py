@@ -0,0 +1,239 @@
+import numpy as np
+
+from utility.decorators import override
+from utility.debug_tools import assert_colorize
+from algo.off_policy.replay.basic_replay import Replay
+from algo.off_policy.replay.ds.sum_tree import SumTree
+from algo.off_policy.replay.ds.min_tree import MinTree
+from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+
+
+class SequenceReplay(ProportionalPrioritizedReplay):
+    """ Proportional replay of fixed-length sequences for recurrent agents, as in R2D2.
+    Transitions are stored contiguously as in Replay, a sequence is a record of its start row,
+    the recurrent state of the actor at that row and its priority, so overlapping sequences share rows.
+    Sequences start every seq_period steps of an episode and span burn_in + seq_len rows.
+    The first burn_in steps only warm up the stored recurrent state, which went stale as the network changed.
+    Sequences starting an episode or a merge have no burn-in, since the rows before them are not theirs.
+    Priorities, indexes and IS ratios are per sequence """
+    """ Interface """
+    def __init__(self, args, state_shape, action_dim):
+        super().__init__(args, state_shape, action_dim)
+        assert_colorize(self.eviction == 'fifo' and self.episodes is None,
+                        'SequenceReplay only supports fifo eviction')
+        assert_colorize(not self.lazy_n_steps and self.frame_stack == 1,
+                        'SequenceReplay does not support lazy n-step returns or frame stacking')
+        self.seq_len = args['seq_len'] if 'seq_len' in args else 40
+        self.burn_in = args['burn_in'] if 'burn_in' in args else 40
+        # with seq_period == seq_len, steps trained on by consecutive sequences tile the episode
+        self.seq_period = args['seq_period'] if 'seq_period' in args else self.seq_len
+        self.seq_total = self.burn_in + self.seq_len
+        self.rnn_state_size = args['rnn_state_size']
+        # sequence priority from the priorities of its steps: eta * max + (1 - eta) * mean
+        self.priority_eta = args['priority_eta'] if 'priority_eta' in args else .9
+
+        # sequence records, a ring in insertion order. Episode and merge starts add sequences
+        # besides those every seq_period steps, the oldest records are overwritten if the ring is full
+        self.n_sequences = args['n_sequences'] if 'n_sequences' in args else 2 * self.capacity // self.seq_period
+        self.seq_start = np.zeros(self.n_sequences, dtype=np.int64)        # start row in memory
+        self.seq_abs_start = np.zeros(self.n_sequences, dtype=np.int64)    # start counted in rows ever written
+        self.seq_length = np.zeros(self.n_sequences, dtype=np.int64)       # rows inside the episode
+        self.seq_burn_in = np.zeros(self.n_sequences, dtype=np.int64)
+        self.rnn_state = np.zeros((self.n_sequences, self.rnn_state_size), dtype=np.float32)
+        self.seq_idx = 0
+        self.seq_oldest = 0
+        self.n_valid_seqs = 0
+        self.n_written = 0
+
+        self.data_structure = SumTree(self.n_sequences)     # sequence --> priority
+        self.min_tree = MinTree(self.n_sequences)
+
+    @property
+    def good_to_learn(self):
+        return len(self) >= self.min_size and self.n_valid_seqs > 0
+
+    @override(ProportionalPrioritizedReplay)
+    def add(self, state, action, reward, done):
+        raise NotImplementedError('SequenceReplay only supports merge')
+
+    @override(ProportionalPrioritizedReplay)
+    def add_batch(self, states, actions, rewards, dones):
+        raise NotImplementedError('SequenceReplay only supports merge')
+
+    @override(ProportionalPrioritizedReplay)
+    def update_priorities(self, priorities, saved_mem_idxs):
+        """ Update priorities of sampled sequences, sequences dropped since they were sampled are skipped """
+        priorities = np.reshape(priorities, -1)
+        saved_mem_idxs = np.reshape(saved_mem_idxs, -1)
+        with self.locker:
+            valid = (saved_mem_idxs - self.seq_oldest) % self.n_sequences < self.n_valid_seqs
+            if self.to_update_priority:
+                self.top_priority = max(self.top_priority, np.max(priorities))
+            self._update_priorities(priorities[valid], saved_mem_idxs[valid])
+
+    @override(ProportionalPrioritizedReplay)
+    def save_snapshot(self, path, chunk_size=int(1e5)):
+        raise NotImplementedError('SequenceReplay does not support snapshots')
+
+    @override(ProportionalPrioritizedReplay)
+    def load_snapshot(self, path, chunk_size=int(1e5)):
+        raise NotImplementedError('SequenceReplay does not support snapshots')
+
+    """ Implementation """
+    @override(ProportionalPrioritizedReplay)
+    def _write(self, start_idx, local_buffer, length):
+        assert_colorize('rnn_state' in local_buffer, 'SequenceReplay requires the recurrent states of actors')
+        # sequences starting at rows about to be overwritten are the oldest ones
+        self._drop_sequences(self.n_written + length - self.capacity)
+        Replay._write(self, start_idx, local_buffer, length)
+
+        # sequences start every seq_period steps from each episode start, and from the merge start
+        done = local_buffer['done'][:length, 0] & (local_buffer['steps'][:length, 0] == 1)
+        # rows whose next states lie past the merge, such as the tails of LocalBuffer chunks, are not trained on.
+        # They follow the last episode end of the merge, where its last episode ends for sequences
+        past_merge = (np.logical_not(local_buffer['done'][:length, 0]) 
+                      & (np.arange(length) + local_buffer['steps'][:length, 0] >= length))
+        train_end = np.argmax(past_merge) if np.any(past_merge) else length
+        bounds = np.concatenate([[0], np.flatnonzero(done[:-1]) + 1, [train_end]])
+        offsets = np.concatenate([np.arange(start, end, self.seq_period)
+                                  for start, end in zip(bounds[:-1], bounds[1:])])
+        episode_ends = bounds[np.searchsorted(bounds, offsets, side='right')]
+        lengths = np.minimum(episode_ends - offsets, self.seq_total)
+        burn_ins = np.where(np.isin(offsets, bounds), 0, self.burn_in)
+
+        # priorities of steps trained on, steps outside the episode count as zero
+        steps = np.minimum(offsets[:, None] + np.arange(self.seq_total), length - 1)
+        step_priorities = np.where((np.arange(self.seq_total) < lengths[:, None])
+                                   & (np.arange(self.seq_total) >= burn_ins[:, None]),
+                                   local_buffer['priority'][steps, 0], 0)
+        n_trained = np.maximum(lengths - burn_ins, 1)
+        priorities = (self.priority_eta * np.max(step_priorities, axis=1)
+                      + (1 - self.priority_eta) * np.sum(step_priorities, axis=1) / n_trained)
+        # sequences with no step to train on are never sampled
+        priorities[lengths <= burn_ins] = 0
+
+        self._add_sequences((start_idx + offsets) % self.capacity, self.n_written + offsets,
+                            lengths, burn_ins, local_buffer['rnn_state'][offsets], priorities)
+        self.n_written += length
+
+    def _add_sequences(self, starts, abs_starts, lengths, burn_ins, rnn_states, priorities):
+        n = len(starts)
+        assert_colorize(n <= self.n_sequences, f'Too many sequences in a merge: {n} vs. {self.n_sequences}')
+        ids = (self.seq_idx + np.arange(n)) % self.n_sequences
+        self.seq_start[ids] = starts
+        self.seq_abs_start[ids] = abs_starts
+        self.seq_length[ids] = lengths
+        self.seq_burn_in[ids] = burn_ins
+        self.rnn_state[ids] = rnn_states
+        self.data_structure.update_batch(priorities, ids)
+        self.min_tree.update_batch(np.where(priorities > 0, priorities, np.inf), ids)
+
+        self.seq_idx = (self.seq_idx + n) % self.n_sequences
+        # the ring of records overwrites the oldest sequences when it is full
+        n_overwritten = max(self.n_valid_seqs + n - self.n_sequences, 0)
+        self.seq_oldest = (self.seq_oldest + n_overwritten) % self.n_sequences
+        self.n_valid_seqs += n - n_overwritten
+
+    def _drop_sequences(self, abs_row):
+        """ Drop the sequences starting before abs_row, counted in rows ever written """
+        n_dropped = 0
+        end = self.seq_oldest + self.n_valid_seqs
+        # valid records are sorted by abs_start in at most two contiguous parts of the ring
+        for start, stop in [(self.seq_oldest, min(end, self.n_sequences)), (0, max(end - self.n_sequences, 0))]:
+            n = np.searchsorted(self.seq_abs_start[start: stop], abs_row)
+            n_dropped += n
+            if n < stop - start:
+                break
+        if n_dropped == 0:
+            return
+        ids = (self.seq_oldest + np.arange(n_dropped)) % self.n_sequences
+        self.data_structure.update_batch(0, ids)
+        self.min_tree.update_batch(np.inf, ids)
+        self.seq_oldest = (self.seq_oldest + n_dropped) % self.n_sequences
+        self.n_valid_seqs -= n_dropped
+
+    @override(ProportionalPrioritizedReplay)
+    def _get_samples(self, indexes):
+        """ Gather sequences of seq_total steps, each field with one strided index of shape [batch, seq_total].
+        mask marks steps inside the episode and past burn-in, whose next states are in the same merge,
+        which are the steps to train on """
+        indexes = np.asarray(indexes)
+        t = np.arange(self.seq_total)
+        rows = (self.seq_start[indexes][:, None] + t) % self.capacity
+        mask = (t < self.seq_length[indexes][:, None]) & (t >= self.seq_burn_in[indexes][:, None])
+
+        # rewards stored in narrower dtypes are decoded so that they are normalized and scaled in float32
+        reward = np.take(self.memory['reward'], rows, axis=0)
+        reward = reward.astype(np.promote_types(reward.dtype, np.float32), copy=False)
+        done = np.take(self.memory['done'], rows, axis=0)
+        steps = np.take(self.memory['steps'], rows, axis=0)
+        next_rows = self._next_indexes(rows, steps[..., 0], out=np.empty_like(rows))
+        state = np.take(self.memory['state'], rows, axis=0)
+        next_state = np.take(self.memory['state'], next_rows, axis=0)
+        # using zero state as the terminal state
+        next_state[done[..., 0]] = 0
+
+        if self.normalize_reward:
+            reward[...] = self.running_reward_stats.normalize(reward)
+        if self.reward_scale != 1:
+            # rewards of terminal transitions are not scaled
+            np.multiply(reward, self.reward_scale, out=reward, where=np.logical_not(done), dtype=np.float64)
+
+        return (
+            state,
+            np.take(self.memory['action'], rows, axis=0),
+            reward,
+            next_state,
+            done,
+            steps,
+            mask,
+            self.rnn_state[indexes],
+        )
+
+
+if __name__ == '__main__':
+    # latency of gathering sequence batches with one strided index against a gather per sequence
+    from time import time
+    from algo.off_policy.replay.utils import init_buffer
+
+    state_shape = (64,)
+    action_dim = 4
+    local_capacity = 1000
+    args = dict(
+        capacity=int(1e6),
+        min_size=local_capacity,
+        batch_size=64,
+        normalize_reward=False,
+        n_steps=1,
+        gamma=.99,
+        alpha=.5,
+        beta0=.4,
+        beta_steps=5e4,
+        tb_capacity=100,
+        seq_len=40,
+        burn_in=40,
+        rnn_state_size=512,
+    )
+    local_buffer = {}
+    init_buffer(local_buffer, local_capacity, state_shape, action_dim, True, rnn_state_size=args['rnn_state_size'])
+    local_buffer['state'][:] = np.random.normal(size=local_buffer['state'].shape)
+    local_buffer['steps'][:] = 1
+    replay = SequenceReplay(args, state_shape, action_dim)
+    for _ in range(args['capacity'] // local_capacity):
+        local_buffer['done'][:] = np.random.uniform(size=(local_capacity, 1)) < 1 / 200
+        local_buffer['priority'][:] = np.random.uniform(.1, 2)
+        replay.merge(local_buffer, local_capacity)
+
+    n = 100
+    start = time()
+    for _ in range(n):
+        replay.sample()
+    strided_time = (time() - start) / n
+    start = time()
+    for _ in range(n):
+        _, indexes, _ = replay._sample()
+        [{k: v[np.arange(s, s + replay.seq_total) % replay.capacity] for k, v in replay.memory.items()}
+         for s in replay.seq_start[indexes]]
+    loop_time = (time() - start) / n
+    print(f'sequences: {replay.n_valid_seqs}\tbatch of {args["batch_size"]} sequences of {replay.seq_total} steps\t'
+          f'strided: {strided_time * 1e3:.1f}ms\tper sequence: {loop_time * 1e3:.1f}ms')
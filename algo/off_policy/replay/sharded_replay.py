@@ -0,0 +1,246 @@
+import threading
+from collections import deque
+import numpy as np
+
+from utility.decorators import override
+from utility.debug_tools import assert_colorize
+from algo.off_policy.replay.utils import copy_buffer
+from algo.off_policy.replay.ds.sharded_tree import ShardedSumTree, ShardedMinTree
+from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+
+
+class ShardedReplay(ProportionalPrioritizedReplay):
+    """ Proportional replay whose memory is split into n_shards contiguous shards,
+    each with its own write head, sum tree and min tree. Merges into different shards
+    copy data and update their trees concurrently, each under the lockers of its shard.
+    Shards are sampled in proportion to their total priorities without waiting for merges,
+    rows being overwritten have zero priority until their copy is done, and a batch is
+    drawn again if a merge starts overwriting one of its rows or next-state rows while it is gathered """
+    """ Interface """
+    def __init__(self, args, state_shape, action_dim):
+        super().__init__(args, state_shape, action_dim)
+        self.n_shards = args['n_shards'] if 'n_shards' in args else 8
+        assert_colorize(not self.lazy_n_steps, 'ShardedReplay does not support lazy n-step returns')
+        assert_colorize(self.frame_stack == 1, 'ShardedReplay does not support frame stacking')
+        assert_colorize(self.episodes is None, 'ShardedReplay does not support the episode index')
+        # chunks of compressed states may span shards, which are written concurrently
+        assert_colorize(self.schema['state']['compression'] is None, 'ShardedReplay does not support compression')
+        assert_colorize(self.capacity % self.n_shards == 0, 
+                        f'Capacity must be divisible by n_shards: {self.capacity} vs. {self.n_shards}')
+        self.shard_capacity = self.capacity // self.n_shards
+        self.data_structure = ShardedSumTree(self.n_shards, self.shard_capacity)
+        self.min_tree = ShardedMinTree(self.n_shards, self.shard_capacity)
+
+        self.shard_mem_idx = np.zeros(self.n_shards, dtype=np.int64)
+        self.shard_full = np.zeros(self.n_shards, dtype=bool)
+        # number of transitions merged into each shard, used to find the least-loaded shard
+        self.n_inserted = np.zeros(self.n_shards, dtype=np.int64)
+        self.shard_lockers = [threading.Lock() for _ in range(self.n_shards)]
+        # held for tree updates only, so priority updates do not wait for copies
+        self.tree_lockers = [threading.Lock() for _ in range(self.n_shards)]
+        # priority updates of each shard, applied by whoever holds its tree locker next
+        self.pending_priorities = [deque() for _ in range(self.n_shards)]
+        # rows whose data is being copied, their priorities are kept zero
+        self.being_written = np.zeros(self.capacity, dtype=bool)
+        # number of times each row has been overwritten, checked by the sampler
+        self.n_writes = np.zeros(self.capacity, dtype=np.int64)
+
+    def __len__(self):
+        return int(np.sum(np.where(self.shard_full, self.shard_capacity, self.shard_mem_idx)))
+
+    @override(ProportionalPrioritizedReplay)
+    def merge(self, local_buffer, length):
+        """ Merge a local buffer to the least-loaded shard whose locker is free """
+        assert_colorize(length < self.shard_capacity, 
+                    f'Local buffer cannot be larger than a shard: {length} vs. {self.shard_capacity}')
+        if self.rate_limiter:
+            self.rate_limiter.await_insert(length)
+        shard_nos = np.argsort(self.n_inserted, kind='stable')
+        for shard_no in shard_nos:
+            if self.shard_lockers[shard_no].acquire(blocking=False):
+                break
+        else:
+            # all shards are busy, wait for the least-loaded one
+            shard_no = shard_nos[0]
+            self.shard_lockers[shard_no].acquire()
+        try:
+            self._merge_shard(shard_no, local_buffer, length)
+        finally:
+            self.shard_lockers[shard_no].release()
+
+    @override(ProportionalPrioritizedReplay)
+    def add(self, state, action, reward, done):
+        raise NotImplementedError('ShardedReplay only supports merge')
+
+    @override(ProportionalPrioritizedReplay)
+    def update_priorities(self, priorities, saved_mem_idxs):
+        priorities = np.reshape(priorities, -1)
+        saved_mem_idxs = np.reshape(saved_mem_idxs, -1)
+        with self.locker:
+            if self.to_update_priority:
+                self.top_priority = max(self.top_priority, np.max(priorities))
+        shard_nos = saved_mem_idxs // self.shard_capacity
+        unique_shard_nos = np.unique(shard_nos)
+        for shard_no in unique_shard_nos:
+            in_shard = shard_nos == shard_no
+            self.pending_priorities[shard_no].append((priorities[in_shard], saved_mem_idxs[in_shard]))
+        # merges holding the trees of their shards apply the updates when they are done with them
+        free_shard_nos = [shard_no for shard_no in unique_shard_nos 
+                          if self.tree_lockers[shard_no].acquire(blocking=False)]
+        try:
+            self._apply_pending_priorities(free_shard_nos)
+        finally:
+            for shard_no in free_shard_nos:
+                self.tree_lockers[shard_no].release()
+
+    @override(ProportionalPrioritizedReplay)
+    def save_snapshot(self, path, chunk_size=int(1e5)):
+        raise NotImplementedError('ShardedReplay does not support snapshots')
+
+    @override(ProportionalPrioritizedReplay)
+    def load_snapshot(self, path, chunk_size=int(1e5)):
+        raise NotImplementedError('ShardedReplay does not support snapshots')
+
+    """ Implementation """
+    @override(ProportionalPrioritizedReplay)
+    def _sample(self):
+        while True:
+            total_priorities = self.data_structure.total_priorities
+            segment = total_priorities / self.batch_size
+            values = np.random.uniform(np.arange(self.batch_size) * segment, 
+                                       np.arange(1, self.batch_size + 1) * segment)
+            # trees of shards being merged may be mid-update, rows found this way may be hidden
+            priorities, indexes = self.data_structure.find_batch(values)
+            # next states are read from other rows, which must not be overwritten while gathered either
+            steps = self.memory['steps'][indexes, 0]
+            next_indexes = self._next_indexes(indexes, steps, out=None)
+            rows = np.concatenate([indexes, next_indexes])
+            n_writes = self.n_writes[rows]
+            hidden = self.being_written[rows].any() or np.any(priorities == 0)
+            samples = self._get_samples(indexes)
+            if (not hidden and np.array_equal(self.n_writes[rows], n_writes)
+                    and np.array_equal(samples[5][:, 0], steps)):
+                break
+
+        probabilities = priorities / total_priorities
+        min_probability = self.min_tree.min_priority / total_priorities
+        IS_ratios = self._compute_IS_ratios(probabilities, min_probability)
+        
+        return IS_ratios, indexes, samples
+
+    def _apply_pending_priorities(self, shard_nos):
+        """ Called with the tree lockers of shard_nos held """
+        updates = []
+        for shard_no in shard_nos:
+            pending = self.pending_priorities[shard_no]
+            while pending:
+                updates.append(pending.popleft())
+        if not updates:
+            return
+        # later updates come later, so they take effect for duplicate rows
+        priorities, mem_idxs = (np.concatenate(v) for v in zip(*updates))
+        # rows overwritten since they were sampled get their priorities when their copy is done
+        valid = np.logical_not(self.being_written[mem_idxs])
+        self._update_priorities(priorities[valid], mem_idxs[valid])
+
+    def _merge_shard(self, shard_no, local_buffer, length):
+        assert np.all(local_buffer['priority'][: length] >= 0)
+        shard_start = shard_no * self.shard_capacity
+        start_idx = self.shard_mem_idx[shard_no]
+        end_idx = start_idx + length
+        mem_idxs = shard_start + np.arange(start_idx, end_idx) % self.shard_capacity
+
+        # hide rows from the sampler before overwriting them
+        with self.tree_lockers[shard_no]:
+            self._apply_pending_priorities([shard_no])
+            self.n_writes[mem_idxs] += 1
+            self.being_written[mem_idxs] = True
+            self.data_structure.update_batch(0, mem_idxs)
+            self.min_tree.update_batch(np.inf, mem_idxs)
+
+        if end_idx > self.shard_capacity:
+            first_part = self.shard_capacity - start_idx
+            copy_buffer(self.memory, shard_start + start_idx, shard_start + self.shard_capacity, 
+                        local_buffer, 0, first_part)
+            copy_buffer(self.memory, shard_start, shard_start + length - first_part, 
+                        local_buffer, first_part, length)
+        else:
+            copy_buffer(self.memory, shard_start + start_idx, shard_start + end_idx, local_buffer, 0, length)
+
+        with self.tree_lockers[shard_no]:
+            self._apply_pending_priorities([shard_no])
+            # the copy is done, rows found before their priorities are restored are rejected by the sampler
+            self.being_written[mem_idxs] = False
+            self._update_priorities(local_buffer['priority'][: length], mem_idxs)
+
+            if end_idx >= self.shard_capacity:
+                self.shard_full[shard_no] = True
+            self.shard_mem_idx[shard_no] = end_idx % self.shard_capacity
+            self.n_inserted[shard_no] += length
+        if self.normalize_reward:
+            # reward statistics are shared by all shards
+            with self.locker:
+                self.running_reward_stats.update(local_buffer['reward'][:length].astype(np.float64))
+
+    @override(ProportionalPrioritizedReplay)
+    def _next_indexes(self, indexes, steps, out):
+        # next states wrap around within the shard
+        offsets = indexes % self.shard_capacity
+        next_indexes = np.add(offsets, steps, out=out)
+        next_indexes %= self.shard_capacity
+        next_indexes += indexes - offsets
+
+        return next_indexes
+
+
+if __name__ == '__main__':
+    # measure throughput as the number of concurrent writers grows
+    import time
+    from algo.off_policy.replay.utils import init_buffer
+
+    state_shape = (24,)
+    action_dim = 4
+    local_capacity = 1000
+    args = dict(
+        capacity=int(1e6),
+        min_size=local_capacity,
+        batch_size=256,
+        normalize_reward=False,
+        n_steps=3,
+        gamma=.99,
+        alpha=.5,
+        beta0=.4,
+        beta_steps=5e4,
+        tb_capacity=100,
+        n_shards=8,
+    )
+    local_buffer = {}
+    init_buffer(local_buffer, local_capacity, state_shape, action_dim, True)
+    local_buffer['state'][:] = np.random.normal(size=local_buffer['state'].shape)
+    local_buffer['steps'][:] = 1
+    local_buffer['priority'][:] = np.random.uniform(.1, 1, size=local_buffer['priority'].shape)
+
+    duration = 3
+    for n_writers in [1, 2, 4, 8, 16]:
+        for ReplayType in [ProportionalPrioritizedReplay, ShardedReplay]:
+            replay = ReplayType(args, state_shape, action_dim)
+            replay.merge(local_buffer, local_capacity)
+            counts = {'merge': 0, 'sample': 0}
+            stop = threading.Event()
+            def write():
+                while not stop.is_set():
+                    replay.merge(local_buffer, local_capacity)
+                    counts['merge'] += 1
+            def sample():
+                while not stop.is_set():
+                    IS_ratios, indexes, _ = replay.sample()
+                    replay.update_priorities(IS_ratios, indexes)
+                    counts['sample'] += 1
+            threads = [threading.Thread(target=write) for _ in range(n_writers)] + [threading.Thread(target=sample)]
+            [t.start() for t in threads]
+            time.sleep(duration)
+            stop.set()
+            [t.join() for t in threads]
+            print(f'{ReplayType.__name__}\twriters: {n_writers}\t'
+                  f'inserts: {counts["merge"] * local_capacity / duration:.0f}/s\t'
+                  f'sampled batches: {counts["sample"] / duration:.0f}/s')
@@ -0,0 +1,48 @@
+import os
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class SharedArray(np.ndarray):
+    """ Array backed by a multiprocessing.shared_memory segment, which other processes
+    on the same machine attach to by the spec of the array without copying it.
+    The creating process owns the segment and unlinks it, views keep the segment alive.
+    Assumes POSIX shared memory under /dev/shm, as on linux """
+    """ Interface """
+    @classmethod
+    def create(cls, shape, dtype):
+        dtype = np.dtype(dtype)
+        nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        array = cls._wrap(shm, shape, dtype)
+        array[...] = 0
+
+        return array
+
+    @staticmethod
+    def attach(spec):
+        """ Map the segment of spec into this process as an np.memmap.
+        Mapping the file of the segment keeps the resource tracker of this process, 
+        which may not be the creator's, from unlinking the segment when this process exits """
+        name, shape, dtype = spec
+
+        return np.memmap(os.path.join('/dev/shm', name), dtype=np.dtype(dtype), mode='r+', shape=shape)
+
+    @property
+    def spec(self):
+        """ What other processes need to attach to the array """
+        return self.shm.name, self.shape, self.dtype.str
+
+    def unlink(self):
+        self.shm.unlink()
+
+    def __array_finalize__(self, obj):
+        self.shm = getattr(obj, 'shm', None)
+
+    """ Implementation """
+    @classmethod
+    def _wrap(cls, shm, shape, dtype):
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf).view(cls)
+        array.shm = shm
+
+        return array
@@ -0,0 +1,245 @@
+from time import time, sleep
+import numpy as np
+
+from utility.decorators import override
+from utility.debug_tools import assert_colorize
+from algo.off_policy.replay.utils import copy_buffer
+from algo.off_policy.replay.shared_array import SharedArray
+from algo.off_policy.replay.sharded_replay import ShardedReplay
+
+
+class SharedReplay(ShardedReplay):
+    """ Sharded proportional replay whose memory is in shared memory, so actor processes on
+    the same machine write local buffers straight into it with a SharedReplayWriter,
+    one writer per shard, and nothing is serialized on the way.
+    Writers and the replay follow a ring protocol over a shared control array,
+    each counter is written by one side only and counts rows ever written to the shard:
+        control[shard_no, 0], committed: rows the writer has finished writing
+        control[shard_no, 1], released: rows the writer may write, the replay has hidden the rows they overwrite
+    The replay picks up committed rows and releases hide_ahead rows past them whenever it syncs,
+    i.e., before sampling a batch and when good_to_learn is checked, so local buffers must not be
+    larger than hide_ahead. Rows released are never sampled and their priorities are not updated,
+    so batches never contain rows being written """
+    """ Interface """
+    def __init__(self, args, state_shape, action_dim):
+        assert_colorize('storage' not in args or args['storage'] == 'shared', 'SharedReplay requires shared storage')
+        super().__init__(dict(args, storage='shared'), state_shape, action_dim)
+        assert_colorize(self.rate_limiter is None, 'SharedReplay does not support the rate limiter')
+        if 'priority' not in self.memory:
+            # writers pass priorities through memory even when the replay keeps a transition buffer
+            self.memory['priority'] = SharedArray.create((self.capacity, 1), np.float64)
+        # rows hidden ahead of the committed rows of each shard, writers wait when they catch up with them
+        self.hide_ahead = args['hide_ahead'] if 'hide_ahead' in args else self.shard_capacity // 8
+        assert_colorize(0 < self.hide_ahead < self.shard_capacity,
+                        f'hide_ahead must be in (0, {self.shard_capacity}): {self.hide_ahead}')
+        # seconds a writer waits for rows to be released before it gives up, the replay may have stopped syncing
+        self.writer_timeout = args['writer_timeout'] if 'writer_timeout' in args else 600
+
+        self.control = SharedArray.create((self.n_shards, 2), np.int64)
+        # no row is overwritten before the shard is full
+        self.control[:, 1] = self.shard_capacity
+        self.n_synced = np.zeros(self.n_shards, dtype=np.int64)
+        self.n_released = np.full(self.n_shards, self.shard_capacity, dtype=np.int64)
+
+    @property
+    def good_to_learn(self):
+        with self.locker:
+            self._sync()
+        return super().good_to_learn
+
+    def writer_spec(self):
+        """ What a SharedReplayWriter needs to write to the replay """
+        return dict(
+            fields={k: v.spec for k, v in self.memory.items()},
+            control=self.control.spec,
+            n_shards=self.n_shards,
+            shard_capacity=self.shard_capacity,
+            hide_ahead=self.hide_ahead,
+            timeout=self.writer_timeout,
+        )
+
+    def close(self):
+        """ Unlink shared memory, writers must be done by now """
+        for v in self.memory.values():
+            v.unlink()
+        self.control.unlink()
+
+    @override(ShardedReplay)
+    def merge(self, local_buffer, length):
+        raise NotImplementedError('SharedReplay is written by SharedReplayWriter')
+
+    """ Implementation """
+    @override(ShardedReplay)
+    def _sample_batch(self):
+        self._sync()
+
+        return super()._sample_batch()
+
+    def _sync(self):
+        """ Pick up rows committed by writers and release rows to them, called with self.locker held """
+        committed = self.control[:, 0].copy()
+        for shard_no in np.flatnonzero(committed > self.n_synced):
+            shard_start = shard_no * self.shard_capacity
+            # newly committed rows become visible with the priorities their writer gave them
+            mem_idxs = shard_start + np.arange(self.n_synced[shard_no], committed[shard_no]) % self.shard_capacity
+            self.being_written[mem_idxs] = False
+            self._update_priorities(self.memory['priority'][mem_idxs, 0], mem_idxs)
+            if self.normalize_reward:
+                self.running_reward_stats.update(self.memory['reward'][mem_idxs].astype(np.float64))
+            self.n_inserted[shard_no] += committed[shard_no] - self.n_synced[shard_no]
+            self.n_synced[shard_no] = committed[shard_no]
+            self.shard_full[shard_no] = committed[shard_no] >= self.shard_capacity
+            self.shard_mem_idx[shard_no] = committed[shard_no] % self.shard_capacity
+
+            # rows about to be overwritten are hidden before they are released
+            released = committed[shard_no] + self.hide_ahead
+            if released > self.n_released[shard_no]:
+                mem_idxs = shard_start + np.arange(self.n_released[shard_no], released) % self.shard_capacity
+                self.being_written[mem_idxs] = True
+                self.data_structure.update_batch(0, mem_idxs)
+                self.min_tree.update_batch(np.inf, mem_idxs)
+                self.n_released[shard_no] = released
+                self.control[shard_no, 1] = released
+
+
+class SharedReplayWriter:
+    """ Write local buffers to a shard of a SharedReplay, possibly from another process.
+    Each shard must have at most one writer """
+    """ Interface """
+    def __init__(self, spec, shard_no):
+        self.memory = {k: SharedArray.attach(v) for k, v in spec['fields'].items()}
+        self.control = SharedArray.attach(spec['control'])
+        self.shard_no = shard_no
+        self.shard_capacity = spec['shard_capacity']
+        self.shard_start = shard_no * self.shard_capacity
+        # the replay releases at most hide_ahead rows past those committed
+        self.max_length = spec['hide_ahead']
+        self.timeout = spec['timeout']
+        self.wait_time = 0.     # seconds waited for the replay to release rows
+
+    def merge(self, local_buffer, length):
+        """ Copy the first length transitions of local_buffer to the shard,
+        waiting until the replay has released the rows they overwrite. 
+        Raise TimeoutError if they are not released within timeout seconds """
+        assert_colorize(length <= self.max_length, 
+                        f'Local buffer cannot be larger than hide_ahead: {length} vs. {self.max_length}')
+        committed = int(self.control[self.shard_no, 0])
+        end = committed + length
+        if self.control[self.shard_no, 1] < end:
+            start = time()
+            while self.control[self.shard_no, 1] < end:
+                if time() - start > self.timeout:
+                    raise TimeoutError(f'Shard {self.shard_no} has not been released for {self.timeout}s, '
+                                       'the replay syncs only when it is sampled or good_to_learn is checked')
+                sleep(1e-4)
+            self.wait_time += time() - start
+
+        start_idx = committed % self.shard_capacity
+        end_idx = start_idx + length
+        if end_idx > self.shard_capacity:
+            first_part = self.shard_capacity - start_idx
+            copy_buffer(self.memory, self.shard_start + start_idx, self.shard_start + self.shard_capacity,
+                        local_buffer, 0, first_part)
+            copy_buffer(self.memory, self.shard_start, self.shard_start + length - first_part,
+                        local_buffer, first_part, length)
+        else:
+            copy_buffer(self.memory, self.shard_start + start_idx, self.shard_start + end_idx, local_buffer, 0, length)
+        # rows are committed only after they are written
+        self.control[self.shard_no, 0] = end
+
+
+if __name__ == '__main__':
+    # inserted transitions per second from writer processes to a shared replay
+    # and from ray actors to a replay server, while a sampler keeps sampling
+    import threading
+    import multiprocessing
+    import ray
+    from algo.off_policy.replay.utils import build_schema, init_buffer
+    from algo.off_policy.apex.replay_server import get_replay_servers
+
+    action_dim = 4
+    local_capacity = 500
+    duration = 10
+    args = dict(
+        type='proportional',
+        min_size=local_capacity,
+        batch_size=256,
+        normalize_reward=False,
+        n_steps=3,
+        gamma=.99,
+        alpha=.5,
+        beta0=.4,
+        beta_steps=5e4,
+        tb_capacity=100,
+        hide_ahead=local_capacity,
+        n_servers=1,
+        server_cpus=0,
+        batches_per_pull=1,
+    )
+    def make_local_buffer(state_shape, schema):
+        local_buffer = {}
+        init_buffer(local_buffer, local_capacity, state_shape, action_dim, True, extra_state=1, 
+                    schema=build_schema(schema, action_dim))
+        local_buffer['state'][:] = np.random.randint(0, 255, size=local_buffer['state'].shape)
+        local_buffer['steps'][:] = 1
+        local_buffer['priority'][:] = np.random.uniform(.1, 2, size=local_buffer['priority'].shape)
+        return local_buffer
+
+    @ray.remote(num_cpus=0)
+    def push(server, state_shape, schema, duration):
+        local_buffer = make_local_buffer(state_shape, schema)
+        n = 0
+        merge_ref = None
+        start = time()
+        while time() - start < duration:
+            if merge_ref is not None:
+                ray.get(merge_ref)
+            merge_ref = server.merge.remote(dict(local_buffer), local_capacity)
+            n += 1
+        ray.get(merge_ref)
+        return n
+
+    def write(spec, shard_no, state_shape, schema, duration):
+        writer = SharedReplayWriter(spec, shard_no)
+        local_buffer = make_local_buffer(state_shape, schema)
+        start = time()
+        while time() - start < duration:
+            writer.merge(local_buffer, local_capacity)
+
+    ray.init(include_dashboard=False)
+    for state_shape, dtype, capacity in [((24,), 'float16', int(1e6)), ((84, 84), 'uint8', int(2e4))]:
+        schema = dict(state=dict(dtype=dtype))
+        for n_writers in [1, 2]:
+            shape_args = dict(args, capacity=capacity, n_shards=n_writers, schema=schema)
+            # shared replay, sampled by a thread of this process
+            replay = SharedReplay(shape_args, state_shape, action_dim)
+            spec = replay.writer_spec()
+            writers = [multiprocessing.get_context('fork').Process(target=write, 
+                                                                   args=(spec, i, state_shape, schema, duration))
+                       for i in range(n_writers)]
+            [w.start() for w in writers]
+            n_batches = 0
+            while any(w.is_alive() for w in writers):
+                if replay.good_to_learn:
+                    replay.sample()
+                    n_batches += 1
+            [w.join() for w in writers]
+            shared_rate = np.sum(replay.control[:, 0]) / duration
+            shared_batches = n_batches / duration
+            replay.close()
+
+            # replay server fed by ray actors, sampled by this process
+            server = get_replay_servers(shape_args, state_shape, action_dim)[0]
+            pushes = [push.remote(server, state_shape, schema, duration) for _ in range(n_writers)]
+            n_batches = 0
+            while ray.wait(pushes, num_returns=len(pushes), timeout=0)[1]:
+                if ray.get(server.good_to_learn.remote()):
+                    ray.get(server.sample.remote())
+                    n_batches += 1
+            ray_rate = np.sum(ray.get(pushes)) * local_capacity / duration
+            ray_batches = n_batches / duration
+            ray.kill(server)
+
+            print(f'state: {state_shape} {dtype}\twriters: {n_writers}\t'
+                  f'shared: {shared_rate:.0f} inserts/s, {shared_batches:.0f} batches/s\t'
+                  f'ray: {ray_rate:.0f} inserts/s, {ray_batches:.0f} batches/s')
@@ -10,26 +10,69 @@ class UniformReplay(Replay):
     def __init__(self, args, state_shape, action_dim):
         super().__init__(args, state_shape, action_dim)
 
-        init_buffer(self.memory, self.capacity, state_shape, action_dim, False)
+        init_buffer(self.memory, self.capacity, state_shape, action_dim, False,
+                    storage=self.storage, storage_dir=self.storage_dir, schema=self.schema)
+        # rows merged with zero priority, e.g., the tails of chunks streamed by LocalBuffer, 
+        # only hold next states of the rows before them and are never sampled
+        self.hidden = np.zeros(self.capacity, dtype=bool)
 
         # Code for single agent
-        if self.n_steps > 1:
+        if self.has_tb:
             self.tb_capacity = args['tb_capacity']
             self.tb_idx = 0
             self.tb_full = False
             self.tb = {}
-            init_buffer(self.tb, self.tb_capacity, state_shape, action_dim, False)
+            init_buffer(self.tb, self.tb_capacity, state_shape, action_dim, False, schema=self.schema)
 
     @override(Replay)
     def add(self, state, action, reward, done):
+        if not self.has_tb:
+            # the row is written in place, not merged
+            self.hidden[self.mem_idx] = False
         super()._add(state, action, reward, done)
 
+    @override(Replay)
+    def add_batch(self, states, actions, rewards, dones):
+        super()._add_batch(states, actions, rewards, dones)
+
     """ Implementation """
+    @override(Replay)
+    def _write(self, start_idx, local_buffer, length):
+        super()._write(start_idx, local_buffer, length)
+        rows = (start_idx + np.arange(length)) % self.capacity
+        self.hidden[rows] = (local_buffer['priority'][:length, 0] == 0 if 'priority' in local_buffer 
+                             else False)
+
+    @override(Replay)
+    def _hold_rows(self, rows):
+        held = self.hidden[rows].astype(np.float64)
+        self.hidden[rows] = True
+        self._mark_dirty(rows)
+
+        return held
+
+    @override(Replay)
+    def _release_rows(self, rows, held):
+        self.hidden[rows] = held.astype(bool)
+        self._mark_dirty(rows)
+
     @override(Replay)
     def _sample(self):
         size = self.capacity if self.is_full else self.mem_idx
         indexes = np.random.randint(0, size, self.batch_size)
+        # hidden rows are redrawn, they are a small fraction of memory
+        hidden = self.hidden[indexes]
+        while np.any(hidden):
+            indexes[hidden] = np.random.randint(0, size, np.sum(hidden))
+            hidden = self.hidden[indexes]
         
         samples = self._get_samples(indexes)
 
         return samples
+
+    @override(Replay)
+    def _snapshot_arrays(self):
+        arrays = super()._snapshot_arrays()
+        arrays['hidden'] = self.hidden
+
+        return arrays
@@ -1,21 +1,131 @@
+import os
+import shutil
+import tempfile
+import weakref
 import numpy as np
 
 from utility.debug_tools import assert_colorize
+from algo.off_policy.replay.compressed_array import CompressedArray
+from algo.off_policy.replay.shared_array import SharedArray
 
 
-def init_buffer(buffer, capacity, state_shape, action_dim, has_priority, extra_state=0):
-    state_dtype = np.float16
+def build_schema(schema_args, action_dim):
+    """ Build the storage layout of replay fields from the schema in yaml, e.g.,
+        schema:
+            state: {dtype: uint8, scale: 0.00392156862, offset: 0, compression: lz4}
+            action: {dtype: int32}
+            reward: {dtype: float32}
+    Fields with scale are quantized as round((x - offset) / scale) and decoded as stored * scale + offset.
+    States with frame_stack > 1 are frames stacked along the last axis, only the newest frame of 
+    each state is stored and states are rebuilt at sample time. States with compression: lz4 are
+    stored in compressed chunks of chunk_size rows, the last cache_size chunks read are kept decoded.
+    Unspecified fields keep the default dtypes """
+    schema = dict(
+        state=dict(dtype=np.float16),
+        action=dict(dtype=np.int8 if action_dim == 1 else np.float16),
+        reward=dict(dtype=np.float16),
+    )
+    for name, spec in (schema_args or {}).items():
+        assert_colorize(name in schema, f'Unknown field in buffer schema: {name}')
+        schema[name] = dict(spec)
+        assert_colorize(name != 'reward' or 'scale' not in spec, 
+                        'Reward cannot be quantized since n-step returns are accumulated in place')
+    for spec in schema.values():
+        spec['dtype'] = np.dtype(spec['dtype'])
+        spec['scale'] = float(spec['scale']) if 'scale' in spec else None
+        spec['offset'] = float(spec['offset']) if 'offset' in spec else 0.
+    state_spec = schema['state']
+    state_spec['frame_stack'] = int(state_spec['frame_stack']) if 'frame_stack' in state_spec else 1
+    state_spec['compression'] = state_spec['compression'] if 'compression' in state_spec else None
+    assert_colorize(state_spec['compression'] in [None, 'lz4'], 
+                    f'Unknown state compression: {state_spec["compression"]}')
+    state_spec['chunk_size'] = int(state_spec['chunk_size']) if 'chunk_size' in state_spec else 32
+    state_spec['cache_size'] = int(state_spec['cache_size']) if 'cache_size' in state_spec else 8
+
+    return schema
+
+def encode(schema, name, x):
+    """ Encode x to be stored in field name """
+    if schema is None:
+        return x
+    spec = schema[name]
+    if 'frame_stack' in spec and spec['frame_stack'] > 1:
+        # only the newest frame is stored
+        x = np.asarray(x)[..., -1]
+    if spec['scale'] is None:
+        return x
+    x = np.round((np.asarray(x) - spec['offset']) / spec['scale'])
+    if np.issubdtype(spec['dtype'], np.integer):
+        info = np.iinfo(spec['dtype'])
+        x = np.clip(x, info.min, info.max)
+
+    return x
+
+def decode(schema, name, x):
+    """ Decode x stored in field name to float32 """
+    if schema is None:
+        return x
+    x = np.asarray(x, dtype=np.float32)
+    if schema[name]['scale'] is not None:
+        x = x * schema[name]['scale'] + schema[name]['offset']
+
+    return x
+
+def init_buffer(buffer, capacity, state_shape, action_dim, has_priority, extra_state=0, 
+                storage='ram', storage_dir=None, schema=None, rnn_state_size=None):
+    """ Allocate all fields of buffer, with dtypes given by schema. 
+    storage='memmap' puts each field in a file-backed np.memmap under storage_dir,
+    storage='shared' puts each field in a SharedArray other processes can write to,
+    states compressed by the schema are CompressedArrays in any case.
+    rnn_state_size adds the recurrent state of the actor before each transition """
+    schema = schema or build_schema(None, action_dim)
+    state_dtype = schema['state']['dtype']
+    frame_stack = schema['state']['frame_stack']
+    if frame_stack > 1:
+        state_shape = state_shape[:-1]
     action_shape = (capacity, ) if action_dim == 1 else (capacity, action_dim)
-    action_dtype = np.int8 if action_dim == 1 else np.float16
+    action_dtype = schema['action']['dtype']
+
+    if storage == 'ram':
+        allocate = lambda name, shape, dtype: np.zeros(shape, dtype=dtype)
+    elif storage == 'memmap':
+        assert_colorize(storage_dir is not None, 'storage_dir is required by memmap storage')
+        os.makedirs(storage_dir, exist_ok=True)
+        # each buffer gets its own directory so that multiple buffers can share storage_dir
+        buffer_dir = tempfile.mkdtemp(prefix='replay-', dir=storage_dir)
+        def allocate(name, shape, dtype):
+            array = np.memmap(os.path.join(buffer_dir, f'{name}.dat'), dtype=dtype, mode='w+', shape=shape)
+            # the directory is removed once any of its arrays is collected or the interpreter exits,
+            # arrays still alive keep their unlinked files mapped
+            weakref.finalize(array, shutil.rmtree, buffer_dir, ignore_errors=True)
+            return array
+    elif storage == 'shared':
+        assert_colorize(schema['state']['compression'] is None, 'Compressed states cannot be shared')
+        allocate = lambda name, shape, dtype: SharedArray.create(shape, dtype)
+    else:
+        raise NotImplementedError(f'Unknown storage: {storage}')
+
+    if schema['state']['compression'] == 'lz4':
+        # compressed states are kept in ram whatever the storage
+        state = CompressedArray((capacity + extra_state, *state_shape), state_dtype, 
+                                chunk_size=schema['state']['chunk_size'], 
+                                cache_size=schema['state']['cache_size'])
+    else:
+        state = allocate('state', (capacity + extra_state, *state_shape), state_dtype)
 
-    target_buffer = {'priority': np.zeros((capacity, 1))} if has_priority else {}
+    target_buffer = {'priority': allocate('priority', (capacity, 1), np.float64)} if has_priority else {}
     target_buffer.update({
-        'state': np.zeros((capacity + extra_state, *state_shape), dtype=state_dtype),
-        'action': np.zeros(action_shape, dtype=action_dtype),
-        'reward': np.zeros((capacity, 1), dtype=np.float16),
-        'done': np.zeros((capacity, 1), dtype=np.bool),
-        'steps': np.zeros((capacity, 1), dtype=np.uint8)
+        'state': state,
+        'action': allocate('action', action_shape, action_dtype),
+        'reward': allocate('reward', (capacity, 1), schema['reward']['dtype']),
+        'done': allocate('done', (capacity, 1), np.bool),
+        'steps': allocate('steps', (capacity, 1), np.uint8)
     })
+    if frame_stack > 1:
+        # number of steps since the episode start, capped at 255
+        target_buffer['since_start'] = allocate('since_start', (capacity + extra_state, 1), np.uint8)
+    if rnn_state_size:
+        target_buffer['rnn_state'] = allocate('rnn_state', (capacity, rnn_state_size), np.float32)
 
     buffer.update(target_buffer)
 
@@ -26,9 +136,13 @@ def reset_buffer(buffer):
 
     buffer.update(target_buffer)
 
-def add_buffer(buffer, idx, state, action, reward, done, n_steps, gamma):
-    buffer['state'][idx] = state
-    buffer['action'][idx] = action
+def add_buffer(buffer, idx, state, action, reward, done, n_steps, gamma, schema=None, episode_step=0, rnn_state=None):
+    buffer['state'][idx] = encode(schema, 'state', state)
+    if 'since_start' in buffer:
+        buffer['since_start'][idx] = min(episode_step, 255)
+    if rnn_state is not None:
+        buffer['rnn_state'][idx] = np.reshape(rnn_state, -1)
+    buffer['action'][idx] = encode(schema, 'action', action)
     buffer['reward'][idx] = reward
     buffer['done'][idx] = done
     buffer['steps'][idx] = 1
@@ -50,3 +164,101 @@ def copy_buffer(dest_buffer, dest_start, dest_end, orig_buffer, orig_start, orig
     
     for key in (dest_buffer if dest_keys else orig_buffer).keys():
         dest_buffer[key][dest_start: dest_end] = orig_buffer[key][orig_start: orig_end]
+
+def frame_offsets(since_start, frame_stack, max_offsets):
+    """ Offsets back from each row to the rows of the frames stacked into its state, oldest first.
+    Frames before the episode start or more than max_offsets back are replaced by the oldest valid frame,
+    as frame stacking wrappers repeat the first frame of an episode """
+    return np.minimum(np.arange(frame_stack - 1, -1, -1), np.minimum(since_start, max_offsets)[:, None])
+
+def gather_frames(frames, rows, out=None):
+    """ Gather frames at rows of shape [B, frame_stack] into states stacked along the last axis """
+    stacked = np.moveaxis(np.take(frames, rows, axis=0), 1, -1)
+    if out is None:
+        return np.ascontiguousarray(stacked)
+    out[...] = stacked
+
+    return out
+
+def stack_samples(sample_fn, k):
+    """ Call sample_fn k times and stack the (nested tuples of) arrays it returns 
+    along a new leading axis. Each batch is copied before sample_fn is called again, 
+    so sample_fn may reuse its arrays """
+    def allocate(x):
+        return tuple(allocate(v) for v in x) if isinstance(x, tuple) else np.empty((k, *np.shape(x)), np.asarray(x).dtype)
+
+    def assign(stack, x, i):
+        if isinstance(x, tuple):
+            for s, v in zip(stack, x):
+                assign(s, v, i)
+        else:
+            stack[i] = x
+
+    samples = sample_fn()
+    stack = allocate(samples)
+    assign(stack, samples, 0)
+    for i in range(1, k):
+        assign(stack, sample_fn(), i)
+
+    return stack
+
+
+if __name__ == '__main__':
+    # compare sample throughput of ram and memmap storage, memmap storage is measured both 
+    # with its pages in the page cache (warm) and right after they are evicted (cold)
+    import mmap
+    import shutil
+    from utility.debug_tools import timeit
+    from algo.off_policy.replay.uniform_replay import UniformReplay
+    from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+
+    capacity = int(1e6)
+    state_shape = (24,)
+    action_dim = 4
+    # cold runs read from disk only if storage_dir is not on tmpfs
+    storage_dir = tempfile.mkdtemp(prefix='replay-benchmark-')
+    args = dict(
+        capacity=capacity,
+        min_size=capacity,
+        batch_size=256,
+        normalize_reward=False,
+        n_steps=3,
+        gamma=.99,
+        alpha=.5,
+        beta0=.4,
+        beta_steps=5e4,
+        tb_capacity=100,
+        storage_dir=storage_dir,
+    )
+    local_buffer = {}
+    init_buffer(local_buffer, capacity, state_shape, action_dim, True)
+    local_buffer['state'][:] = np.random.normal(size=local_buffer['state'].shape)
+    local_buffer['action'][:] = np.random.uniform(-1, 1, size=local_buffer['action'].shape)
+    local_buffer['reward'][:] = np.random.normal(size=local_buffer['reward'].shape)
+    local_buffer['steps'][:] = 3
+    local_buffer['priority'][:] = np.random.uniform(size=local_buffer['priority'].shape)
+
+    def evict(memory):
+        """ Write memmaps back to their files and drop their pages from the page cache """
+        for v in memory.values():
+            if isinstance(v, np.memmap):
+                v.flush()
+                # pages still mapped by this process are not dropped by posix_fadvise
+                v._mmap.madvise(mmap.MADV_DONTNEED)
+                fd = os.open(v.filename, os.O_RDONLY)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                os.close(fd)
+
+    n = 1000
+    for ReplayType in [UniformReplay, ProportionalPrioritizedReplay]:
+        for storage in ['ram', 'memmap']:
+            replay = ReplayType(dict(args, storage=storage), state_shape, action_dim)
+            for start in range(0, capacity, capacity // 10):
+                replay.merge({k: v[start:] for k, v in local_buffer.items()}, capacity // 10)
+            runs = ['warm'] if storage == 'ram' else ['cold', 'warm']
+            for run in runs:
+                if run == 'cold':
+                    evict(replay.memory)
+                duration, _ = timeit(lambda: [replay.sample() for _ in range(n)])
+                print(f'{ReplayType.__name__}-{storage}-{run}:\t{n * args["batch_size"] / duration:.0f} transitions/s')
+    shutil.rmtree(storage_dir)
@@ -0,0 +1,64 @@
+import numpy as np
+import ray
+
+from algo.off_policy.apex.buffer import LocalBuffer
+from algo.off_policy.apex.replay_server import get_replay_servers, RemoteReplay
+
+
+state_shape = (3,)
+action_dim = 2
+
+args = dict(
+    type='proportional',
+    capacity=1000,
+    min_size=100,
+    batch_size=32,
+    normalize_reward=False,
+    n_steps=3,
+    gamma=.99,
+    alpha=.5,
+    beta0=.4,
+    beta_steps=1e4,
+    epsilon=1e-4,
+    tb_capacity=10,
+    local_capacity=200,
+    n_servers=2,
+    server_cpus=.5,
+    batches_per_pull=2,
+    priority_update_freq=2,
+)
+
+class TestClass:
+    def test_remote_replay(self):
+        ray.init(num_cpus=1, include_dashboard=False)
+        try:
+            replay = RemoteReplay(dict(args, replay_servers=get_replay_servers(args, state_shape, action_dim)))
+            states = []
+            priorities = []
+            for server in replay.servers:
+                local_buffer = LocalBuffer(args, state_shape, action_dim)
+                for i in range(200):
+                    local_buffer.add_data(np.random.normal(size=state_shape), np.random.uniform(-1, 1, size=action_dim), 
+                                        np.random.normal(), i == 199)
+                local_buffer['priority'][:200] = np.random.uniform(.1, 2, size=(200, 1))
+                ray.get(server.merge.remote(dict(local_buffer), local_buffer.idx))
+                states.append(np.array(local_buffer['state'][:200]))
+                priorities.append(np.array(local_buffer['priority'][:200, 0]))
+            assert replay.good_to_learn
+            assert len(replay) == 400
+
+            # IS ratios are normalized by the minimum priority of all servers
+            IS_ratios, indexes, _ = replay.sample()
+            server_nos = indexes // replay.server_capacity
+            np.testing.assert_allclose(IS_ratios, 
+                (np.min(priorities) / np.array(priorities)[server_nos, indexes % replay.server_capacity])**args['beta0'], 
+                rtol=1e-3)
+            for _ in range(4):
+                IS_ratios, indexes, (state, _, _, _, _, _) = replay.sample()
+                assert np.all(IS_ratios <= 1)
+                server_nos = indexes // replay.server_capacity
+                np.testing.assert_equal(state, np.array(states)[server_nos, indexes % replay.server_capacity])
+                replay.update_priorities(np.random.uniform(.1, 2, size=len(indexes)), indexes)
+            assert replay.priorities == []
+        finally:
+            ray.shutdown()
@@ -0,0 +1,702 @@
+import os
+import pickle
+import threading
+import multiprocessing
+import numpy as np
+import pytest
+
+from algo.off_policy.replay.ds.sum_tree import SumTree
+from algo.off_policy.replay.ds.min_tree import MinTree
+from algo.off_policy.replay.uniform_replay import UniformReplay
+from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+from algo.off_policy.replay.rank_replay import RankBasedPrioritizedReplay
+from algo.off_policy.replay.sharded_replay import ShardedReplay
+from algo.off_policy.replay.shared_replay import SharedReplay, SharedReplayWriter
+from algo.off_policy.replay.sequence_replay import SequenceReplay
+from algo.off_policy.replay.rate_limiter import RateLimiter
+from algo.off_policy.replay.priority_updater import PriorityUpdater
+from algo.off_policy.apex.buffer import LocalBuffer
+from algo.off_policy.apex.codec import encode_experience, decode_experience, encode_weights, decode_weights
+from algo.off_policy.replay.utils import decode
+
+
+state_shape = (3,)
+action_dim = 2
+
+args = dict(
+    capacity=1000,
+    min_size=100,
+    batch_size=64,
+    normalize_reward=False,
+    n_steps=3,
+    gamma=.99,
+    alpha=.5,
+    beta0=.4,
+    beta_steps=1e4,
+    epsilon=1e-4,
+    tb_capacity=10,
+    local_capacity=300,
+)
+
+def fill_local_buffer(buffer, length):
+    buffer.reset()
+    for i in range(length):
+        buffer.add_data(np.random.normal(size=state_shape), np.random.uniform(-1, 1, size=action_dim), 
+                        np.random.normal(), i == length - 1)
+    buffer['priority'][:length] = np.random.uniform(.1, 2, size=(length, 1))
+
+
+class TestClass:
+    def test_sum_tree_find_batch(self):
+        for capacity in [1, 2, 7, 8, 1000]:
+            tree = SumTree(capacity)
+            for mem_idx, priority in enumerate(np.random.uniform(size=capacity)):
+                tree.update(priority, mem_idx)
+            values = np.random.uniform(0, tree.total_priorities, size=64)
+            priorities, indexes = list(zip(*[tree.find(v) for v in values]))
+            batch_priorities, batch_indexes = tree.find_batch(values)
+
+            np.testing.assert_equal(batch_priorities, priorities)
+            np.testing.assert_equal(batch_indexes, indexes)
+
+    def test_sum_tree_update_batch(self):
+        for capacity in [1, 2, 7, 8, 1000]:
+            tree = SumTree(capacity)
+            batch_tree = SumTree(capacity)
+            # duplicate indexes are expected, the last priority should take effect
+            mem_idxs = np.random.randint(0, capacity, size=2 * capacity)
+            priorities = np.random.uniform(size=2 * capacity)
+            for priority, mem_idx in zip(priorities, mem_idxs):
+                tree.update(priority, mem_idx)
+            batch_tree.update_batch(priorities, mem_idxs)
+
+            np.testing.assert_allclose(batch_tree.container, tree.container)
+
+    def test_min_tree(self):
+        tree = MinTree(1000)
+        mem_idxs = np.random.randint(0, 1000, size=500)
+        priorities = np.random.uniform(size=500)
+        tree.update_batch(priorities, mem_idxs)
+        leaves = tree.container[tree.tree_size:]
+
+        np.testing.assert_equal(leaves[mem_idxs[-1]], priorities[-1])
+        np.testing.assert_equal(tree.min_priority, np.min(leaves))
+
+    def test_proportional_IS_ratios(self):
+        replay = ProportionalPrioritizedReplay(args, state_shape, action_dim)
+        local_buffer = LocalBuffer(args, state_shape, action_dim)
+        for _ in range(5):
+            fill_local_buffer(local_buffer, 300)
+            replay.merge(local_buffer, local_buffer.idx)
+        leaves = replay.data_structure.container[replay.data_structure.tree_size:]
+        np.testing.assert_equal(replay.min_tree.min_priority, np.min(leaves))
+
+        beta = replay.beta
+        IS_ratios, indexes, _ = replay.sample()
+        expected = (np.min(leaves) / leaves[indexes])**beta
+        np.testing.assert_allclose(IS_ratios, expected)
+        assert np.all(IS_ratios <= 1)
+
+    def test_rank_based_replay(self):
+        replay = RankBasedPrioritizedReplay(args, state_shape, action_dim)
+        local_buffer = LocalBuffer(args, state_shape, action_dim)
+        for _ in range(5):
+            fill_local_buffer(local_buffer, 300)
+            replay.merge(local_buffer, local_buffer.idx)
+        assert len(replay.data_structure) == len(replay)
+        priorities = replay.data_structure.container[replay.data_structure.order]
+        assert np.all(np.diff(priorities) <= 0)
+
+        beta = replay.beta
+        IS_ratios, indexes, _ = replay.sample()
+        ranks = np.argsort(replay.data_structure.order)[indexes]
+        assert np.all(ranks >= replay.segment_starts) and np.all(ranks < replay.segment_ends)
+        np.testing.assert_allclose(IS_ratios, ((ranks + 1.) / len(replay))**(replay.alpha * beta))
+
+        # ranked rows are re-ranked as soon as their priorities are updated
+        replay.update_priorities(np.random.uniform(0, 3, size=len(indexes)), indexes)
+        priorities = replay.data_structure.container[replay.data_structure.order]
+        assert np.all(np.diff(priorities) <= 0)
+        assert len(replay.data_structure) == len(replay)
+
+    def test_get_samples(self):
+        replay = UniformReplay(dict(args, reward_scale=5), state_shape, action_dim)
+        local_buffer = LocalBuffer(args, state_shape, action_dim)
+        for _ in range(5):
+            fill_local_buffer(local_buffer, 300)
+            replay.merge(local_buffer, local_buffer.idx)
+        
+        indexes = np.random.randint(0, len(replay), size=args['batch_size'])
+        memory = replay.memory
+        done = memory['done'][indexes]
+        next_indexes = (indexes + np.squeeze(memory['steps'][indexes])) % replay.capacity
+        # rewards are emitted in float32
+        reward = memory['reward'][indexes].astype(np.float32)
+        reward *= np.where(done, 1, replay.reward_scale)
+        expected = (memory['state'][indexes], 
+                    memory['action'][indexes], 
+                    reward, 
+                    np.where(done, 0, memory['state'][next_indexes]), 
+                    done, 
+                    memory['steps'][indexes])
+
+        samples = replay._get_samples(indexes)
+        # samples stay valid until the ring of slots wraps around
+        for _ in range(replay.n_sample_slots - 1):
+            replay._get_samples(np.random.randint(0, len(replay), size=args['batch_size']))
+        for x, y in zip(samples, expected):
+            assert x.dtype == y.dtype
+            np.testing.assert_equal(x, y)
+
+    def test_snapshot(self, tmp_path):
+        replay = ProportionalPrioritizedReplay(args, state_shape, action_dim)
+        local_buffer = LocalBuffer(args, state_shape, action_dim)
+        for _ in range(5):
+            fill_local_buffer(local_buffer, 300)
+            replay.merge(local_buffer, local_buffer.idx)
+        replay.save_snapshot(tmp_path, chunk_size=128).join()
+
+        restored = ProportionalPrioritizedReplay(args, state_shape, action_dim)
+        restored.load_snapshot(tmp_path)
+        assert (restored.mem_idx, restored.is_full) == (replay.mem_idx, replay.is_full)
+        for k, v in replay.memory.items():
+            np.testing.assert_equal(restored.memory[k], v)
+        np.testing.assert_allclose(restored.data_structure.container, replay.data_structure.container)
+        np.testing.assert_equal(restored.min_tree.container, replay.min_tree.container)
+
+        # merges go on while the snapshot is saved over the previous one, 
+        # each merge writes its number into states and rewards, and that number + 1 into priorities
+        n_merges = 0
+        def merge_stamped():
+            nonlocal n_merges
+            fill_local_buffer(local_buffer, 100)
+            n_merges += 1
+            local_buffer['state'][:] = local_buffer['reward'][:] = n_merges
+            local_buffer['priority'][:] = n_merges + 1
+            replay.merge(local_buffer, local_buffer.idx)
+        while n_merges < replay.capacity // 100:
+            merge_stamped()
+        thread = replay.save_snapshot(tmp_path, chunk_size=16)
+        while thread.is_alive():
+            merge_stamped()
+        thread.join()
+        assert not os.path.exists(f'{tmp_path}.tmp')
+        restored = ProportionalPrioritizedReplay(args, state_shape, action_dim)
+        restored.load_snapshot(tmp_path)
+        # arrays and meta are taken from the same buffer
+        merge_nos = restored.memory['state'][:, 0]
+        np.testing.assert_equal(restored.memory['state'], np.repeat(merge_nos[:, None], state_shape[0], axis=1))
+        np.testing.assert_equal(restored.memory['reward'][:, 0], merge_nos)
+        np.testing.assert_equal(restored.data_structure.priorities, merge_nos + 1)
+        assert merge_nos[restored.mem_idx - 1] == np.max(merge_nos)
+
+    def test_sharded_replay(self):
+        replay = ShardedReplay(dict(args, n_shards=4), state_shape, action_dim)
+        local_buffer = LocalBuffer(args, state_shape, action_dim)
+        for i in range(16):
+            fill_local_buffer(local_buffer, 100)
+            replay.merge(local_buffer, local_buffer.idx)
+            assert np.sum(replay.n_inserted) == (i + 1) * 100
+            assert len(replay) == np.sum(np.minimum(replay.n_inserted, replay.shard_capacity))
+        assert np.all(replay.shard_full)
+        assert not np.any(replay.being_written)
+        # each shard has its own tree
+        leaves = replay.data_structure.priorities.reshape(replay.n_shards, replay.shard_capacity)
+        np.testing.assert_allclose(replay.data_structure.roots, np.sum(leaves, axis=1))
+
+        IS_ratios, indexes, (state, _, _, next_state, done, steps) = replay.sample()
+        assert np.all(IS_ratios <= 1)
+        # next states never cross shard boundaries
+        shard_nos = indexes // replay.shard_capacity
+        next_indexes = shard_nos * replay.shard_capacity + (indexes + steps[:, 0]) % replay.shard_capacity
+        np.testing.assert_equal(state, replay.memory['state'][indexes])
+        np.testing.assert_equal(next_state, np.where(done, 0, replay.memory['state'][next_indexes]))
+
+        priorities = np.random.uniform(.1, 2, size=len(indexes))
+        replay.update_priorities(priorities, indexes)
+        _, unique_idxs = np.unique(indexes[::-1], return_index=True)
+        unique_idxs = len(indexes) - 1 - unique_idxs
+        np.testing.assert_allclose(replay.data_structure.priorities[indexes[unique_idxs]], priorities[unique_idxs])
+
+        # updates to a shard whose trees are held by a merge wait for the merge
+        with replay.tree_lockers[0]:
+            replay.update_priorities([5.], [0])
+            assert replay.data_structure.priorities[0] != 5.
+        # and are applied by whoever holds the trees of the shard next
+        replay.update_priorities([3.], [1])
+        np.testing.assert_equal(replay.data_structure.priorities[:2], [5., 3.])
+
+    def test_sample_many(self):
+        replays = []
+        for _ in range(2):
+            np.random.seed(0)
+            replay = ProportionalPrioritizedReplay(args, state_shape, action_dim)
+            local_buffer = LocalBuffer(args, state_shape, action_dim)
+            for _ in range(3):
+                fill_local_buffer(local_buffer, 300)
+                replay.merge(local_buffer, local_buffer.idx)
+            replays.append(replay)
+
+        np.random.seed(1)
+        IS_ratios, indexes, samples = replays[0].sample_many(8)
+        np.random.seed(1)
+        for i in range(8):
+            expected_IS_ratios, expected_indexes, expected_samples = replays[1].sample()
+            np.testing.assert_equal(IS_ratios[i], expected_IS_ratios)
+            np.testing.assert_equal(indexes[i], expected_indexes)
+            for x, y in zip(samples, expected_samples):
+                np.testing.assert_equal(x[i], y)
+        assert replays[0].sample_i == replays[1].sample_i == 8
+
+    def test_lazy_n_steps(self):
+        eager = UniformReplay(args, state_shape, action_dim)
+        lazy = UniformReplay(dict(args, lazy_n_steps=True), state_shape, action_dim)
+        for i in range(500):
+            transition = (np.random.normal(size=state_shape), np.random.uniform(-1, 1, size=action_dim), 
+                          np.random.normal(), i == 499 or np.random.uniform() < .05)
+            eager.add(*transition)
+            lazy.add(*transition)
+        assert eager.mem_idx == lazy.mem_idx == 500
+
+        indexes = np.arange(500)
+        _, _, lazy_reward, lazy_next_state, lazy_done, lazy_steps = lazy._get_samples(indexes)
+        _, _, reward, next_state, done, steps = eager._get_samples(indexes)
+        np.testing.assert_equal(lazy_steps, steps)
+        np.testing.assert_equal(lazy_done, done)
+        np.testing.assert_equal(lazy_next_state, next_state)
+        np.testing.assert_allclose(lazy_reward, reward, rtol=1e-2, atol=1e-2)
+
+        # n_steps can be changed without refilling the buffer
+        lazy.n_steps = 1
+        _, _, reward, _, done, steps = lazy._get_samples(indexes)
+        np.testing.assert_equal(reward, lazy.memory['reward'][:500])
+        np.testing.assert_equal(done, lazy.memory['done'][:500])
+        assert np.all(steps == 1)
+
+    def test_lazy_n_steps_write_head(self):
+        n_steps = args['n_steps']
+        for ReplayType in [ProportionalPrioritizedReplay, RankBasedPrioritizedReplay]:
+            replay = ReplayType(dict(args, lazy_n_steps=True), state_shape, action_dim)
+            for i in range(200):
+                replay.add(np.full(state_shape, i), np.zeros(action_dim), 1, i == 100)
+            # the windows of the newest n_steps rows reach past the write head
+            for _ in range(20):
+                _, indexes, (state, _, _, next_state, done, steps) = replay.sample()
+                assert np.all(indexes < 200 - n_steps)
+                np.testing.assert_equal(steps[:, 0], np.where(indexes > 100, n_steps, np.minimum(101 - indexes, n_steps)))
+                np.testing.assert_equal(next_state[:, 0], np.where(done[:, 0], 0, state[:, 0] + steps[:, 0]))
+            replay.add(np.full(state_shape, 200), np.zeros(action_dim), 1, False)
+            np.testing.assert_equal(np.sort(replay.open_rows), [198, 199, 200])
+            replay.add(np.full(state_shape, 201), np.zeros(action_dim), 1, True)
+            assert len(replay.open_rows) == 0
+            assert np.all(replay.data_structure.priorities[:202] > 0)
+
+    def test_add_batch(self):
+        n_envs = 3
+        gamma, n_steps = args['gamma'], args['n_steps']
+        # episodes longer than tb_capacity are merged in several chunks
+        episode_lengths = [[20, 50, 7], [33, 2, 40, 11], [50, 50]]
+        ends = [np.cumsum(lengths) for lengths in episode_lengths]
+        n_total = max(e[-1] for e in ends)
+        rewards = np.random.normal(size=(n_envs, n_total)).astype(np.float32)
+        for ReplayType in [ProportionalPrioritizedReplay, RankBasedPrioritizedReplay]:
+            replay = ReplayType(args, state_shape, action_dim)
+            for t in range(n_total):
+                # finished envs keep stepping, but their episodes are never done
+                dones = np.array([t + 1 in e for e in ends])
+                states = np.array([[env_id, t, 0] for env_id in range(n_envs)], dtype=np.float32)
+                replay.add_batch(states, np.zeros((n_envs, action_dim)), rewards[:, t], dones)
+
+            rows = np.flatnonzero(replay.data_structure.priorities[:replay.mem_idx] > 0)
+            env_ids, ts = replay.memory['state'][rows, 0].astype(int), replay.memory['state'][rows, 1].astype(int)
+            # each step of every finished episode is merged once with a nonzero priority
+            for env_id in range(n_envs):
+                np.testing.assert_equal(np.sort(ts[env_ids == env_id])[:ends[env_id][-1]], np.arange(ends[env_id][-1]))
+            assert len(np.unique(env_ids * n_total + ts)) == len(rows)
+            for row, env_id, t in zip(rows, env_ids, ts):
+                episode_end = ends[env_id][np.searchsorted(ends[env_id], t, side='right')] \
+                    if t < ends[env_id][-1] else np.inf
+                steps = int(min(n_steps, episode_end - t))
+                done = episode_end - t <= n_steps
+                assert replay.memory['steps'][row, 0] == steps
+                assert replay.memory['done'][row, 0] == done
+                np.testing.assert_allclose(replay.memory['reward'][row, 0], 
+                                           np.sum(gamma**np.arange(steps) * rewards[env_id, t: t + steps]), 
+                                           rtol=1e-2, atol=1e-2)
+                if not done:
+                    np.testing.assert_equal(replay.memory['state'][row + steps, :2], [env_id, t + steps])
+
+    def test_schema(self):
+        schema = dict(state=dict(dtype='uint8', scale=4/255, offset=-2), reward=dict(dtype='float32'))
+        schema_args = dict(args, schema=schema)
+        replay = UniformReplay(schema_args, state_shape, action_dim)
+        local_buffer = LocalBuffer(schema_args, state_shape, action_dim)
+        states = np.random.uniform(-2, 2, size=(100, *state_shape))
+        for i, state in enumerate(states):
+            local_buffer.add_data(state, np.random.uniform(-1, 1, size=action_dim), np.random.normal(), i == 99)
+        replay.merge(local_buffer, local_buffer.idx)
+
+        state, _, reward, _, _, _ = replay._get_samples(np.arange(100))
+        assert state.dtype == np.uint8
+        assert reward.dtype == np.float32
+        np.testing.assert_allclose(decode(replay.schema, 'state', state), states, atol=2/255 + 1e-6)
+
+        # float16 rewards are normalized and scaled in float32
+        norm_args = dict(args, normalize_reward=True, reward_scale=3)
+        replay = UniformReplay(norm_args, state_shape, action_dim)
+        local_buffer = LocalBuffer(norm_args, state_shape, action_dim)
+        for i in range(100):
+            local_buffer.add_data(np.zeros(state_shape), np.zeros(action_dim), 1000 + i, False)
+        replay.merge(local_buffer, local_buffer.idx)
+        _, _, reward, _, _, _ = replay._get_samples(np.arange(100))
+        stored = replay.memory['reward'][:100].astype(np.float64)
+        assert reward.dtype == np.float32
+        np.testing.assert_allclose(reward, 3 * replay.running_reward_stats.normalize(stored), rtol=1e-5, atol=1e-7)
+
+    def test_frame_stack(self):
+        frame_shape = (4, 5)
+        stacked_shape = (*frame_shape, 3)
+        stacked_args = dict(args, capacity=200, schema=dict(state=dict(dtype='uint8')))
+        frame_args = dict(args, capacity=200, schema=dict(state=dict(dtype='uint8', frame_stack=3)))
+        stacked = UniformReplay(stacked_args, stacked_shape, action_dim)
+        replay = UniformReplay(frame_args, stacked_shape, action_dim)
+        local_stacked = LocalBuffer(stacked_args, stacked_shape, action_dim)
+        local_buffer = LocalBuffer(frame_args, stacked_shape, action_dim)
+        assert replay.memory['state'].shape == (200, *frame_shape)
+
+        # stacked states repeat the first frame of each episode, the replays wrap around 
+        # and the episode of the second local buffer continues from the first one
+        frames = []
+        for i in range(330):
+            if not frames:
+                frames = [np.random.randint(0, 256, size=frame_shape)] * 3
+            state = np.stack(frames[-3:], axis=-1)
+            frames.append(np.random.randint(0, 256, size=frame_shape))
+            done = i == 329 or np.random.uniform() < .05
+            transition = (state, np.random.uniform(-1, 1, size=action_dim), np.random.normal(), done)
+            if i < 280:
+                stacked.add(*transition)
+                replay.add(*transition)
+                merge_start = replay.mem_idx
+            else:
+                local_stacked.add_data(*transition)
+                local_buffer.add_data(*transition)
+            if done:
+                frames = []
+        # the episode is cut at the start of the local buffer
+        np.testing.assert_equal(local_buffer.sample()[0][2:], local_stacked.sample()[0][2:])
+        stacked.merge(local_stacked, local_stacked.idx)
+        replay.merge(local_buffer, local_buffer.idx)
+
+        # states whose frames are all still in the replay. Transitions left in the temporary buffer
+        # are never merged, so windows reaching the merge do not end at the states the actor saw
+        indexes = np.arange(replay.mem_idx + 2, replay.mem_idx + 200) % 200
+        next_indexes = (indexes + replay.memory['steps'][indexes, 0]) % 200
+        indexes = indexes[(indexes != merge_start) & (indexes != merge_start + 1) 
+                          & (next_indexes != merge_start) & (next_indexes != merge_start + 1)]
+        for x, y in zip(replay._get_samples(indexes), stacked._get_samples(indexes)):
+            np.testing.assert_equal(x, y)
+
+    def test_compression(self):
+        plain_args = dict(args, schema=dict(state=dict(dtype='uint8')))
+        compressed_args = dict(args, schema=dict(state=dict(dtype='uint8', compression='lz4', 
+                                                            chunk_size=64, cache_size=2)))
+        plain = ProportionalPrioritizedReplay(plain_args, state_shape, action_dim)
+        replay = ProportionalPrioritizedReplay(compressed_args, state_shape, action_dim)
+        local_plain = LocalBuffer(plain_args, state_shape, action_dim)
+        local_buffer = LocalBuffer(compressed_args, state_shape, action_dim)
+        # the replays wrap around
+        for _ in range(5):
+            local_plain.reset()
+            local_buffer.reset()
+            for i in range(300):
+                transition = (np.random.randint(0, 256, size=state_shape), np.random.uniform(-1, 1, size=action_dim), 
+                              np.random.normal(), i == 299)
+                local_plain.add_data(*transition)
+                local_buffer.add_data(*transition)
+            local_plain['priority'][:300] = local_buffer['priority'][:300] = 1
+            # local buffers are pickled on their way to the replay
+            plain.merge(local_plain, local_plain.idx)
+            replay.merge(pickle.loads(pickle.dumps(local_buffer)), local_buffer.idx)
+
+        np.testing.assert_equal(replay.memory['state'][:], plain.memory['state'])
+        indexes = np.random.randint(0, len(replay), size=args['batch_size'])
+        for x, y in zip(replay._get_samples(indexes), plain._get_samples(indexes)):
+            np.testing.assert_equal(x, y)
+        # index arrays keep their shape, as for ndarrays
+        rows = np.random.randint(0, len(replay), size=(4, 8))
+        np.testing.assert_equal(replay.memory['state'][rows], plain.memory['state'][rows])
+        np.testing.assert_equal(replay.memory['state'][rows[0, 0]], plain.memory['state'][rows[0, 0]])
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(samples_per_insert=2, error_buffer=10, min_size=5, timeout=.01)
+        limiter.await_insert(5)     # diff: 10, band: [0, 20]
+        limiter.await_insert(10)    # inside the band before the call, overshoots it
+        limiter.await_insert(1)     # above the band, times out
+        assert (limiter.diff, limiter.n_insert_timeouts) == (32, 1)
+        limiter.await_sample(40)    # inside the band before the call, overshoots it
+        limiter.await_sample(1)     # below the band, times out
+        assert (limiter.diff, limiter.n_sample_timeouts) == (-9, 1)
+        assert limiter.insert_wait_time > 0 and limiter.sample_wait_time > 0
+
+        # a writer and a sampler in different threads stay in the band
+        limiter_args = dict(samples_per_insert=2, error_buffer=128, timeout=1)
+        replay = UniformReplay(dict(args, rate_limiter=limiter_args), state_shape, action_dim)
+        local_buffer = LocalBuffer(args, state_shape, action_dim)
+        fill_local_buffer(local_buffer, 100)
+        replay.merge(local_buffer, local_buffer.idx)
+        writer = threading.Thread(target=lambda: [replay.merge(local_buffer, local_buffer.idx) for _ in range(20)])
+        writer.start()
+        diffs = []
+        while writer.is_alive():
+            replay.sample()
+            diffs.append(replay.rate_limiter.diff)
+        writer.join()
+        limiter = replay.rate_limiter
+        assert limiter.n_inserted == 2100
+        assert limiter.min_diff - args['batch_size'] <= min(diffs)
+        assert max(diffs) <= limiter.max_diff + 2 * 100
+        assert limiter.n_insert_timeouts == 0
+
+    def test_episode_index(self):
+        def check_index(replay):
+            episodes = replay.episodes
+            starts, ends = episodes.starts, episodes.ends
+            assert np.all(starts[1:] >= ends[:-1]) and np.all(ends <= replay.capacity)
+            ids = episodes.order
+            reward = replay.memory['reward'][:, 0].astype(np.float64)
+            priority = replay.data_structure.priorities
+            for i, start, end in zip(ids, starts, ends):
+                np.testing.assert_allclose(episodes.ret[i], np.sum(reward[start: end]), atol=1e-6)
+                np.testing.assert_allclose(episodes.priority[i], np.sum(priority[start: end]), atol=1e-6)
+            # rows outside episodes are never sampled
+            covered = np.zeros(replay.capacity, dtype=bool)
+            for start, end in zip(starts, ends):
+                covered[start: end] = True
+            assert np.all(priority[~covered] == 0)
+
+        local_buffer = LocalBuffer(args, state_shape, action_dim)
+        for eviction in ['fifo', 'reservoir', 'lowest_priority', 'top_k_return']:
+            replay = ProportionalPrioritizedReplay(dict(args, eviction=eviction, episode_index=True, top_k=3), 
+                                                   state_shape, action_dim)
+            best_ret = -np.inf
+            for i in range(100):
+                fill_local_buffer(local_buffer, np.random.randint(10, 100))
+                local_buffer['priority'][:local_buffer.idx] = np.random.uniform(.1, 2)
+                n_rejected = replay.n_rejected
+                replay.merge(local_buffer, local_buffer.idx)
+                replay.update_priorities(np.random.uniform(.1, 2, size=64), np.random.randint(0, len(replay), size=64))
+                check_index(replay)
+                if replay.n_rejected == n_rejected:
+                    best_ret = max(best_ret, np.sum(local_buffer['reward'][:local_buffer.idx], dtype=np.float64))
+            if eviction == 'top_k_return':
+                # the best episode is never evicted
+                np.testing.assert_allclose(np.max(replay.episodes.ret[replay.episodes.order]), best_ret)
+            if eviction in ['reservoir', 'lowest_priority']:
+                assert replay.n_rejected > 0
+
+            rows, sequences = replay.sample_sequences(8)
+            ids = replay.episodes.find(rows)
+            assert np.all(ids >= 0) and np.all(ids == ids[:, :1])
+            np.testing.assert_equal(sequences['state'], replay.memory['state'][rows])
+
+    def test_sequence_replay(self):
+        seq_args = dict(args, seq_len=8, burn_in=4, seq_period=4, rnn_state_size=5)
+        replay = SequenceReplay(seq_args, state_shape, action_dim)
+        local_buffer = LocalBuffer(seq_args, state_shape, action_dim)
+        for merge_no in range(1, 31):
+            local_buffer.reset()
+            length = np.random.randint(10, 100)
+            # half of the merges stop in the middle of an episode, as chunks streamed by workers do
+            ends_episode = merge_no % 2 == 0
+            for i in range(length):
+                local_buffer.add_data(np.random.normal(size=state_shape), np.random.uniform(-1, 1, size=action_dim), 
+                                      np.random.normal(), np.random.uniform() < .05 or (ends_episode and i == length - 1), 
+                                      rnn_state=np.random.normal(size=5))
+            local_buffer['state'][:length, -1] = merge_no
+            local_buffer['priority'][:length] = np.random.uniform(.1, 2, size=(length, 1))
+            replay.merge(local_buffer, length)
+        # only sequences whose start rows are still in memory are kept
+        ids = (replay.seq_oldest + np.arange(replay.n_valid_seqs)) % replay.n_sequences
+        assert np.all(replay.seq_abs_start[ids] >= replay.n_written - replay.capacity)
+        assert np.all(replay.data_structure.priorities[np.setdiff1d(np.arange(replay.n_sequences), ids)] == 0)
+
+        IS_ratios, indexes, (state, action, reward, next_state, done, steps, mask, rnn_state) = replay.sample()
+        T = replay.seq_total
+        assert state.shape == (64, T, *state_shape) and mask.shape == (64, T) and rnn_state.shape == (64, 5)
+        rows = (replay.seq_start[indexes][:, None] + np.arange(T)) % replay.capacity
+        np.testing.assert_equal(state, replay.memory['state'][rows])
+        np.testing.assert_equal(rnn_state, replay.rnn_state[indexes])
+        # steps are trained on past burn-in and inside the episode, which only ends at the last of them
+        assert np.all(np.any(mask, axis=1))
+        episode_end = done[..., 0] & (steps[..., 0] == 1)
+        assert not np.any(episode_end[:, :-1] & mask[:, 1:])
+        # next states of steps trained on are in their merges
+        bootstrapped = mask & np.logical_not(done[..., 0])
+        np.testing.assert_equal(next_state[..., -1][bootstrapped], state[..., -1][bootstrapped])
+        
+        replay.update_priorities(np.zeros(64), indexes)
+        assert np.all(replay.data_structure.priorities[indexes] == 0)
+
+    def test_priority_updater(self):
+        replay = ProportionalPrioritizedReplay(args, state_shape, action_dim)
+        local_buffer = LocalBuffer(args, state_shape, action_dim)
+        fill_local_buffer(local_buffer, 300)
+        replay.merge(local_buffer, 300)
+        updater = PriorityUpdater(replay, max_staleness=3)
+        expected = replay.data_structure.priorities[:300].copy()
+        for _ in range(200):
+            priorities = np.random.uniform(.1, 2, size=64)
+            saved_mem_idxs = np.random.randint(0, 300, size=64)
+            updater.update_priorities(priorities, saved_mem_idxs)
+            for p, i in zip(priorities, saved_mem_idxs):
+                expected[i] = p
+        updater.flush()
+        np.testing.assert_allclose(replay.data_structure.priorities[:300], expected)
+        np.testing.assert_allclose(replay.min_tree.min_priority, np.min(expected))
+        stats = updater.stats()
+        assert stats['PriorityUpdates'] == 200 and stats['PriorityBatches'] <= 200
+        assert stats['PriorityLagMax'] < 3
+
+    def test_shared_replay(self):
+        replay = SharedReplay(dict(args, n_shards=2, hide_ahead=100), state_shape, action_dim)
+        spec = replay.writer_spec()
+        def write(shard_no):
+            writer = SharedReplayWriter(spec, shard_no)
+            local_buffer = LocalBuffer(args, state_shape, action_dim)
+            for i in range(50):
+                fill_local_buffer(local_buffer, 100)
+                # rows of a merge are filled with its number, so torn rows have mixed values
+                local_buffer['state'][:100] = 100 * shard_no + i
+                local_buffer['action'][:100] = 100 * shard_no + i
+                writer.merge(local_buffer, 100)
+        try:
+            # writers are other processes, which only see the replay through shared memory
+            writers = [multiprocessing.get_context('fork').Process(target=write, args=(i,)) for i in range(2)]
+            [w.start() for w in writers]
+            while not replay.good_to_learn:
+                pass
+            while any(w.is_alive() for w in writers):
+                IS_ratios, indexes, (state, action, _, _, _, _) = replay.sample()
+                assert np.all(state == state[:, :1]) and np.all(action == state[:, :2])
+                replay.update_priorities(np.random.uniform(.1, 2, size=64), indexes)
+            [w.join() for w in writers]
+            assert all(w.exitcode == 0 for w in writers)
+            replay.sample()
+            assert np.all(replay.n_inserted == 5000)
+            # the newest rows of each shard are the last merge, the rows after them are hidden
+            np.testing.assert_equal(replay.memory['state'][400: 500], 49)
+            np.testing.assert_equal(replay.memory['state'][900: 1000], 149)
+            assert np.all(replay.data_structure.priorities[: 100] == 0)
+            assert np.all(replay.data_structure.priorities[400: 500] > 0)
+            # writers give up when the replay stops releasing rows
+            writer = SharedReplayWriter(dict(spec, timeout=.05), 0)
+            local_buffer = LocalBuffer(args, state_shape, action_dim)
+            fill_local_buffer(local_buffer, 100)
+            writer.merge(local_buffer, 100)
+            with pytest.raises(TimeoutError):
+                writer.merge(local_buffer, 100)
+        finally:
+            replay.close()
+
+    def test_local_buffer_chunks(self):
+        n_steps, chunk_size, T = args['n_steps'], 50, 1000
+        replay = ProportionalPrioritizedReplay(dict(args, capacity=2000), state_shape, action_dim)
+        local_buffer = LocalBuffer(dict(args, local_capacity=chunk_size + n_steps), state_shape, action_dim)
+        rewards = np.random.randint(-5, 5, size=T).astype(np.float32)
+        dones = np.random.uniform(size=T) < .05
+        for t in range(T):
+            local_buffer.add_data(np.full(state_shape, t), np.zeros(action_dim), rewards[t], dones[t])
+            if local_buffer.chunk_ready:
+                chunk, length = local_buffer.pop_chunk()
+                chunk['priority'][:length - n_steps] = np.random.uniform(.1, 2, size=(length - n_steps, 1))
+                replay.merge(chunk, length)
+                local_buffer.carry_tail()
+        
+        # each step is merged once with a nonzero priority
+        sampleable = replay.data_structure.priorities[:len(replay)] > 0
+        np.testing.assert_equal(np.sort(replay.memory['state'][:len(replay)][sampleable, 0]), 
+                                np.arange(np.sum(sampleable)))
+        for _ in range(10):
+            _, _, (state, _, reward, next_state, done, steps) = replay.sample()
+            for t, r, ns, d, k in zip(state[:, 0].astype(int), reward[:, 0], next_state[:, 0], done[:, 0], steps[:, 0]):
+                # n-step returns are complete across chunk boundaries
+                end = t + np.argmax(dones[t: t + n_steps]) + 1 if np.any(dones[t: t + n_steps]) else t + n_steps
+                assert k == end - t and d == dones[end - 1]
+                np.testing.assert_allclose(r, np.sum(rewards[t: end] * args['gamma']**np.arange(k)), atol=.05)
+                assert d or ns == t + k
+
+    def test_uniform_replay_chunks(self):
+        n_steps, chunk_size, T = args['n_steps'], 50, 1000
+        replay = UniformReplay(dict(args, capacity=2000), state_shape, action_dim)
+        local_buffer = LocalBuffer(dict(args, local_capacity=chunk_size + n_steps), state_shape, action_dim)
+        dones = np.random.uniform(size=T) < .05
+        for t in range(T):
+            local_buffer.add_data(np.full(state_shape, t), np.zeros(action_dim), 1, dones[t])
+            if local_buffer.chunk_ready:
+                chunk, length = local_buffer.pop_chunk()
+                chunk['priority'][:length - n_steps] = 1
+                # tail rows are marked in the replay only
+                chunk['action'][length - n_steps: length] = 1
+                replay.merge(chunk, length)
+                chunk['action'][length - n_steps: length] = 0
+                local_buffer.carry_tail()
+
+        # the tails of chunks are hidden, each step is stored once otherwise
+        visible = np.logical_not(replay.hidden[:len(replay)])
+        np.testing.assert_equal(np.sort(replay.memory['state'][:len(replay)][visible, 0]), 
+                                np.arange(np.sum(visible)))
+        for _ in range(100):
+            state, action, _, next_state, done, steps = replay.sample()
+            assert np.all(action == 0)
+            np.testing.assert_equal(np.where(done[:, 0], 0, state[:, 0] + steps[:, 0]), next_state[:, 0])
+
+    def test_frame_stack_chunks(self):
+        n_steps, chunk_size, T = args['n_steps'], 20, 500
+        frame_shape = (2, 3)
+        stacked_shape = (*frame_shape, 4)
+        frame_args = dict(args, capacity=2000, schema=dict(state=dict(dtype='float32', frame_stack=4)))
+        replay = ProportionalPrioritizedReplay(frame_args, stacked_shape, action_dim)
+        local_buffer = LocalBuffer(dict(frame_args, local_capacity=chunk_size + n_steps), stacked_shape, action_dim)
+        # the newest frame of the state at step t is filled with t
+        stacks = []
+        dones = np.random.uniform(size=T) < .05
+        frames = []
+        for t in range(T):
+            frames = frames or [np.full(frame_shape, t)] * 3
+            frames.append(np.full(frame_shape, t))
+            stacks.append(np.stack(frames[-4:], axis=-1))
+            local_buffer.add_data(stacks[t], np.zeros(action_dim), 1, dones[t])
+            if dones[t]:
+                frames = []
+            if local_buffer.chunk_ready:
+                chunk, length = local_buffer.pop_chunk()
+                chunk['priority'][local_buffer.start: length - n_steps] = 1
+                replay.merge(chunk, length)
+                local_buffer.carry_tail()
+
+        # each step is sampleable once, with the stacks the actor saw
+        indexes = np.flatnonzero(replay.data_structure.priorities[:len(replay)])
+        state, _, _, next_state, done, steps = replay._get_samples(indexes)
+        ts = state[:, 0, 0, -1].astype(int)
+        np.testing.assert_equal(np.sort(ts), np.arange(len(ts)))
+        np.testing.assert_equal(state, np.array(stacks)[ts])
+        next_ts = np.minimum(ts + steps[:, 0], T - 1)
+        np.testing.assert_equal(next_state, np.where(done[:, 0, None, None, None], 0, np.array(stacks)[next_ts]))
+
+    def test_codec(self):
+        chunk = dict(state=np.random.randint(0, 255, size=(50, 84, 84), dtype=np.uint8),
+                     reward=np.random.normal(size=(50, 1)).astype(np.float32),
+                     done=np.random.uniform(size=(50, 1)) < .1)
+        decoded = decode_experience(pickle.loads(pickle.dumps(encode_experience(chunk, 'lz4'))))
+        for k, v in chunk.items():
+            assert decoded[k].dtype == v.dtype
+            np.testing.assert_equal(decoded[k], v)
+        assert decode_experience(chunk) is chunk
+
+        weights = np.random.normal(0, .1, size=1000).astype(np.float32)
+        assert decode_weights(encode_weights(weights, None)) is weights
+        for codec, rtol in [('float16', 2**-11), ('bfloat16', 2**-8)]:
+            decoded = decode_weights(encode_weights(weights, codec))
+            assert decoded.dtype == np.float32
+            np.testing.assert_allclose(decoded, weights, rtol=rtol, atol=1e-7)